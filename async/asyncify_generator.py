@@ -1,8 +1,14 @@
 # https://stackoverflow.com/questions/62294385/synchronous-generator-in-asyncio
 
 import asyncio, threading
+import functools
+import inspect
 import time
-from typing import Iterable
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Generic, Iterable, Iterator, Optional, TypeVar
 
 def async_wrap_iter(it):
     """Wrap blocking iterator into an asynchronous one"""
@@ -36,6 +42,275 @@ def async_wrap_iter(it):
     threading.Thread(target=iter_to_queue).start()
     return yield_queue_items()
 
+
+T = TypeVar('T')
+
+
+class BatchedBridge(Generic[T]):
+    """Hands items from a producer thread to a coroutine on `loop`.
+
+    The producer appends to a deque, and only wakes the loop (with
+    call_soon_threadsafe) when the consumer is waiting for items. The
+    consumer takes everything buffered at once. So a fast producer moves
+    many items per wakeup, instead of a cross-thread round trip per item,
+    and a slow one still gets each item through right away.
+
+    The producer blocks while `buffer_size` items are buffered.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, buffer_size: int = 1024):
+        self._loop = loop
+        self._buffer_size = buffer_size
+        # deque appends and pops are atomic, so the producer only takes the
+        # lock to wake the consumer or wait for space
+        self._items: deque = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._producer_waiting = False
+        self._done = False
+        self._closed = False
+        self._exception: Optional[BaseException] = None
+        # set while the consumer waits for items
+        self._waiter: Optional[asyncio.Future] = None
+        self._wakeup_scheduled = False
+
+    # producer thread
+
+    def put(self, item: T) -> bool:
+        """False once the consumer has closed the bridge; stop producing then."""
+        if self._closed:
+            return False
+        self._items.append(item)
+        # The consumer sets _waiter and then checks for items, and we append
+        # and then check _waiter, so one of us sees the other.
+        if self._waiter is not None:
+            with self._lock:
+                self._wake_consumer()
+        if len(self._items) >= self._buffer_size:
+            with self._not_full:
+                self._producer_waiting = True
+                while len(self._items) >= self._buffer_size and not self._closed:
+                    self._not_full.wait()
+                self._producer_waiting = False
+        return not self._closed
+
+    def finish(self, exception: Optional[BaseException] = None) -> None:
+        """No more items. The consumer raises `exception` after the last."""
+        with self._lock:
+            self._done = True
+            self._exception = exception
+            self._wake_consumer()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def buffer_size(self) -> int:
+        return self._buffer_size
+
+    @property
+    def buffered(self) -> int:
+        return len(self._items)
+
+    def close(self, exception: Optional[BaseException] = None) -> None:
+        """Stops the producer, whose next put returns False, and drops what's
+        buffered. Unless the producer already finished, the consumer stops
+        too, raising `exception` if there is one."""
+        with self._lock:
+            self._closed = True
+            self._items.clear()
+            if not self._done:
+                self._done = True
+                self._exception = exception
+            self._not_full.notify_all()
+            self._wake_consumer()
+
+    def _wake_consumer(self) -> None:
+        # with the lock held
+        if self._waiter is not None and not self._wakeup_scheduled:
+            self._wakeup_scheduled = True
+            self._loop.call_soon_threadsafe(self._on_wakeup)
+
+    # event loop
+
+    def _on_wakeup(self) -> None:
+        with self._lock:
+            self._wakeup_scheduled = False
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def take(self) -> Optional[list[T]]:
+        """Everything buffered, waiting for at least one item. None at the end."""
+        items = self._items
+        while True:
+            if items:
+                popleft = items.popleft
+                taken = [popleft() for _ in range(len(items))]
+                if self._producer_waiting:
+                    with self._not_full:
+                        self._not_full.notify()
+                return taken
+            with self._lock:
+                if self._done and not items:
+                    if self._exception is not None:
+                        raise self._exception
+                    return None
+                waiter = self._waiter = self._loop.create_future()
+                if items or self._done:
+                    # put or finish didn't see the waiter
+                    self._waiter = None
+                    continue
+            await waiter
+
+    def __aiter__(self) -> 'BridgeIterator[T]':
+        return BridgeIterator(self)
+
+
+class BridgeIterator(Generic[T]):
+    """The consumer's async iterator over a BatchedBridge.
+
+    Not an async generator: one that's never started doesn't run its
+    finally block when closed or garbage collected, which would leave the
+    bridge open and its producer blocked on a full buffer for good. This
+    closes the bridge on aclose(), at the end, or when garbage collected.
+    """
+
+    def __init__(self, bridge: BatchedBridge[T]):
+        self._bridge = bridge
+        self._batch: Iterator[T] = iter(())
+        weakref.finalize(self, bridge.close)
+
+    def __aiter__(self) -> 'BridgeIterator[T]':
+        return self
+
+    async def __anext__(self) -> T:
+        for item in self._batch:
+            return item
+        try:
+            items = await self._bridge.take()
+        except BaseException:
+            self._bridge.close()
+            raise
+        if items is None:
+            self._bridge.close()
+            raise StopAsyncIteration
+        self._batch = iter(items)
+        return next(self._batch)
+
+    async def aclose(self) -> None:
+        self._bridge.close()
+
+
+@dataclass
+class BridgeStats:
+    # producers running on a worker thread, and waiting for one
+    active_producers: int
+    queued_producers: int
+    # iterators whose consumer hasn't finished or closed them
+    open_iterators: int
+    # items buffered for those consumers, and how many could be
+    buffered_items: int
+    buffer_capacity: int
+
+
+class BridgePool:
+    """Runs the producers of asyncify'd iterators on a shared, bounded pool
+    of worker threads, instead of a thread each.
+
+    Closing an iterator (aclose(), or garbage collecting it) makes its
+    producer's next put fail, so the producer stops and closes a
+    generator source, freeing its worker. A producer blocked inside the
+    source's next() only notices once that returns.
+
+    A producer holds its worker while its consumer doesn't read and the
+    buffer is full, so with more than `max_workers` of those, new producers
+    queue until a worker is free.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, buffer_size: int = 1024):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='asyncify')
+        self._buffer_size = buffer_size
+        self._bridges: weakref.WeakSet[BatchedBridge] = weakref.WeakSet()
+        # counts change in worker threads
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._closed = False
+
+    def asyncify(
+        self, it: Iterable[T], buffer_size: Optional[int] = None
+    ) -> AsyncIterator[T]:
+        if self._closed:
+            raise RuntimeError('BridgePool is closed')
+        bridge: BatchedBridge[T] = BatchedBridge(
+            asyncio.get_running_loop(), buffer_size or self._buffer_size
+        )
+        self._bridges.add(bridge)
+        with self._lock:
+            self._queued += 1
+        self._executor.submit(self._produce, it, bridge)
+        return bridge.__aiter__()
+
+    def _produce(self, it: Iterable[T], bridge: BatchedBridge[T]) -> None:
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            # unless it was closed while queued
+            if not bridge.closed:
+                for item in it:
+                    if not bridge.put(item):
+                        # run the generator's finally blocks here, not
+                        # whenever it's garbage collected
+                        if inspect.isgenerator(it):
+                            it.close()
+                        break
+                else:
+                    bridge.finish()
+        except Exception as e:
+            bridge.finish(e)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def stats(self) -> BridgeStats:
+        with self._lock:
+            active, queued = self._active, self._queued
+        bridges = [bridge for bridge in self._bridges if not bridge.closed]
+        return BridgeStats(
+            active_producers=active,
+            queued_producers=queued,
+            open_iterators=len(bridges),
+            buffered_items=sum(bridge.buffered for bridge in bridges),
+            buffer_capacity=sum(bridge.buffer_size for bridge in bridges),
+        )
+
+    async def aclose(self) -> None:
+        """Stops all producers, and waits for the worker threads to exit.
+        Consumers still iterating raise RuntimeError."""
+        self._closed = True
+        for bridge in list(self._bridges):
+            bridge.close(RuntimeError('BridgePool closed'))
+        await asyncio.to_thread(
+            self._executor.shutdown, wait=True, cancel_futures=True
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def default_pool() -> BridgePool:
+    """The pool asyncify_batched uses unless given one."""
+    return BridgePool()
+
+
+def asyncify_batched(
+    it: Iterable[T], buffer_size: int = 1024, pool: Optional[BridgePool] = None
+) -> AsyncIterator[T]:
+    """Like async_wrap_iter, but moves items in batches (see BatchedBridge),
+    producing on `pool`'s worker threads."""
+    return (pool or default_pool()).asyncify(it, buffer_size)
+
 def sleep_gen(n: int) -> Iterable[int]:
     for i in range(n):
         time.sleep(1)
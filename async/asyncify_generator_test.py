@@ -0,0 +1,55 @@
+import asyncio
+import gc
+import itertools
+
+from asyncify_generator import BridgePool
+
+
+async def wait_until_stopped(pool: BridgePool) -> None:
+    for _ in range(100):
+        if pool.stats().active_producers == 0:
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_bridge_pool__closing_an_unstarted_iterator_stops_its_producer():
+    async def main() -> None:
+        pool = BridgePool(max_workers=1, buffer_size=4)
+        it = pool.asyncify(itertools.count())
+        # the producer fills the buffer, and blocks
+        while pool.stats().buffered_items < 4:
+            await asyncio.sleep(0.01)
+        await it.aclose()
+        await wait_until_stopped(pool)
+        stats = pool.stats()
+        assert stats.active_producers == 0
+        assert stats.open_iterators == 0
+        await pool.aclose()
+
+    asyncio.run(main())
+
+
+def test_bridge_pool__dropping_an_unstarted_iterator_stops_its_producer():
+    async def main() -> None:
+        pool = BridgePool(max_workers=1, buffer_size=4)
+        it = pool.asyncify(itertools.count())
+        while pool.stats().buffered_items < 4:
+            await asyncio.sleep(0.01)
+        del it
+        gc.collect()
+        await wait_until_stopped(pool)
+        assert pool.stats().active_producers == 0
+        await pool.aclose()
+
+    asyncio.run(main())
+
+
+def test_bridge_pool__iterates_in_order():
+    async def main() -> list[int]:
+        pool = BridgePool(max_workers=1, buffer_size=4)
+        items = [i async for i in pool.asyncify(range(100))]
+        assert pool.stats().open_iterators == 0
+        await pool.aclose()
+        return items
+
+    assert asyncio.run(main()) == list(range(100))
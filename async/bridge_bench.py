@@ -0,0 +1,66 @@
+"""Compares items/sec through async_wrap_iter and asyncify_batched, and the
+reverse direction through syncify_async_iterable.
+
+    python async/bridge_bench.py --items 1000000
+
+async_wrap_iter does a cross-thread round trip per item, so it only gets
+--slow-items items.
+"""
+
+import argparse
+import asyncio
+import time
+from typing import AsyncIterator, Callable, Iterable
+
+from asyncify_generator import async_wrap_iter, asyncify_batched
+from syncify_async_generator import syncify_async_iterable
+
+
+async def time_bridge(
+    bridge: Callable[[Iterable[int]], AsyncIterator[int]], num_items: int
+) -> float:
+    """Items per second."""
+    start = time.perf_counter()
+    count = 0
+    async for _ in bridge(range(num_items)):
+        count += 1
+    assert count == num_items, count
+    return num_items / (time.perf_counter() - start)
+
+
+async def async_range(n: int) -> AsyncIterator[int]:
+    for i in range(n):
+        yield i
+
+
+def time_sync_bridge(num_items: int, buffer_size: int) -> float:
+    """Items per second, iterating an async generator synchronously."""
+    start = time.perf_counter()
+    count = 0
+    for _ in syncify_async_iterable(async_range(num_items), buffer_size):
+        count += 1
+    assert count == num_items, count
+    return num_items / (time.perf_counter() - start)
+
+
+async def main() -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument('--items', type=int, default=1_000_000)
+    p.add_argument('--slow-items', type=int, default=20_000)
+    p.add_argument('--buffer-size', type=int, default=1024)
+    args = p.parse_args()
+
+    rate = await time_bridge(async_wrap_iter, args.slow_items)
+    print(f'async_wrap_iter:  {rate:12,.0f} items/s')
+    for buffer_size in sorted({1, 64, args.buffer_size}):
+        rate = await time_bridge(
+            lambda it: asyncify_batched(it, buffer_size), args.items
+        )
+        print(f'asyncify_batched: {rate:12,.0f} items/s (buffer_size={buffer_size})')
+    # blocks this loop, but the items come from the shared loop thread
+    rate = time_sync_bridge(args.items, args.buffer_size)
+    print(f'syncify_async_iterable: {rate:12,.0f} items/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+"""Map a blocking function over inputs in parallel, getting results in order.
+
+    async for page in amap(fetch, urls, max_in_flight=16, retries=2):
+        ...
+    for text in imap_ordered(do_ocr, filenames, executor=ProcessPoolExecutor()):
+        ...
+
+Calls run on `executor` (the loop's default thread pool unless given one;
+use a ProcessPoolExecutor for CPU bound work). At most `max_in_flight`
+calls are submitted ahead of the next result to yield, so the reorder
+buffer of results that finished before an earlier, slower one stays
+bounded too. That's the "submit everything, then as_completed and sort"
+pattern in asofterworld/ocr.py, without holding every result.
+"""
+
+import asyncio
+import functools
+import itertools
+import random
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, TypeVar
+
+from syncify_async_generator import LoopThread, syncify_async_iterable
+
+A = TypeVar('A')
+R = TypeVar('R')
+
+
+async def call_with_retries(
+    fn: Callable[[A], R],
+    item: A,
+    executor: Optional[Executor] = None,
+    retries: int = 0,
+    retry_delay: float = 0.5,
+    timeout: Optional[float] = None,
+) -> R:
+    """fn(item) on `executor`, retrying after any exception (or taking longer
+    than `timeout` seconds), waiting `retry_delay` seconds, doubled after
+    each retry. Raises the last attempt's exception.
+
+    A timed out call can't be interrupted, so it keeps its worker until it
+    returns, even though the retry has been submitted.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor, fn, item), timeout
+            )
+        except Exception:
+            if attempt == retries:
+                raise
+        await asyncio.sleep(retry_delay * 2 ** attempt)
+    raise AssertionError('unreachable')
+
+
+async def amap(
+    fn: Callable[[A], R],
+    items: Iterable[A],
+    *,
+    executor: Optional[Executor] = None,
+    max_in_flight: int = 32,
+    retries: int = 0,
+    retry_delay: float = 0.5,
+    timeout: Optional[float] = None,
+    return_exceptions: bool = False,
+) -> AsyncIterator[R]:
+    """fn(item) for each of `items`, in order. See call_with_retries for
+    `retries`, `retry_delay` and `timeout`.
+
+    An item whose calls all failed raises its exception, cancelling the
+    calls after it, or with `return_exceptions`, is yielded as the
+    exception. `items` is iterated on the event loop, a few at a time, so
+    it shouldn't block.
+    """
+    call = functools.partial(
+        call_with_retries,
+        fn,
+        executor=executor,
+        retries=retries,
+        retry_delay=retry_delay,
+        timeout=timeout,
+    )
+    it = iter(items)
+    # in input order
+    pending: deque[asyncio.Task] = deque()
+    try:
+        while True:
+            for item in itertools.islice(it, max_in_flight - len(pending)):
+                pending.append(asyncio.ensure_future(call(item)))
+            if not pending:
+                return
+            # doesn't raise the task's exception
+            await asyncio.wait([pending[0]])
+            task = pending.popleft()
+            try:
+                result = task.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                result = e
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def imap_ordered(
+    fn: Callable[[A], R],
+    items: Iterable[A],
+    *,
+    loop_thread: Optional[LoopThread] = None,
+    max_in_flight: int = 32,
+    **kwargs,
+) -> Iterator[R]:
+    """amap for synchronous code, run on syncify_async_iterable's loop
+    thread. Takes the same keyword arguments."""
+    results = amap(fn, items, max_in_flight=max_in_flight, **kwargs)
+    # so no more than max_in_flight results wait for the caller there either
+    return syncify_async_iterable(results, max_in_flight, loop_thread)
+
+
+def flaky_square(x: int) -> int:
+    time.sleep(random.uniform(0, .2))
+    if random.random() < .1:
+        raise ConnectionError(f'flaked on {x}')
+    return x * x
+
+
+def main():
+    start = time.perf_counter()
+    results = imap_ordered(
+        flaky_square, range(40), max_in_flight=8, retries=3, retry_delay=.01
+    )
+    for x, square in enumerate(results):
+        assert square == x * x
+        print(f'{x}^2 = {square} at {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,71 +1,101 @@
 # https://stackoverflow.com/questions/62294385/synchronous-generator-in-asyncio
 
 import asyncio
-import queue
 import signal
-import threading
+from dataclasses import dataclass
 from typing import AsyncIterable, Iterable, Optional, TypeVar
 
-
-SIGWINCH_QUEUE = queue.Queue(1)
-
-
-def enqueue_signal(sig, _frame) -> None:
-    try:
-        print('adding signal to queue:', sig)
-        SIGWINCH_QUEUE.put_nowait(sig)
-    except asyncio.QueueFull:
-        print("queue full but thats ok")
-
-
-def install_winch_handler():
-    signal.signal(signal.SIGWINCH, enqueue_signal)
-
-def get_winch_stream_sync() -> Iterable[int]:
-    while True:
-        print('forever loop...')
-        yield SIGWINCH_QUEUE.get()
+from asyncify_generator import asyncify_batched
+
+
+@dataclass(frozen=True)
+class SignalEvent:
+    signal: signal.Signals
+    # how many arrived since the last event for this signal
+    count: int
+
+
+class SignalStream:
+    """Signals as an async stream of SignalEvents.
+
+    loop.add_signal_handler wakes the loop through its self-pipe (the
+    signal module's wakeup fd), and runs our handler as a normal callback,
+    so there's no thread and no cross-thread hop. Signals that arrive while
+    the consumer is busy are coalesced: one event per signal, with a
+    count, in the order each signal first arrived.
+
+    Replaces any handlers for `signals` until closed, and then restores the
+    previous ones. Closing ends iteration, once pending events are taken.
+    Unix only, like add_signal_handler.
+    """
+
+    def __init__(self, *signals: int):
+        self._loop = asyncio.get_running_loop()
+        self._signals = signals
+        # signal -> count, for signals that haven't been taken yet
+        self._pending: dict[int, int] = {}
+        # set while the consumer waits for a signal
+        self._waiter: Optional[asyncio.Future] = None
+        self._closed = False
+        # remove_signal_handler resets to SIG_DFL, not to what was there
+        self._previous_handlers = {sig: signal.getsignal(sig) for sig in signals}
+        for sig in signals:
+            self._loop.add_signal_handler(sig, self._on_signal, sig)
+
+    def _on_signal(self, sig: int) -> None:
+        self._pending[sig] = self._pending.get(sig, 0) + 1
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def __anext__(self) -> SignalEvent:
+        while not self._pending:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        sig = next(iter(self._pending))
+        return SignalEvent(signal.Signals(sig), self._pending.pop(sig))
+
+    def __aiter__(self) -> 'SignalStream':
+        return self
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for sig in self._signals:
+            self._loop.remove_signal_handler(sig)
+            previous = self._previous_handlers[sig]
+            # None for a handler that wasn't installed from Python
+            if previous is not None:
+                signal.signal(sig, previous)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __enter__(self) -> 'SignalStream':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
 T = TypeVar('T')
 
 def asyncify_iterable(it: Iterable[T]) -> AsyncIterable[T]:
-    """Wrap blocking iterator into an asynchronous one"""
-    loop = asyncio.get_event_loop()
-    q = asyncio.Queue(1)
-    exception = None
-    _END = object()
-
-    async def yield_items_async():
-        while True:
-            next_item = await q.get()
-            if next_item is _END:
-                break
-            yield next_item
-        if exception is not None:
-            # the iterator has raised, propagate the exception
-            raise exception
-
-    def iter_to_queue():
-        nonlocal exception
-        try:
-            for item in it:
-                # This runs outside the event loop thread, so we
-                # must use thread-safe API to talk to the queue.
-                asyncio.run_coroutine_threadsafe(q.put(item), loop).result()
-        except Exception as e:
-            exception = e
-        finally:
-            asyncio.run_coroutine_threadsafe(q.put(_END), loop).result()
-
-    threading.Thread(target=iter_to_queue).start()
-    return yield_items_async()
+    """Wrap blocking iterator into an asynchronous one, produced on the shared
+    BridgePool. aclose() stops the producer, once the iterator yields again."""
+    return asyncify_batched(it)
 
 
 async def main():
-    install_winch_handler()
-    async for i in asyncify_iterable(get_winch_stream_sync()):
-        print('got winch:', i)
+    with SignalStream(signal.SIGWINCH, signal.SIGUSR1) as signals:
+        async for event in signals:
+            print(f'got {event.signal.name} x{event.count}')
+            # a slow consumer, so bursts (like resizing) coalesce
+            await asyncio.sleep(1)
 
 
 
@@ -0,0 +1,200 @@
+"""Iterate async iterables from synchronous code.
+
+Calling asyncio.run per call (see multiple_async_runs.py) makes and tears
+down an event loop every time, and can't be done from inside a running
+loop. Instead, one event loop runs forever in a daemon thread, shared by
+every call, and each async iterable is driven there by a task that
+prefetches into a bounded buffer:
+
+    for row in syncify_async_iterable(fetch_rows(query)):
+        ...
+"""
+
+import asyncio
+import functools
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import Future
+from typing import AsyncIterable, Awaitable, Generic, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class LoopThread:
+    """An event loop running forever in a daemon thread."""
+
+    def __init__(self, name: str = 'syncify-loop'):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, awaitable: Awaitable[T]) -> T:
+        """Like asyncio.run, but on this thread's loop."""
+        self._check_not_on_loop()
+        return asyncio.run_coroutine_threadsafe(awaitable, self.loop).result()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def _check_not_on_loop(self) -> None:
+        # waiting for the loop on its own thread would never return
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("can't block on the loop from its own thread")
+
+
+@functools.lru_cache(maxsize=None)
+def shared_loop() -> LoopThread:
+    """The loop syncify_async_iterable uses unless given one."""
+    return LoopThread()
+
+
+class SyncBridge(Generic[T]):
+    """Hands items from a coroutine on `loop` to a consumer thread; the
+    reverse of asyncify_generator.BatchedBridge.
+
+    The producer task appends to a deque, and only takes the lock to wake
+    the consumer when it's waiting. The consumer takes everything buffered
+    at once. The producer waits (without blocking the loop) while
+    `buffer_size` items are buffered.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, buffer_size: int = 1024):
+        self._loop = loop
+        self._buffer_size = buffer_size
+        self._items: deque = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._consumer_waiting = False
+        self._done = False
+        self._exception: Optional[BaseException] = None
+        # set while the producer waits for space
+        self._space: Optional[asyncio.Future] = None
+        # the producer task
+        self._future: Optional[Future] = None
+
+    # event loop
+
+    async def pump(self, source: AsyncIterable[T]) -> None:
+        it = source.__aiter__()
+        try:
+            async for item in it:
+                await self._put(item)
+        except Exception as e:
+            self._finish(e)
+        else:
+            self._finish()
+        finally:
+            # when cancelled, close an async generator here, rather than
+            # whenever it's garbage collected
+            aclose = getattr(it, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+    async def _put(self, item: T) -> None:
+        items = self._items
+        items.append(item)
+        # The consumer sets _consumer_waiting and then checks for items,
+        # and we append and then check it, so one of us sees the other.
+        if self._consumer_waiting:
+            with self._not_empty:
+                self._not_empty.notify()
+        if len(items) >= self._buffer_size:
+            self._space = self._loop.create_future()
+            # likewise, the consumer takes items and then checks _space
+            if len(items) >= self._buffer_size:
+                await self._space
+            self._space = None
+
+    def _finish(self, exception: Optional[BaseException] = None) -> None:
+        with self._not_empty:
+            self._done = True
+            self._exception = exception
+            self._not_empty.notify()
+
+    def _on_space(self) -> None:
+        space = self._space
+        if space is not None and not space.done():
+            space.set_result(None)
+
+    # consumer thread
+
+    def start(self, source: AsyncIterable[T]) -> None:
+        self._future = asyncio.run_coroutine_threadsafe(self.pump(source), self._loop)
+
+    def take(self) -> Optional[list[T]]:
+        """Everything buffered, waiting for at least one item. None at the end."""
+        items = self._items
+        while True:
+            if items:
+                popleft = items.popleft
+                taken = [popleft() for _ in range(len(items))]
+                if self._space is not None:
+                    self._loop.call_soon_threadsafe(self._on_space)
+                return taken
+            with self._not_empty:
+                if self._done and not items:
+                    if self._exception is not None:
+                        raise self._exception
+                    return None
+                self._consumer_waiting = True
+                while not items and not self._done:
+                    self._not_empty.wait()
+                self._consumer_waiting = False
+
+    def close(self) -> None:
+        """Cancels the producer task, which closes the source."""
+        if self._future is not None:
+            self._future.cancel()
+
+    def __iter__(self) -> Iterator[T]:
+        try:
+            while (items := self.take()) is not None:
+                yield from items
+        finally:
+            self.close()
+
+
+def syncify_async_iterable(
+    source: AsyncIterable[T],
+    buffer_size: int = 1024,
+    loop_thread: Optional[LoopThread] = None,
+) -> Iterator[T]:
+    """Iterates `source` on `loop_thread` (by default shared_loop()), starting
+    right away, and returns a plain iterator over its items.
+
+    Breaking out of the loop stops the source once the iterator is closed
+    or garbage collected. Don't call this from `loop_thread` itself.
+    """
+    loop_thread = loop_thread or shared_loop()
+    loop_thread._check_not_on_loop()
+    bridge: SyncBridge[T] = SyncBridge(loop_thread.loop, buffer_size)
+    bridge.start(source)
+    items = iter(bridge)
+    # a generator that's never started doesn't run its finally block
+    weakref.finalize(items, bridge.close)
+    return items
+
+
+async def ticks(n: int) -> AsyncIterable[int]:
+    for i in range(n):
+        await asyncio.sleep(.1)
+        yield i
+
+
+def main():
+    start = time.perf_counter()
+    for run in range(3):
+        for i in syncify_async_iterable(ticks(3)):
+            print(f'run {run} got {i} at {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Benchmarks lock acquire/release latency against the fake GCS server.
+
+    python -m gcs_lock.bench --iterations 500 --latency-ms 20
+
+With --gsutil-path gs://BUCKET/OBJECT, also times the gsutil store against
+real GCS (slow: every operation starts a gsutil process).
+
+Then runs --deployers simulated deployers against each backend (in-memory,
+local files, and the fake server), each waiting for the same lock --rounds
+times, and reports how long they waited. With --processes, deployers are
+separate processes (except for the in-memory store, which can't be shared).
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import functools
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional
+
+from gcs_lock.fake_gcs_server import FakeGcsServer
+from gcs_lock.gcs_lock import (
+    DeployLockResult,
+    DeployState,
+    PollBudget,
+    _wait_for_deploy_lock,
+)
+from gcs_lock.lock_store import (
+    GcsJsonApiLockStore,
+    GsutilLockStore,
+    InMemoryLockStore,
+    LocalFileLockStore,
+    LockStore,
+)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile, `p` in [0, 100]."""
+    if not sorted_values:
+        return float("nan")
+    rank = round(p / 100 * (len(sorted_values) - 1))
+    return sorted_values[rank]
+
+
+def format_latencies(name: str, latencies: list[float], wall_time: float) -> str:
+    s = sorted(latencies)
+    ms = [1000 * percentile(s, p) for p in (50, 90, 99)]
+    return (
+        f"{name:>24}: n={len(s):<6} "
+        f"p50={ms[0]:8.2f}ms p90={ms[1]:8.2f}ms p99={ms[2]:8.2f}ms "
+        f"throughput={len(s) / wall_time:9.1f}/s"
+    )
+
+
+def time_acquire_release(
+    lock_store: LockStore, gcs_path: str, iterations: int
+) -> tuple[list[float], float]:
+    """Uncontended acquire+release cycles. Returns (cycle latencies, wall time)."""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        result = lock_store.acquire(gcs_path, f'{{"i": {i}}}')
+        assert result.acquired, result
+        lock_store.release(gcs_path)
+        latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - start
+
+
+def time_contended_acquire(
+    lock_store: LockStore, gcs_path: str, iterations: int, expect_held: bool
+) -> tuple[list[float], float]:
+    """Acquire attempts against a held lock. Returns (latencies, wall time)."""
+    assert lock_store.acquire(gcs_path, '{"holder": true}').acquired
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        result = lock_store.acquire(gcs_path, "{}", expect_held=expect_held)
+        assert not result.acquired and result.existing_state, result
+        latencies.append(time.perf_counter() - t0)
+    wall = time.perf_counter() - start
+    lock_store.release(gcs_path)
+    return latencies, wall
+
+
+def time_handoff(
+    lock_store: LockStore, gcs_path: str, iterations: int, hold: float = 0.05
+) -> tuple[list[float], float]:
+    """Time from a holder releasing the lock to a waiter getting it."""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        holder = DeployState("sha", 1, "", "holder").to_json()
+        assert lock_store.acquire(gcs_path, holder).acquired
+        released_at = 0.0
+
+        def release() -> None:
+            nonlocal released_at
+            released_at = time.perf_counter()
+            lock_store.release(gcs_path)
+
+        threading.Timer(hold, release).start()
+        waiter = DeployState("sha", 2, "", "waiter")
+        attempt = _wait_for_deploy_lock(
+            gcs_path, waiter, timedelta(minutes=1), lock_store, lease_ttl=None
+        )
+        assert attempt.result == DeployLockResult.got_lock, attempt
+        latencies.append(time.perf_counter() - released_at)
+        lock_store.release(gcs_path)
+    return latencies, time.perf_counter() - start
+
+
+##### contention
+
+# Deployers check the lock often, so the backend is the bottleneck rather
+# than sleeping.
+CONTENTION_POLL_BUDGET = PollBudget(
+    timedelta(milliseconds=1), timedelta(milliseconds=10)
+)
+
+
+@functools.lru_cache(maxsize=None)
+def make_store(backend: str, location: str = "") -> LockStore:
+    """`location` is the root directory for "file", the endpoint for "json".
+
+    Cached, so that deployer threads share one in-memory store.
+    """
+    if backend == "memory":
+        return InMemoryLockStore()
+    if backend == "file":
+        return LocalFileLockStore(location)
+    if backend == "json":
+        return GcsJsonApiLockStore(endpoint=location)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def run_deployer(
+    backend: str,
+    location: str,
+    gcs_path: str,
+    rounds: int,
+    hold: float,
+    queued: bool,
+) -> tuple[list[float], int]:
+    """One simulated deployer, waiting for the lock `rounds` times.
+
+    Each round is a new deploy, with a newer commit than deploys that started
+    before it. Returns (wait times for rounds that got the lock, number of
+    rounds that gave up because a newer deploy got the lock first).
+    """
+    store = make_store(backend, location)
+    latencies = []
+    gave_up = 0
+    for _ in range(rounds):
+        deploy_state = DeployState("sha", time.time_ns(), "", f"{os.getpid()}")
+        start = time.perf_counter()
+        attempt = _wait_for_deploy_lock(
+            gcs_path,
+            deploy_state,
+            timedelta(minutes=5),
+            store,
+            lease_ttl=None,
+            poll_budget=CONTENTION_POLL_BUDGET,
+            queued=queued,
+        )
+        if attempt.result != DeployLockResult.got_lock:
+            assert attempt.result == DeployLockResult.existing_deploy_is_newer
+            gave_up += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        time.sleep(hold)
+        assert attempt.generation is not None
+        assert store.release_generation(gcs_path, attempt.generation)
+    return latencies, gave_up
+
+
+def _silence_stdout() -> None:
+    # lock operations print a lot
+    sys.stdout = open(os.devnull, "w")
+
+
+def time_contention(
+    backend: str,
+    location: str,
+    deployers: int,
+    rounds: int,
+    hold: float,
+    processes: bool = False,
+    queued: bool = False,
+) -> tuple[list[float], int, float]:
+    """Runs `deployers` in parallel. Returns (wait times, give ups, wall time)."""
+    executor: Executor
+    if processes:
+        executor = ProcessPoolExecutor(deployers, initializer=_silence_stdout)
+    else:
+        executor = ThreadPoolExecutor(deployers)
+    gcs_path = f"gs://bench/contention-{time.time_ns()}.json"
+    start = time.perf_counter()
+    with executor, contextlib.redirect_stdout(io.StringIO()):
+        futures = [
+            executor.submit(
+                run_deployer, backend, location, gcs_path, rounds, hold, queued
+            )
+            for _ in range(deployers)
+        ]
+        results = [f.result() for f in futures]
+    wall = time.perf_counter() - start
+    latencies = [latency for deployer, _ in results for latency in deployer]
+    return latencies, sum(gave_up for _, gave_up in results), wall
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument("--iterations", type=int, default=200)
+    p.add_argument(
+        "--latency-ms", type=float, default=0, help="simulated fake server RTT"
+    )
+    p.add_argument("--gsutil-path", help="also benchmark gsutil on this gs:// path")
+    p.add_argument("--deployers", type=int, default=8)
+    p.add_argument("--rounds", type=int, default=10, help="lock waits per deployer")
+    p.add_argument("--hold-ms", type=float, default=1, help="time holding the lock")
+    p.add_argument("--processes", action="store_true", help="deployers as processes")
+    p.add_argument("--queued", action="store_true", help="wait in queued mode")
+    args = p.parse_args(argv)
+
+    with FakeGcsServer(latency=args.latency_ms / 1000) as server:
+        store = GcsJsonApiLockStore(endpoint=server.endpoint)
+        latencies, wall = time_acquire_release(
+            store, "gs://bench/lock.json", args.iterations
+        )
+        print(format_latencies("json api (fake server)", latencies, wall))
+        for expect_held in (False, True):
+            # lock stores print on every failed attempt
+            with contextlib.redirect_stdout(io.StringIO()):
+                latencies, wall = time_contended_acquire(
+                    store, "gs://bench/held.json", args.iterations, expect_held
+                )
+            name = f"contended {expect_held=}"
+            print(format_latencies(name, latencies, wall))
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, wall = time_handoff(
+                store, "gs://bench/handoff.json", min(args.iterations, 20)
+            )
+        print(format_latencies("release->acquire handoff", latencies, wall))
+
+        with tempfile.TemporaryDirectory() as root:
+            backends = [("memory", ""), ("file", root), ("json", server.endpoint)]
+            for backend, location in backends:
+                processes = args.processes and backend != "memory"
+                latencies, gave_up, wall = time_contention(
+                    backend,
+                    location,
+                    args.deployers,
+                    args.rounds,
+                    args.hold_ms / 1000,
+                    processes,
+                    args.queued,
+                )
+                name = f"contended wait ({backend})"
+                print(f"{format_latencies(name, latencies, wall)} {gave_up=}")
+
+    if args.gsutil_path:
+        latencies, wall = time_acquire_release(
+            GsutilLockStore(), args.gsutil_path, min(args.iterations, 10)
+        )
+        print(format_latencies("gsutil", latencies, wall))
+
+
+if __name__ == "__main__":
+    main()
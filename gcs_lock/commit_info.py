@@ -0,0 +1,272 @@
+"""Finds the git commit being deployed, for DeployState.latest_commit.
+
+In order of preference:
+- build metadata injected via environment variables:
+    DEPLOY_GIT_SHA=... DEPLOY_GIT_TIMESTAMP=... (commit epoch seconds)
+- or a JSON file, e.g. written by a Docker build step:
+    DEPLOY_COMMIT_INFO_FILE=/app/commit.json
+    {"git_sha": "...", "git_timestamp": 1600000000}
+- reading .git directly: HEAD, loose refs, packed-refs, and the commit
+  object, loose or in a pack file (as in a fresh clone).
+- `git log`, for what we can't read: commits stored as deltas in a pack,
+  objects in alternate object stores, or no .git at all.
+
+So slim containers without git work if the build injects the commit, and
+lock creation doesn't fork a process in the common cases. HEAD is read again
+on every call, so long-lived processes see new commits; only commit
+timestamps (which never change) are cached.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import mmap
+import os
+import struct
+import subprocess
+import zlib
+from typing import NamedTuple, Optional
+
+DEPLOY_GIT_SHA_ENV = "DEPLOY_GIT_SHA"
+DEPLOY_GIT_TIMESTAMP_ENV = "DEPLOY_GIT_TIMESTAMP"
+DEPLOY_COMMIT_INFO_FILE_ENV = "DEPLOY_COMMIT_INFO_FILE"
+
+
+class CommitInfo(NamedTuple):
+    sha: str
+    # committer time, epoch seconds
+    timestamp: int
+
+
+def commit_info(repo_dir: Optional[str] = None) -> CommitInfo:
+    """The commit to deploy: injected metadata, else HEAD of `repo_dir`.
+
+    `repo_dir` defaults to the current directory, and can be anywhere inside
+    the work tree.
+    """
+    sha = os.environ.get(DEPLOY_GIT_SHA_ENV)
+    timestamp = os.environ.get(DEPLOY_GIT_TIMESTAMP_ENV)
+    if sha and timestamp:
+        return CommitInfo(sha, int(timestamp))
+    info_file = os.environ.get(DEPLOY_COMMIT_INFO_FILE_ENV)
+    if info_file:
+        return _read_commit_info_file(info_file)
+    return _repo_commit_info(os.path.abspath(repo_dir or os.getcwd()))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_commit_info_file(path: str) -> CommitInfo:
+    with open(path) as f:
+        info = json.load(f)
+    return CommitInfo(info["git_sha"], int(info["git_timestamp"]))
+
+
+def _repo_commit_info(repo_dir: str) -> CommitInfo:
+    git_dir = find_git_dir(repo_dir)
+    if git_dir is not None:
+        common_dir = _common_dir(git_dir)
+        sha = resolve_ref(git_dir, common_dir, "HEAD")
+        if sha is not None:
+            return CommitInfo(sha, _commit_timestamp(repo_dir, common_dir, sha))
+    print(f"Can't read HEAD from .git in {repo_dir}, running git log...")
+    return _git_log_commit_info(repo_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def _commit_timestamp(repo_dir: str, common_dir: str, sha: str) -> int:
+    timestamp = read_commit_timestamp(common_dir, sha)
+    if timestamp is None:
+        print(f"Can't read commit {sha} from .git in {repo_dir}, running git log...")
+        timestamp = _git_log_commit_info(repo_dir, sha).timestamp
+    return timestamp
+
+
+def _git_log_commit_info(repo_dir: str, rev: str = "HEAD") -> CommitInfo:
+    # Get full hash, newline, and UNIX timestamp of commit.
+    # See format placeholders docs: https://git-scm.com/docs/git-log
+    git_result = subprocess.run(
+        ["git", "log", "-1", "--format=%H%n%ct", rev],
+        cwd=repo_dir,
+        text=True,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    git_lines = git_result.stdout.rstrip().split("\n")
+    assert len(git_lines) == 2, f"Expecting 2 lines, got: {git_lines}"
+    return CommitInfo(git_lines[0], int(git_lines[1]))
+
+
+##### reading .git
+
+
+def find_git_dir(start: str) -> Optional[str]:
+    """The .git directory for the work tree containing `start`, if any."""
+    path = start
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # worktrees and submodules: "gitdir: <path>"
+            with open(dot_git) as f:
+                content = f.read().strip()
+            if content.startswith("gitdir: "):
+                return os.path.join(path, content[len("gitdir: ") :])
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _common_dir(git_dir: str) -> str:
+    """Where shared refs and objects live. Differs from git_dir for worktrees."""
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            return os.path.join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        return git_dir
+
+
+def resolve_ref(git_dir: str, common_dir: str, ref: str) -> Optional[str]:
+    """Follows `ref` (e.g. "HEAD" or "refs/heads/main") to a commit sha."""
+    # symbolic refs can point at each other; git gives up after 5 levels
+    for _ in range(5):
+        content = _read_loose_ref(git_dir, ref) or _read_loose_ref(common_dir, ref)
+        if content is None:
+            return _read_packed_ref(common_dir, ref)
+        if not content.startswith("ref: "):
+            return content
+        ref = content[len("ref: ") :]
+    return None
+
+
+def _read_loose_ref(git_dir: str, ref: str) -> Optional[str]:
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _read_packed_ref(common_dir: str, ref: str) -> Optional[str]:
+    try:
+        with open(os.path.join(common_dir, "packed-refs")) as f:
+            for line in f:
+                # skip "# pack-refs with: ..." and "^<peeled tag sha>" lines
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, name = line.rstrip("\n").partition(" ")
+                if name == ref:
+                    return sha
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def read_commit_timestamp(common_dir: str, sha: str) -> Optional[int]:
+    """Committer timestamp of commit `sha`, or None if we can't find it, or
+    it's stored as a delta."""
+    commit = _read_loose_commit(common_dir, sha)
+    if commit is None:
+        commit = _read_packed_commit(common_dir, sha)
+    if commit is None:
+        return None
+    # headers end at the first blank line; then comes the message
+    for line in commit.split(b"\n\n", 1)[0].split(b"\n"):
+        # "committer Name <email> 1600000000 +0000"
+        if line.startswith(b"committer "):
+            return int(line.rsplit(b" ", 2)[1])
+    return None
+
+
+def _read_loose_commit(common_dir: str, sha: str) -> Optional[bytes]:
+    path = os.path.join(common_dir, "objects", sha[:2], sha[2:])
+    try:
+        with open(path, "rb") as f:
+            raw = zlib.decompress(f.read())
+    except FileNotFoundError:
+        return None
+    header, _, body = raw.partition(b"\0")
+    assert header.startswith(b"commit "), f"{sha} isn't a commit: {header!r}"
+    return body
+
+
+##### reading pack files
+# https://git-scm.com/docs/pack-format
+
+_PACK_INDEX_V2_HEADER = b"\377tOc\0\0\0\2"
+_OBJ_COMMIT = 1
+
+
+def _read_packed_commit(common_dir: str, sha: str) -> Optional[bytes]:
+    pack_dir = os.path.join(common_dir, "objects", "pack")
+    try:
+        names = os.listdir(pack_dir)
+    except FileNotFoundError:
+        return None
+    binsha = bytes.fromhex(sha)
+    for name in names:
+        if not name.endswith(".idx"):
+            continue
+        offset = _find_in_pack_index(os.path.join(pack_dir, name), binsha)
+        if offset is not None:
+            return _read_pack_entry(os.path.join(pack_dir, name[:-4] + ".pack"), offset)
+    return None
+
+
+def _find_in_pack_index(path: str, binsha: bytes) -> Optional[int]:
+    """Offset of object `binsha` in the pack that index `path` is for."""
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as idx:
+        if idx[:8] != _PACK_INDEX_V2_HEADER or len(binsha) != 20:
+            return None
+        # fanout[b] is how many object names start with a byte <= b
+        fanout = struct.unpack_from(">256I", idx, 8)
+        count = fanout[255]
+        lo = fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = fanout[binsha[0]]
+        names = 8 + 256 * 4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = idx[names + 20 * mid : names + 20 * (mid + 1)]
+            if name < binsha:
+                lo = mid + 1
+            elif name > binsha:
+                hi = mid
+            else:
+                # after the names and their CRC32s
+                offsets = names + 24 * count
+                (offset,) = struct.unpack_from(">I", idx, offsets + 4 * mid)
+                if offset & 0x80000000:
+                    # an index into the 8 byte offsets, for packs over 2GB
+                    large = offsets + 4 * count + 8 * (offset & 0x7FFFFFFF)
+                    (offset,) = struct.unpack_from(">Q", idx, large)
+                return offset
+    return None
+
+
+def _read_pack_entry(path: str, offset: int) -> Optional[bytes]:
+    """The commit at `offset` in pack `path`, or None if it's a delta."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        # type in bits 4-6 of the first byte; size in the rest, 7 bits a byte
+        byte = f.read(1)[0]
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = f.read(1)[0]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+        if obj_type != _OBJ_COMMIT:
+            return None
+        decompressor = zlib.decompressobj()
+        data = b""
+        while len(data) < size and not decompressor.eof:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            data += decompressor.decompress(chunk)
+        return data
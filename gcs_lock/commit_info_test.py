@@ -0,0 +1,121 @@
+import json
+import subprocess
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from gcs_lock import commit_info as ci
+from gcs_lock.commit_info import CommitInfo, commit_info
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    for var in (
+        ci.DEPLOY_GIT_SHA_ENV,
+        ci.DEPLOY_GIT_TIMESTAMP_ENV,
+        ci.DEPLOY_COMMIT_INFO_FILE_ENV,
+    ):
+        monkeypatch.delenv(var, raising=False)
+    yield
+    ci._commit_timestamp.cache_clear()
+    ci._read_commit_info_file.cache_clear()
+
+
+def _git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ['git', '-C', str(repo), *args],
+        text=True,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.strip()
+
+
+def _commit(repo: Path, i: int) -> None:
+    (repo / 'f').write_text(str(i))
+    _git(repo, 'add', 'f')
+    _git(
+        repo,
+        '-c',
+        'user.name=t',
+        '-c',
+        'user.email=t@example.com',
+        'commit',
+        '-q',
+        '-m',
+        f'commit {i}',
+        f'--date=@{1600000000 + i}',
+    )
+
+
+@pytest.fixture
+def repo(tmp_path: Path) -> Path:
+    _git(tmp_path, 'init', '-q')
+    for i in range(2):
+        _commit(tmp_path, i)
+    return tmp_path
+
+
+def _git_log_head(repo: Path) -> CommitInfo:
+    sha, timestamp = _git(repo, 'log', '-1', '--format=%H%n%ct').split('\n')
+    return CommitInfo(sha, int(timestamp))
+
+
+def _fail_subprocess(*args, **kwargs):
+    raise AssertionError('should not run git')
+
+
+def test_commit_info__reads_loose_objects_without_git(
+    repo: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    expected = _git_log_head(repo)
+    (repo / 'sub').mkdir()
+    monkeypatch.setattr(subprocess, 'run', _fail_subprocess)
+    assert commit_info(str(repo / 'sub')) == expected
+
+
+def test_commit_info__reads_packed_refs(
+    repo: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    _git(repo, 'pack-refs', '--all')
+    assert not list((repo / '.git' / 'refs' / 'heads').iterdir())
+    expected = _git_log_head(repo)
+    monkeypatch.setattr(subprocess, 'run', _fail_subprocess)
+    assert commit_info(str(repo)) == expected
+
+
+def test_commit_info__reads_packed_objects_without_git(
+    repo: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    _git(repo, 'gc', '-q')
+    assert not list((repo / '.git' / 'objects').glob('??'))
+    expected = _git_log_head(repo)
+    monkeypatch.setattr(subprocess, 'run', _fail_subprocess)
+    assert commit_info(str(repo)) == expected
+
+
+def test_commit_info__falls_back_to_git_for_unreadable_objects(
+    repo: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    _git(repo, 'gc', '-q')
+    # like a commit stored as a delta
+    monkeypatch.setattr(ci, '_read_pack_entry', lambda path, offset: None)
+    assert commit_info(str(repo)) == _git_log_head(repo)
+
+
+def test_commit_info__sees_new_commits(repo: Path) -> None:
+    assert commit_info(str(repo)) == _git_log_head(repo)
+    _commit(repo, 2)
+    assert commit_info(str(repo)) == _git_log_head(repo)
+
+
+def test_commit_info__prefers_injected_metadata(
+    repo: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    info_file = tmp_path / 'commit.json'
+    info_file.write_text(json.dumps({'git_sha': 'abc', 'git_timestamp': 5}))
+    monkeypatch.setenv(ci.DEPLOY_COMMIT_INFO_FILE_ENV, str(info_file))
+    assert commit_info(str(repo)) == CommitInfo('abc', 5)
+    monkeypatch.setenv(ci.DEPLOY_GIT_SHA_ENV, 'def')
+    monkeypatch.setenv(ci.DEPLOY_GIT_TIMESTAMP_ENV, '6')
+    assert commit_info(str(repo)) == CommitInfo('def', 6)
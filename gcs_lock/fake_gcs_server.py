@@ -0,0 +1,295 @@
+"""In-process stand-in for the bits of the GCS JSON API that gcs_lock uses.
+
+For offline tests and benchmarks:
+
+    with FakeGcsServer() as server:
+        store = GcsJsonApiLockStore(endpoint=server.endpoint)
+        ...
+
+Or run standalone and point STORAGE_EMULATOR_HOST at it:
+
+    python -m gcs_lock.fake_gcs_server --port 9023
+    STORAGE_EMULATOR_HOST=localhost:9023 python -m gcs_lock.gcs_lock -t 123
+
+Supported: media upload, media/metadata get, and delete, each with
+`ifGenerationMatch` preconditions, plus prefix listing and metadata patches.
+Objects only live in memory.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple, Optional
+
+
+class _FakeObject(NamedTuple):
+    data: bytes
+    generation: int
+    metageneration: int
+    metadata: dict[str, str] = {}
+
+
+class _FakeBuckets:
+    """Object state shared by all request handler threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects: dict[tuple[str, str], _FakeObject] = {}
+        self._last_generation = 0
+
+    def _next_generation(self) -> int:
+        # Real GCS generations are microsecond timestamps.
+        self._last_generation = max(
+            self._last_generation + 1, time.time_ns() // 1000
+        )
+        return self._last_generation
+
+    def get(self, bucket: str, name: str) -> Optional[_FakeObject]:
+        with self._lock:
+            return self._objects.get((bucket, name))
+
+    def put(
+        self, bucket: str, name: str, data: bytes, if_generation: Optional[int]
+    ) -> Optional[_FakeObject]:
+        """Returns None if the precondition failed."""
+        with self._lock:
+            existing = self._objects.get((bucket, name))
+            current_generation = existing.generation if existing else 0
+            if if_generation is not None and if_generation != current_generation:
+                return None
+            obj = _FakeObject(data, self._next_generation(), 1)
+            self._objects[(bucket, name)] = obj
+            return obj
+
+    def list(self, bucket: str, prefix: str) -> list[tuple[str, _FakeObject]]:
+        with self._lock:
+            return sorted(
+                (name, obj)
+                for (b, name), obj in self._objects.items()
+                if b == bucket and name.startswith(prefix)
+            )
+
+    def patch_metadata(
+        self, bucket: str, name: str, metadata: dict[str, str]
+    ) -> Optional[_FakeObject]:
+        with self._lock:
+            existing = self._objects.get((bucket, name))
+            if existing is None:
+                return None
+            obj = existing._replace(
+                metageneration=existing.metageneration + 1,
+                metadata={**existing.metadata, **metadata},
+            )
+            self._objects[(bucket, name)] = obj
+            return obj
+
+    def delete(self, bucket: str, name: str, if_generation: Optional[int]) -> int:
+        """Returns an HTTP status code."""
+        with self._lock:
+            existing = self._objects.get((bucket, name))
+            if existing is None:
+                return 404
+            if if_generation is not None and if_generation != existing.generation:
+                return 412
+            del self._objects[(bucket, name)]
+            return 204
+
+
+def _object_resource(bucket: str, name: str, obj: _FakeObject) -> dict:
+    # GCS returns int64 fields as strings
+    resource = {
+        "kind": "storage#object",
+        "bucket": bucket,
+        "name": name,
+        "generation": str(obj.generation),
+        "metageneration": str(obj.metageneration),
+        "size": str(len(obj.data)),
+    }
+    if obj.metadata:
+        resource["metadata"] = obj.metadata
+    return resource
+
+
+class _FakeGcsHandler(BaseHTTPRequestHandler):
+    # keep-alive, so clients can reuse connections like they would with GCS
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; don't wait on delayed ACKs
+    disable_nagle_algorithm = True
+    server: _FakeGcsHttpServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(
+        self, status: int, body: bytes = b"", headers: Optional[dict] = None
+    ) -> None:
+        self.server.request_count += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, resource: dict) -> None:
+        body = json.dumps(resource).encode()
+        self._send(status, body, {"Content-Type": "application/json"})
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send_json(status, {"error": {"code": status, "message": message}})
+
+    def _parse(self) -> tuple[list[str], dict[str, str]]:
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return parts, query
+
+    @staticmethod
+    def _if_generation(query: dict[str, str]) -> Optional[int]:
+        value = query.get("ifGenerationMatch")
+        return int(value) if value is not None else None
+
+    def do_POST(self):
+        parts, query = self._parse()
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        # /upload/storage/v1/b/BUCKET/o?uploadType=media&name=NAME
+        if parts[:3] != ["upload", "storage", "v1"] or len(parts) != 6:
+            return self._send_error(404, f"unsupported path {self.path}")
+        bucket, name = parts[4], query["name"]
+        obj = self.server.buckets.put(bucket, name, data, self._if_generation(query))
+        if self.server.dropped_responses > 0:
+            # the upload happened, but the client never hears back
+            self.server.dropped_responses -= 1
+            self.close_connection = True
+            return
+        if obj is None:
+            return self._send_error(412, "conditionNotMet")
+        self._send_json(200, _object_resource(bucket, name, obj))
+
+    def do_GET(self):
+        parts, query = self._parse()
+        # /storage/v1/b/BUCKET/o?prefix=PREFIX
+        if parts[:2] == ["storage", "v1"] and len(parts) == 5:
+            bucket = parts[3]
+            listed = self.server.buckets.list(bucket, query.get("prefix", ""))
+            items = [_object_resource(bucket, name, obj) for name, obj in listed]
+            return self._send_json(200, {"kind": "storage#objects", "items": items})
+        # /storage/v1/b/BUCKET/o/NAME
+        if parts[:2] != ["storage", "v1"] or len(parts) != 6:
+            return self._send_error(404, f"unsupported path {self.path}")
+        bucket, name = parts[3], parts[5]
+        obj = self.server.buckets.get(bucket, name)
+        if obj is None:
+            return self._send_error(404, "No such object")
+        if_generation = self._if_generation(query)
+        if if_generation is not None and if_generation != obj.generation:
+            return self._send_error(412, "conditionNotMet")
+        if query.get("alt") == "media":
+            headers = {
+                "x-goog-generation": str(obj.generation),
+                "x-goog-metageneration": str(obj.metageneration),
+            }
+            return self._send(200, obj.data, headers)
+        self._send_json(200, _object_resource(bucket, name, obj))
+
+    def do_PATCH(self):
+        parts, _ = self._parse()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if parts[:2] != ["storage", "v1"] or len(parts) != 6:
+            return self._send_error(404, f"unsupported path {self.path}")
+        bucket, name = parts[3], parts[5]
+        metadata = json.loads(body).get("metadata", {})
+        obj = self.server.buckets.patch_metadata(bucket, name, metadata)
+        if obj is None:
+            return self._send_error(404, "No such object")
+        self._send_json(200, _object_resource(bucket, name, obj))
+
+    def do_DELETE(self):
+        parts, query = self._parse()
+        if parts[:2] != ["storage", "v1"] or len(parts) != 6:
+            return self._send_error(404, f"unsupported path {self.path}")
+        bucket, name = parts[3], parts[5]
+        status = self.server.buckets.delete(bucket, name, self._if_generation(query))
+        if status == 204:
+            return self._send(204)
+        message = "No such object" if status == 404 else "conditionNotMet"
+        self._send_error(status, message)
+
+
+class _FakeGcsHttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+    buckets: _FakeBuckets
+    latency: float
+    request_count: int = 0
+    dropped_responses: int = 0
+
+
+class FakeGcsServer:
+    """Runs the stand-in server on a background thread.
+
+    `latency` (seconds) is added to every response, to simulate the round trip
+    time to real GCS in benchmarks.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0):
+        self._server = _FakeGcsHttpServer((host, port), _FakeGcsHandler)
+        self._server.buckets = _FakeBuckets()
+        self._server.latency = latency
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def request_count(self) -> int:
+        """Number of requests served so far, i.e. round trips."""
+        return self._server.request_count
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def drop_upload_responses(self, count: int = 1) -> None:
+        """Closes the connection instead of responding to the next `count`
+        uploads, after doing them, like a connection that breaks in flight."""
+        self._server.dropped_responses = count
+
+    def start(self) -> FakeGcsServer:
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            # shutdown() waits up to this long; keep tests fast
+            kwargs={"poll_interval": 0.05},
+            name="FakeGcsServer",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> FakeGcsServer:
+        return self.start()
+
+    def __exit__(self, _type, _value, _traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=9023)
+    p.add_argument("--latency-ms", type=float, default=0)
+    args = p.parse_args()
+
+    server = FakeGcsServer(port=args.port, latency=args.latency_ms / 1000)
+    print(f"serving fake GCS at {server.endpoint}")
+    server._server.serve_forever()
@@ -6,7 +6,13 @@ However, the `gsutil cp` and `gsutil cat` steps have a race condition, so this
 isn't really bulletproof - this locking mechanism ultimately can only guarantee
 mutual exclusion, and not ordering.
 
-Requires the `gsutil` command (raises FileNotFoundError otherwise).
+The object storage operations are done by a LockStore (see lock_store.py). By
+default that's the GCS JSON API, falling back to the `gsutil` command when
+there are no credentials for the API.
+
+Lock operations emit timing events; see lock_metrics.py.
+
+Run as a module from the repo root, e.g. `python -m gcs_lock.gcs_lock -t 123`.
 
 Inspiration:
 - https://github.com/thinkingmachines/gcs-mutex-lock
@@ -15,66 +21,77 @@ Inspiration:
 
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime, timedelta
 from enum import Enum, auto
 import os
-import subprocess
+import random
 import json
-from typing import NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, NamedTuple, Optional
 import socket
+import threading
+import time
+import uuid
+
+from gcs_lock.commit_info import commit_info
+from gcs_lock.lock_metrics import LockEventKind, Span
+from gcs_lock.lock_store import LockResult, LockStore, default_lock_store
 
 # for retries
 import tenacity
 from tenacity.retry import retry_if_result
 from tenacity.stop import stop_after_delay
-from tenacity.wait import wait_random_exponential
+from tenacity.wait import wait_none
 
 
 ##### low-level operations
 
 
-class LockResult(NamedTuple):
-    # Whether the lock was acquired successfully.
-    acquired: bool
-    # If we failed to acquire the lock, contains existing lock state.
-    # Note: if acquired==False and existing_state==None, then the lock
-    # state disappeared in between when we first tried to acquire the lock
-    # and when we tried to get the lock state.
-    existing_state: Optional[str]
+def acquire_lock(
+    gcs_path: str,
+    data: str,
+    lock_store: Optional[LockStore] = None,
+    expect_held: bool = False,
+) -> LockResult:
+    """Attempts to acquire lock file `gcs_path`, populated with `data`.
 
-
-def acquire_lock(gcs_path: str, data: str) -> LockResult:
-    """Attempts to acquire lock file `gcs_path`, populated with `data`."""
+    If the lock is held, the result has the holder's data and generation from
+    a single read. `expect_held` reads before trying to create (see LockStore).
+    """
+    lock_store = lock_store or default_lock_store()
     print(f"Attempting to lock {gcs_path}...")
-    lock_result = subprocess.run(
-        ["gsutil", "-h", "x-goog-if-generation-match:0", "cp", "-", gcs_path],
-        text=True,
-        input=data,
-    )
-    if lock_result.returncode == 0:
+    span = Span()
+    lock_result = lock_store.acquire(gcs_path, data, expect_held=expect_held)
+    if lock_result.acquired:
         print("Lock acquired!")
-        return LockResult(True, None)
+        outcome = "acquired"
+    else:
+        outcome = "vanished" if lock_result.existing_state is None else "held"
+    span.emit(LockEventKind.acquire, gcs_path, outcome)
+    return lock_result
 
-    print("Lock acquisition failed. Attempting to get current lock data...")
-    cat_result = subprocess.run(
-        ["gsutil", "cat", gcs_path], text=True, stdout=subprocess.PIPE
-    )
-    if cat_result.returncode == 0:
-        print("Got existing lock state.")
-        return LockResult(False, cat_result.stdout)
-
-    # Lock failed, and there wasn't existing deploy info. This should only
-    # happen in rare race conditions.
-    print(
-        "Failed to get current lock data - disappeared between `gsutil cp` and `gsutil cat`?"
-    )
-    return LockResult(False, None)
 
+def release_lock(
+    gcs_path: str,
+    lock_store: Optional[LockStore] = None,
+    generation: Optional[int] = None,
+):
+    """Release the lock. Raises exception if the lockfile isn't present.
 
-def release_lock(gcs_path: str):
-    """Release the lock. Raises exception if the lockfile isn't present."""
+    With `generation`, only releases the lock if it's still that generation
+    (i.e. nobody broke our lease and took the lock over in the meantime).
+    """
+    lock_store = lock_store or default_lock_store()
     print(f"Releasing lock {gcs_path}...")
-    subprocess.run(["gsutil", "rm", gcs_path], check=True)
+    span = Span()
+    if generation is None:
+        lock_store.release(gcs_path)
+    elif not lock_store.release_generation(gcs_path, generation):
+        print("Lock was already released or taken over; leaving it alone.")
+        span.emit(LockEventKind.release, gcs_path, "taken_over")
+        return
+    span.emit(LockEventKind.release, gcs_path, "released")
     print("Lock released.")
 
 
@@ -84,6 +101,29 @@ def release_lock(gcs_path: str):
 # gsutil mb gs://BUCKET_NAME && gsutil versioning set on gs://BUCKET_NAME
 GCS_DEPLOY_LOCK_BASE = "gs://your-gcs-deploy-lock-bucket-name-here"
 
+# Holders renew their lease every lease_ttl / 3. Waiters treat a lease as
+# expired LEASE_EXPIRY_GRACE after its expiry time, to allow for clock skew
+# between hosts. Leases are opt-in (lease_ttl=DEFAULT_LEASE_TTL): deployers
+# older than the tolerant DeployState.from_json can't read leased locks.
+DEFAULT_LEASE_TTL = timedelta(minutes=2)
+LEASE_EXPIRY_GRACE = timedelta(seconds=10)
+
+
+class PollBudget(NamedTuple):
+    """How often waiters check whether a held lock has changed.
+
+    Checks are metadata-only reads. The interval starts at `min_interval` and
+    backs off by `backoff` up to `max_interval`, with jitter so that waiters
+    don't all hit the bucket at the same moment.
+    """
+
+    min_interval: timedelta = timedelta(milliseconds=250)
+    max_interval: timedelta = timedelta(seconds=2)
+    backoff: float = 1.5
+
+
+DEFAULT_POLL_BUDGET = PollBudget()
+
 
 class DeployState(NamedTuple):
     """Data stored in GCS lockfile"""
@@ -94,37 +134,53 @@ class DeployState(NamedTuple):
     # metadata fields for debugging
     deploy_datetime: str
     deploy_hostname: str
+    # epoch seconds. None for locks without a lease (which never expire).
+    lease_expires: Optional[float] = None
 
     @staticmethod
     def latest_commit() -> DeployState:
-        # Get short hash, newline, and UNIX timestamp of commit.
-        # See format placeholders docs: https://git-scm.com/docs/git-log
-        git_result = subprocess.run(
-            ["git", "log", "-1", "--format=%h%n%ct"],
-            text=True,
-            stdout=subprocess.PIPE,
-            check=True,
-        )
-        git_lines = git_result.stdout.rstrip().split("\n")
-        assert len(git_lines) == 2, f"Expecting 2 lines, got: {git_lines}"
+        # see commit_info.py for where this comes from
+        commit = commit_info()
         now = datetime.now()
         return DeployState(
-            git_sha=git_lines[0],
-            git_timestamp=int(git_lines[1]),
+            # short hash, like `git log --format=%h`
+            git_sha=commit.sha[:7],
+            git_timestamp=commit.timestamp,
             deploy_datetime=f"{now.timestamp()} {now.isoformat()}",
             deploy_hostname=socket.gethostname(),
         )
 
     @staticmethod
     def from_json(data: str) -> DeployState:
-        return DeployState(**json.loads(data))
+        # Ignore fields we don't know, so that locks written by newer
+        # deployers can be read during a rollout. Deployers from before
+        # lease_expires existed parse with DeployState(**fields), so they
+        # can read locks without a lease (see to_json) but not leased ones:
+        # upgrade all of them before any deployer uses leases.
+        fields = json.loads(data)
+        return DeployState(
+            **{k: v for k, v in fields.items() if k in DeployState._fields}
+        )
 
     def to_json(self) -> str:
-        return json.dumps(self._asdict(), indent=2)
+        fields = self._asdict()
+        if fields["lease_expires"] is None:
+            # as older deployers wrote it, so they can read it
+            del fields["lease_expires"]
+        return json.dumps(fields, indent=2)
 
     def has_newer_commit(self, other: DeployState) -> bool:
         return self.git_timestamp > other.git_timestamp
 
+    def with_lease(self, ttl: timedelta) -> DeployState:
+        return self._replace(lease_expires=time.time() + ttl.total_seconds())
+
+    def lease_expired(self, now: Optional[float] = None) -> bool:
+        if self.lease_expires is None:
+            return False
+        now = time.time() if now is None else now
+        return now > self.lease_expires + LEASE_EXPIRY_GRACE.total_seconds()
+
 
 class DeployLockResult(Enum):
     """Outcomes of trying to acquire the deploy lock."""
@@ -133,6 +189,7 @@ class DeployLockResult(Enum):
     this_deploy_is_newer = auto()
     existing_deploy_is_newer = auto()
     failed_to_get_lock_and_lock_state = auto()
+    existing_lease_expired = auto()
     timed_out = auto()
 
 
@@ -144,6 +201,11 @@ def _lockresult_to_deploylockresult(
         return DeployLockResult.got_lock
     if lock_result.existing_state:
         existing_deploy = DeployState.from_json(lock_result.existing_state)
+        if existing_deploy.lease_expired():
+            # The holder stopped renewing: it crashed, so it doesn't matter
+            # whether its commit was newer.
+            print(f"Existing deploy's lease has expired: {existing_deploy}")
+            return DeployLockResult.existing_lease_expired
         if this_deploy.has_newer_commit(existing_deploy):
             return DeployLockResult.this_deploy_is_newer
         else:
@@ -156,44 +218,420 @@ def _lockresult_to_deploylockresult(
     return DeployLockResult.failed_to_get_lock_and_lock_state
 
 
+class _DeployLockAttempt(NamedTuple):
+    result: DeployLockResult
+    # Generation of the lock object: ours if result is got_lock.
+    generation: Optional[int] = None
+    # If someone else holds the lock, when their lease expires.
+    holder_lease_expires: Optional[float] = None
+
+
+def _break_expired_lease(
+    gcs_path: str, generation: int, lock_store: Optional[LockStore] = None
+) -> bool:
+    """Deletes an expired lock, unless it changed since we read it.
+
+    The generation precondition makes this safe when several waiters try to
+    break the same lease at once, or when the holder renewed it after all.
+    """
+    lock_store = lock_store or default_lock_store()
+    print(f"Breaking expired lease on {gcs_path} (generation {generation})...")
+    broke_it = lock_store.release_generation(gcs_path, generation)
+    print("Broke lease." if broke_it else "Lock changed, leaving it alone.")
+    return broke_it
+
+
 # split apart so it's easier to test without mocking acquire_lock
 def _acquire_deploy_lock_once(
-    gcs_path: str, deploy_state: DeployState
-) -> DeployLockResult:
-    lock_result = acquire_lock(gcs_path, deploy_state.to_json())
-    return _lockresult_to_deploylockresult(lock_result, deploy_state)
+    gcs_path: str,
+    deploy_state: DeployState,
+    lock_store: Optional[LockStore] = None,
+    expect_held: bool = False,
+    lease_ttl: Optional[timedelta] = None,
+) -> _DeployLockAttempt:
+    if lease_ttl is not None:
+        # lease starts now, not when we started waiting
+        deploy_state = deploy_state.with_lease(lease_ttl)
+    lock_result = acquire_lock(
+        gcs_path, deploy_state.to_json(), lock_store, expect_held=expect_held
+    )
+    result = _lockresult_to_deploylockresult(lock_result, deploy_state)
+    if (
+        result == DeployLockResult.existing_lease_expired
+        and lock_result.generation is not None
+        and _break_expired_lease(gcs_path, lock_result.generation, lock_store)
+    ):
+        # Retry right away instead of waiting for the next backoff.
+        return _acquire_deploy_lock_once(
+            gcs_path, deploy_state, lock_store, lease_ttl=lease_ttl
+        )
+    holder_lease_expires = None
+    if lock_result.existing_state:
+        holder = DeployState.from_json(lock_result.existing_state)
+        holder_lease_expires = holder.lease_expires
+    return _DeployLockAttempt(result, lock_result.generation, holder_lease_expires)
+
+
+def _should_retry(attempt: _DeployLockAttempt) -> bool:
+    # Lock stores already retry when the lock disappears between their
+    # create and read, so failed_to_get_lock_and_lock_state means the lock
+    # is churning a lot. Keep trying in that case too. Likewise for
+    # existing_lease_expired: someone else broke the lease before we could.
+    should_retry = attempt.result in (
+        DeployLockResult.this_deploy_is_newer,
+        DeployLockResult.failed_to_get_lock_and_lock_state,
+        DeployLockResult.existing_lease_expired,
+    )
+    print(f"should retry? condition: {attempt.result}, {should_retry=}")
+    return should_retry
+
+
+def _poll_intervals(poll_budget: PollBudget) -> Iterator[float]:
+    """Seconds to sleep between checks, forever."""
+    interval = poll_budget.min_interval.total_seconds()
+    max_interval = poll_budget.max_interval.total_seconds()
+    while True:
+        yield interval * random.uniform(0.75, 1)
+        interval = min(interval * poll_budget.backoff, max_interval)
+
+
+def _wake_at(deadline: float, expires: Optional[float]) -> float:
+    """The earlier of `deadline` and when something that `expires` is breakable.
+
+    `deadline` and the result are time.monotonic() values, `expires` is epoch
+    seconds (or None for never).
+    """
+    if expires is None:
+        return deadline
+    breakable_in = expires + LEASE_EXPIRY_GRACE.total_seconds() - time.time()
+    return min(deadline, time.monotonic() + breakable_in)
+
+
+def _watch_lock(
+    gcs_path: str,
+    generation: int,
+    wake_at: float,
+    lock_store: LockStore,
+    poll_budget: PollBudget,
+) -> bool:
+    """Blocks until the lock at `generation` looks like it changed.
+
+    GCS has no change notifications, so this polls cheap metadata reads. It
+    returns when the lock object is gone or has a new generation (released,
+    taken over, or lease renewed), or at `wake_at` (see _wake_at).
+
+    Returns False if the lock is gone, True if it (probably) still exists.
+    """
+    for interval in _poll_intervals(poll_budget):
+        remaining = wake_at - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(interval, remaining))
+        meta = lock_store.stat(gcs_path)
+        if meta is None:
+            return False
+        if meta.generation != generation:
+            return True
+    assert False, "unreachable"
 
 
 def _wait_for_deploy_lock(
-    gcs_path: str, deploy_state: DeployState, timeout: timedelta
-) -> DeployLockResult:
-    """Tries to continually acquire the lock until the timeout."""
-
-    def should_retry(result: DeployLockResult) -> bool:
-        # We retry in the failed_to_get_lock_and_lock_state case. That's
-        # assuming that the previous deploy finished and released the lock in
-        # between when we first tried to check it.
-        should_retry = result in (
-            DeployLockResult.this_deploy_is_newer,
-            DeployLockResult.failed_to_get_lock_and_lock_state,
+    gcs_path: str,
+    deploy_state: DeployState,
+    timeout: timedelta,
+    lock_store: Optional[LockStore] = None,
+    lease_ttl: Optional[timedelta] = None,
+    poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+    queued: bool = False,
+) -> _DeployLockAttempt:
+    """Tries to continually acquire the lock until the timeout.
+
+    Between attempts, watches the lock (see _watch_lock) so that we retry
+    soon after it's released rather than after a fixed backoff.
+
+    With `queued`, waiters get the lock in arrival order; see
+    _wait_for_deploy_lock_queued.
+    """
+    if queued:
+        return _wait_for_deploy_lock_queued(
+            gcs_path, deploy_state, timeout, lock_store, lease_ttl, poll_budget
         )
-        print(f"should retry? condition: {result}, {should_retry=}")
-        return should_retry
+    lock_store = lock_store or default_lock_store()
+    deadline = time.monotonic() + timeout.total_seconds()
+    last_attempt: Optional[_DeployLockAttempt] = None
+    num_attempts = 0
 
-    # deploys take a while, so we don't retry that aggressively
+    # _watch_lock does the waiting between attempts
     @tenacity.retry(
-        retry=retry_if_result(should_retry),
-        wait=wait_random_exponential(min=5, max=15),
+        retry=retry_if_result(_should_retry),
+        wait=wait_none(),
         stop=stop_after_delay(timeout.total_seconds()),
     )
-    def _wait_for_deploy_lock() -> DeployLockResult:
-        return _acquire_deploy_lock_once(gcs_path, deploy_state)
+    def _wait_for_deploy_lock() -> _DeployLockAttempt:
+        nonlocal last_attempt, num_attempts
+        num_attempts += 1
+        expect_held = False
+        if last_attempt is not None:
+            if last_attempt.generation is None:
+                # Nothing to watch. Just wait a bit.
+                time.sleep(poll_budget.min_interval.total_seconds())
+            else:
+                # If the lock is still there, read first: one round trip
+                # instead of create+read.
+                expect_held = _watch_lock(
+                    gcs_path,
+                    last_attempt.generation,
+                    _wake_at(deadline, last_attempt.holder_lease_expires),
+                    lock_store,
+                    poll_budget,
+                )
+        last_attempt = _acquire_deploy_lock_once(
+            gcs_path,
+            deploy_state,
+            lock_store,
+            expect_held=expect_held,
+            lease_ttl=lease_ttl,
+        )
+        return last_attempt
 
+    wait_span = Span()
     try:
-        return _wait_for_deploy_lock()
+        attempt = _wait_for_deploy_lock()
     except tenacity.RetryError as e:
         print(f"Timed out after {timeout} waiting for deploy lock ({e}).")
-        return DeployLockResult.timed_out
+        attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+    wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, num_attempts)
+    return attempt
+
+
+class LeaseHeartbeat:
+    """Renews the lease on a held lock from a background thread.
+
+    Each renewal rewrites the lock with a new expiry, conditional on the lock
+    still being at the generation we last wrote. If that fails, someone broke
+    our lease (we must have stalled for longer than the TTL), and we stop.
+    """
+
+    def __init__(
+        self,
+        gcs_path: str,
+        deploy_state: DeployState,
+        generation: int,
+        lease_ttl: timedelta,
+        lock_store: Optional[LockStore] = None,
+    ):
+        self.gcs_path = gcs_path
+        self.deploy_state = deploy_state
+        # Only touched by the heartbeat thread until stop() joins it.
+        self.generation: Optional[int] = generation
+        self.lease_ttl = lease_ttl
+        self.lock_store = lock_store or default_lock_store()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"LeaseHeartbeat({gcs_path})", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Optional[int]:
+        """Stops renewing. Returns the lock's generation, or None if we lost it."""
+        self._stopped.set()
+        self._thread.join()
+        return self.generation
+
+    def _run(self) -> None:
+        interval = self.lease_ttl.total_seconds() / 3
+        while not self._stopped.wait(interval):
+            assert self.generation is not None
+            data = self.deploy_state.with_lease(self.lease_ttl).to_json()
+            try:
+                new_generation = self.lock_store.replace(
+                    self.gcs_path, data, self.generation
+                )
+            except Exception as e:
+                # Transient errors are OK as long as a later renewal succeeds
+                # before the lease expires.
+                print(f"Failed to renew lease on {self.gcs_path}: {e!r}")
+                continue
+            if new_generation is None:
+                print(f"Lost lease on {self.gcs_path}: lock was taken over!")
+                self.generation = None
+                return
+            self.generation = new_generation
+
+
+##### fair queueing
+
+# Waiters renew their queue ticket once less than 2/3 of this is left. Dead
+# waiters hold up the queue for at most this (plus LEASE_EXPIRY_GRACE).
+DEFAULT_TICKET_TTL = timedelta(minutes=1)
+
+
+class _QueueTicket(NamedTuple):
+    gcs_path: str
+    # tickets are served in generation order
+    generation: int
+    # epoch seconds
+    expires: float
+
+
+def _queue_prefix(gcs_path: str) -> str:
+    return f"{gcs_path}.queue/"
+
+
+def _list_queue(gcs_path: str, lock_store: LockStore) -> list[_QueueTicket]:
+    """Live tickets for the lock at `gcs_path`, in queue order.
+
+    Deletes expired tickets along the way.
+    """
+    tickets = []
+    now = time.time()
+    for obj in lock_store.list_objects(_queue_prefix(gcs_path)):
+        if "expires" in obj.metadata:
+            expires = float(obj.metadata["expires"])
+        else:
+            # The waiter died between creating the ticket and setting its
+            # expiry. GCS generations are creation times in microseconds.
+            expires = obj.generation / 1e6 + DEFAULT_TICKET_TTL.total_seconds()
+        if now > expires + LEASE_EXPIRY_GRACE.total_seconds():
+            print(f"Removing expired queue ticket {obj.gcs_path}")
+            lock_store.release_generation(obj.gcs_path, obj.generation)
+            continue
+        tickets.append(_QueueTicket(obj.gcs_path, obj.generation, expires))
+    tickets.sort(key=lambda t: (t.generation, t.gcs_path))
+    return tickets
+
+
+def _enqueue(
+    gcs_path: str,
+    deploy_state: DeployState,
+    lock_store: LockStore,
+    ticket_ttl: timedelta,
+) -> _QueueTicket:
+    # The ticket holds our deploy state, for seeing who's waiting.
+    ticket_path = f"{_queue_prefix(gcs_path)}{uuid.uuid4().hex}"
+    result = lock_store.acquire(ticket_path, deploy_state.to_json())
+    assert result.acquired and result.generation is not None, result
+    ticket = _QueueTicket(ticket_path, result.generation, 0)
+    return _renew_ticket(gcs_path, ticket, deploy_state, lock_store, ticket_ttl)
+
+
+def _renew_ticket(
+    gcs_path: str,
+    ticket: _QueueTicket,
+    deploy_state: DeployState,
+    lock_store: LockStore,
+    ticket_ttl: timedelta,
+) -> _QueueTicket:
+    """Pushes back the ticket's expiry.
+
+    This only changes the ticket's metageneration, so the waiter behind us
+    (watching our generation) isn't woken. If the ticket expired and was
+    deleted, we lose our place and go to the back of the queue.
+    """
+    expires = time.time() + ticket_ttl.total_seconds()
+    if lock_store.update_metadata(ticket.gcs_path, {"expires": str(expires)}):
+        return ticket._replace(expires=expires)
+    print(f"Queue ticket {ticket.gcs_path} expired, requeueing.")
+    return _enqueue(gcs_path, deploy_state, lock_store, ticket_ttl)
+
+
+def _wait_for_deploy_lock_queued(
+    gcs_path: str,
+    deploy_state: DeployState,
+    timeout: timedelta,
+    lock_store: Optional[LockStore] = None,
+    lease_ttl: Optional[timedelta] = None,
+    poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+    ticket_ttl: timedelta = DEFAULT_TICKET_TTL,
+) -> _DeployLockAttempt:
+    """Like _wait_for_deploy_lock, but waiters get the lock in arrival order.
+
+    Each waiter creates a ticket object under `{gcs_path}.queue/`, and tickets
+    are served in generation (i.e. creation) order. Only the waiter at the
+    head of the queue tries the lock; the others watch just the ticket ahead
+    of them. So a release wakes one waiter instead of all of them, and a
+    waiter can't be starved by later arrivals.
+
+    Waiters that don't queue can still take the lock ahead of the queue.
+    With the gsutil lock store every list and poll is a gsutil process, so
+    queueing is much slower there.
+    """
+    lock_store = lock_store or default_lock_store()
+    deadline = time.monotonic() + timeout.total_seconds()
+    renew_before = ticket_ttl.total_seconds() * 2 / 3
+    wait_span = Span()
+    num_attempts = 0
+    ticket: Optional[_QueueTicket] = None
+    attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+
+    # Don't pay for a ticket if nobody else is waiting.
+    if not _list_queue(gcs_path, lock_store):
+        num_attempts += 1
+        attempt = _acquire_deploy_lock_once(
+            gcs_path, deploy_state, lock_store, lease_ttl=lease_ttl
+        )
+        if not _should_retry(attempt):
+            wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, 1)
+            return attempt
+
+    ticket = _enqueue(gcs_path, deploy_state, lock_store, ticket_ttl)
+    try:
+        expect_held = attempt.generation is not None
+        while time.monotonic() < deadline:
+            if ticket.expires - time.time() < renew_before:
+                ticket = _renew_ticket(
+                    gcs_path, ticket, deploy_state, lock_store, ticket_ttl
+                )
+            renew_at = time.monotonic() + ticket.expires - time.time() - renew_before
+            queue = _list_queue(gcs_path, lock_store)
+            place = (ticket.generation, ticket.gcs_path)
+            ahead = [t for t in queue if (t.generation, t.gcs_path) < place]
+            if ahead:
+                predecessor = ahead[-1]
+                wake_at = min(renew_at, _wake_at(deadline, predecessor.expires))
+                _watch_lock(
+                    predecessor.gcs_path,
+                    predecessor.generation,
+                    wake_at,
+                    lock_store,
+                    poll_budget,
+                )
+                # the lock may have changed hands while we waited
+                expect_held = False
+                continue
+
+            # We're at the head of the queue.
+            num_attempts += 1
+            attempt = _acquire_deploy_lock_once(
+                gcs_path,
+                deploy_state,
+                lock_store,
+                expect_held=expect_held,
+                lease_ttl=lease_ttl,
+            )
+            if not _should_retry(attempt):
+                break
+            if attempt.generation is None:
+                time.sleep(poll_budget.min_interval.total_seconds())
+                expect_held = False
+            else:
+                wake_at = _wake_at(deadline, attempt.holder_lease_expires)
+                expect_held = _watch_lock(
+                    gcs_path,
+                    attempt.generation,
+                    min(renew_at, wake_at),
+                    lock_store,
+                    poll_budget,
+                )
+        else:
+            print(f"Timed out after {timeout} waiting in queue for {gcs_path}.")
+            attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+    finally:
+        lock_store.release_generation(ticket.gcs_path, ticket.generation)
+    wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, num_attempts)
+    return attempt
 
 
 ##### DeployLock implementation
@@ -207,9 +645,68 @@ class TimedOutAcquiringLock(Exception):
     pass
 
 
+def _raise_unless_got_lock(lock_result: DeployLockResult) -> None:
+    if lock_result in (
+        DeployLockResult.this_deploy_is_newer,
+        DeployLockResult.failed_to_get_lock_and_lock_state,
+        DeployLockResult.existing_lease_expired,
+    ):
+        assert False, f"Bug: should have auto-retried on {lock_result}"
+    elif lock_result == DeployLockResult.existing_deploy_is_newer:
+        raise ExistingDeployWithNewerCommit
+    elif lock_result == DeployLockResult.timed_out:
+        raise TimedOutAcquiringLock
+    assert lock_result == DeployLockResult.got_lock, "Bug: failed to handle a case?"
+
+
+def _start_heartbeat(
+    gcs_path: str,
+    deploy_state: DeployState,
+    attempt: _DeployLockAttempt,
+    lease_ttl: Optional[timedelta],
+    lock_store: LockStore,
+) -> Optional[LeaseHeartbeat]:
+    if lease_ttl is None:
+        return None
+    assert attempt.generation is not None, "Bug: lock store lost generation"
+    heartbeat = LeaseHeartbeat(
+        gcs_path, deploy_state, attempt.generation, lease_ttl, lock_store
+    )
+    heartbeat.start()
+    return heartbeat
+
+
+def _release_held_lock(
+    gcs_path: str,
+    lock_store: LockStore,
+    leased: bool,
+    generation: Optional[int],
+    hold_span: Optional[Span] = None,
+) -> None:
+    """Releases a lock we acquired. `generation` is from LeaseHeartbeat.stop()."""
+    if not leased:
+        release_lock(gcs_path, lock_store)
+    elif generation is None:
+        print("Not releasing lock: our lease was broken by someone else.")
+    else:
+        release_lock(gcs_path, lock_store, generation)
+    if hold_span:
+        outcome = "lost_lease" if leased and generation is None else "released"
+        hold_span.emit(LockEventKind.hold, gcs_path, outcome)
+
+
 class DeployLock:
     """Context manager for acquiring a deploy lock file.
 
+    With `lease_ttl` (e.g. DEFAULT_LEASE_TTL), the lock is leased and renewed
+    in the background while held, so if this process dies, waiters can take
+    the lock over once the lease expires. Without one, the lock never
+    expires, and deployers from before leases existed can read it.
+
+    While waiting, `poll_budget` controls how often we check for the lock
+    being released. With `queued`, waiters get the lock in the order they
+    started waiting (see _wait_for_deploy_lock_queued).
+
     Raises:
     - ExistingDeployWithNewerCommit: when an existing lock is for a newer deploy
     - TimedOutAcquiringLock: when specified timeout is exceeded.
@@ -221,35 +718,446 @@ class DeployLock:
         lockfile_name: str,
         timeout: timedelta,
         deploy_state: Optional[DeployState] = None,
+        lock_store: Optional[LockStore] = None,
+        lease_ttl: Optional[timedelta] = None,
+        poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+        queued: bool = False,
     ):
         self.gcs_path = os.path.join(GCS_DEPLOY_LOCK_BASE, lockfile_name)
         del lockfile_name
-        # Note: `latest_commit` requires git and .git state (so won't work in
-        # slimmed Docker containers)
+        self.lock_store = lock_store or default_lock_store()
+        # Note: `latest_commit` requires .git state, or commit info injected
+        # at build time in slimmed Docker containers (see commit_info.py)
         deploy_state = deploy_state or DeployState.latest_commit()
 
-        lock_result = _wait_for_deploy_lock(self.gcs_path, deploy_state, timeout)
-        if lock_result in (
-            DeployLockResult.this_deploy_is_newer,
-            DeployLockResult.failed_to_get_lock_and_lock_state,
-        ):
-            assert False, f"Bug: should have auto-retried on {lock_result}"
-        elif lock_result == DeployLockResult.existing_deploy_is_newer:
-            raise ExistingDeployWithNewerCommit
-        elif lock_result == DeployLockResult.timed_out:
-            raise TimedOutAcquiringLock
-        assert lock_result == DeployLockResult.got_lock, "Bug: failed to handle a case?"
+        attempt = _wait_for_deploy_lock(
+            self.gcs_path,
+            deploy_state,
+            timeout,
+            self.lock_store,
+            lease_ttl,
+            poll_budget,
+            queued,
+        )
+        _raise_unless_got_lock(attempt.result)
+        self._hold_span = Span()
+        self.generation = attempt.generation
+        self._heartbeat = _start_heartbeat(
+            self.gcs_path, deploy_state, attempt, lease_ttl, self.lock_store
+        )
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, _type, _value, _traceback):
+        generation = self._heartbeat.stop() if self._heartbeat else None
+        _release_held_lock(
+            self.gcs_path,
+            self.lock_store,
+            self._heartbeat is not None,
+            generation,
+            self._hold_span,
+        )
+
+
+##### DeployLockSet implementation
+
+
+class DeployLockSet:
+    """Context manager for acquiring several deploy lock files together.
+
+    All locks are attempted at once, so acquiring N free locks takes about one
+    lock's worth of latency rather than N.
+
+    Locks are ranked by path. If some locks are held by others, we keep the
+    ones ranked before the first unavailable lock, give back the ones after
+    it, and wait for it. Since everyone ranks locks the same way, nobody waits
+    for a lock while holding a higher-ranked one, so there's no deadlock. If
+    acquisition fails, everything acquired so far is released.
+
+    Raises the same exceptions as DeployLock.
+    """
+
+    def __init__(
+        self,
+        lockfile_names: Iterable[str],
+        timeout: timedelta,
+        deploy_state: Optional[DeployState] = None,
+        lock_store: Optional[LockStore] = None,
+        lease_ttl: Optional[timedelta] = None,
+        poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+    ):
+        self.gcs_paths = sorted(
+            {os.path.join(GCS_DEPLOY_LOCK_BASE, name) for name in lockfile_names}
+        )
+        del lockfile_names
+        assert self.gcs_paths, "No lockfiles given"
+        self.lock_store = lock_store or default_lock_store()
+        self.lease_ttl = lease_ttl
+        self.deploy_state = deploy_state or DeployState.latest_commit()
+        # gcs path -> generation, for locks we hold
+        self.generations: dict[str, Optional[int]] = {}
+        self._heartbeats: dict[str, LeaseHeartbeat] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.gcs_paths), thread_name_prefix="DeployLockSet"
+        )
+        # for LockEvents
+        self._label = ",".join(self.gcs_paths)
+        self._num_attempts = 0
+        wait_span = Span()
+        try:
+            self._acquire_all(timeout, poll_budget)
+        except BaseException as e:
+            self._release(list(self.generations))
+            self._executor.shutdown()
+            if isinstance(e, ExistingDeployWithNewerCommit):
+                outcome = DeployLockResult.existing_deploy_is_newer.name
+            elif isinstance(e, TimedOutAcquiringLock):
+                outcome = DeployLockResult.timed_out.name
+            else:
+                outcome = type(e).__name__
+            wait_span.emit(LockEventKind.wait, self._label, outcome, self._num_attempts)
+            raise
+        wait_span.emit(
+            LockEventKind.wait,
+            self._label,
+            DeployLockResult.got_lock.name,
+            self._num_attempts,
+        )
+        self._hold_span = Span()
+
+    def _acquire_all(self, timeout: timedelta, poll_budget: PollBudget) -> None:
+        deadline = time.monotonic() + timeout.total_seconds()
+        expect_held: dict[str, bool] = {}
+        while True:
+            self._num_attempts += 1
+            pending = [p for p in self.gcs_paths if p not in self.generations]
+            results = self._executor.map(
+                self._attempt, pending, [expect_held.get(p, False) for p in pending]
+            )
+            attempts = dict(zip(pending, results))
+            for path, attempt in attempts.items():
+                if attempt.result == DeployLockResult.got_lock:
+                    self._hold(path, attempt)
+            if any(
+                attempt.result == DeployLockResult.existing_deploy_is_newer
+                for attempt in attempts.values()
+            ):
+                raise ExistingDeployWithNewerCommit
+            if len(self.generations) == len(self.gcs_paths):
+                return
+
+            blocking_path = min(p for p in pending if p not in self.generations)
+            self._release([p for p in self.generations if p > blocking_path])
+            if time.monotonic() >= deadline:
+                print(f"Timed out after {timeout} waiting for deploy locks.")
+                raise TimedOutAcquiringLock
+
+            blocking = attempts[blocking_path]
+            expect_held = {}
+            if blocking.generation is None:
+                time.sleep(poll_budget.min_interval.total_seconds())
+            else:
+                expect_held[blocking_path] = _watch_lock(
+                    blocking_path,
+                    blocking.generation,
+                    _wake_at(deadline, blocking.holder_lease_expires),
+                    self.lock_store,
+                    poll_budget,
+                )
+
+    def _attempt(self, gcs_path: str, expect_held: bool) -> _DeployLockAttempt:
+        return _acquire_deploy_lock_once(
+            gcs_path, self.deploy_state, self.lock_store, expect_held, self.lease_ttl
+        )
+
+    def _hold(self, gcs_path: str, attempt: _DeployLockAttempt) -> None:
+        self.generations[gcs_path] = attempt.generation
+        heartbeat = _start_heartbeat(
+            gcs_path, self.deploy_state, attempt, self.lease_ttl, self.lock_store
+        )
+        if heartbeat:
+            self._heartbeats[gcs_path] = heartbeat
+
+    def _release(self, gcs_paths: list[str]) -> None:
+        """Releases the given held locks in parallel."""
+
+        def release(path: str) -> None:
+            heartbeat = self._heartbeats.pop(path, None)
+            generation = heartbeat.stop() if heartbeat else None
+            _release_held_lock(path, self.lock_store, heartbeat is not None, generation)
+
+        for path in gcs_paths:
+            del self.generations[path]
+        # list() to propagate exceptions
+        list(self._executor.map(release, gcs_paths))
 
     def __enter__(self) -> None:
         pass
 
     def __exit__(self, _type, _value, _traceback):
-        release_lock(self.gcs_path)
+        try:
+            self._release(list(self.generations))
+        finally:
+            self._executor.shutdown()
+        self._hold_span.emit(LockEventKind.hold, self._label, "released")
+
+
+##### AsyncDeployLock implementation
+
+
+async def _watch_lock_async(
+    gcs_path: str,
+    generation: int,
+    wake_at: float,
+    lock_store: LockStore,
+    poll_budget: PollBudget,
+) -> bool:
+    """asyncio version of _watch_lock."""
+    for interval in _poll_intervals(poll_budget):
+        remaining = wake_at - time.monotonic()
+        if remaining <= 0:
+            return True
+        await asyncio.sleep(min(interval, remaining))
+        meta = await asyncio.to_thread(lock_store.stat, gcs_path)
+        if meta is None:
+            return False
+        if meta.generation != generation:
+            return True
+    assert False, "unreachable"
+
+
+async def _wait_for_deploy_lock_async(
+    gcs_path: str,
+    deploy_state: DeployState,
+    timeout: timedelta,
+    lock_store: LockStore,
+    lease_ttl: Optional[timedelta] = None,
+    poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+) -> _DeployLockAttempt:
+    """asyncio version of _wait_for_deploy_lock.
+
+    Each acquisition attempt is a few blocking requests, so it runs on the
+    default executor. The waiting in between is done on the event loop.
+    """
+    deadline = time.monotonic() + timeout.total_seconds()
+    last_attempt: Optional[_DeployLockAttempt] = None
+    num_attempts = 0
+
+    @tenacity.retry(
+        retry=retry_if_result(_should_retry),
+        wait=wait_none(),
+        stop=stop_after_delay(timeout.total_seconds()),
+    )
+    async def _wait_for_deploy_lock() -> _DeployLockAttempt:
+        nonlocal last_attempt, num_attempts
+        num_attempts += 1
+        expect_held = False
+        if last_attempt is not None:
+            if last_attempt.generation is None:
+                await asyncio.sleep(poll_budget.min_interval.total_seconds())
+            else:
+                expect_held = await _watch_lock_async(
+                    gcs_path,
+                    last_attempt.generation,
+                    _wake_at(deadline, last_attempt.holder_lease_expires),
+                    lock_store,
+                    poll_budget,
+                )
+        last_attempt = await asyncio.to_thread(
+            _acquire_deploy_lock_once,
+            gcs_path,
+            deploy_state,
+            lock_store,
+            expect_held,
+            lease_ttl,
+        )
+        return last_attempt
+
+    wait_span = Span()
+    try:
+        attempt = await _wait_for_deploy_lock()
+    except tenacity.RetryError as e:
+        print(f"Timed out after {timeout} waiting for deploy lock ({e}).")
+        attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+    wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, num_attempts)
+    return attempt
+
+
+async def _wait_for_deploy_lock_queued_async(
+    gcs_path: str,
+    deploy_state: DeployState,
+    timeout: timedelta,
+    lock_store: LockStore,
+    lease_ttl: Optional[timedelta] = None,
+    poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+    ticket_ttl: timedelta = DEFAULT_TICKET_TTL,
+) -> _DeployLockAttempt:
+    """asyncio version of _wait_for_deploy_lock_queued.
+
+    Like _wait_for_deploy_lock_async, only the lock store calls run on the
+    default executor, so a waiter doesn't hold an executor thread for as long
+    as it waits (which would starve the holder's release).
+    """
+    deadline = time.monotonic() + timeout.total_seconds()
+    renew_before = ticket_ttl.total_seconds() * 2 / 3
+    wait_span = Span()
+    num_attempts = 0
+    attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+
+    # Don't pay for a ticket if nobody else is waiting.
+    if not await asyncio.to_thread(_list_queue, gcs_path, lock_store):
+        num_attempts += 1
+        attempt = await asyncio.to_thread(
+            _acquire_deploy_lock_once,
+            gcs_path,
+            deploy_state,
+            lock_store,
+            lease_ttl=lease_ttl,
+        )
+        if not _should_retry(attempt):
+            wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, 1)
+            return attempt
+
+    ticket = await asyncio.to_thread(
+        _enqueue, gcs_path, deploy_state, lock_store, ticket_ttl
+    )
+    try:
+        expect_held = attempt.generation is not None
+        while time.monotonic() < deadline:
+            if ticket.expires - time.time() < renew_before:
+                ticket = await asyncio.to_thread(
+                    _renew_ticket,
+                    gcs_path,
+                    ticket,
+                    deploy_state,
+                    lock_store,
+                    ticket_ttl,
+                )
+            renew_at = time.monotonic() + ticket.expires - time.time() - renew_before
+            queue = await asyncio.to_thread(_list_queue, gcs_path, lock_store)
+            place = (ticket.generation, ticket.gcs_path)
+            ahead = [t for t in queue if (t.generation, t.gcs_path) < place]
+            if ahead:
+                predecessor = ahead[-1]
+                wake_at = min(renew_at, _wake_at(deadline, predecessor.expires))
+                await _watch_lock_async(
+                    predecessor.gcs_path,
+                    predecessor.generation,
+                    wake_at,
+                    lock_store,
+                    poll_budget,
+                )
+                # the lock may have changed hands while we waited
+                expect_held = False
+                continue
+
+            # We're at the head of the queue.
+            num_attempts += 1
+            attempt = await asyncio.to_thread(
+                _acquire_deploy_lock_once,
+                gcs_path,
+                deploy_state,
+                lock_store,
+                expect_held=expect_held,
+                lease_ttl=lease_ttl,
+            )
+            if not _should_retry(attempt):
+                break
+            if attempt.generation is None:
+                await asyncio.sleep(poll_budget.min_interval.total_seconds())
+                expect_held = False
+            else:
+                wake_at = _wake_at(deadline, attempt.holder_lease_expires)
+                expect_held = await _watch_lock_async(
+                    gcs_path,
+                    attempt.generation,
+                    min(renew_at, wake_at),
+                    lock_store,
+                    poll_budget,
+                )
+        else:
+            print(f"Timed out after {timeout} waiting in queue for {gcs_path}.")
+            attempt = _DeployLockAttempt(DeployLockResult.timed_out)
+    finally:
+        await asyncio.to_thread(
+            lock_store.release_generation, ticket.gcs_path, ticket.generation
+        )
+    wait_span.emit(LockEventKind.wait, gcs_path, attempt.result.name, num_attempts)
+    return attempt
+
+
+class AsyncDeployLock:
+    """Like DeployLock, but for `async with`. Doesn't block the event loop.
+
+    Unlike DeployLock, the lock is acquired on entering the `async with`
+    block, not on construction. Raises the same exceptions as DeployLock.
+    The lease heartbeat still runs on a thread.
+    """
+
+    def __init__(
+        self,
+        lockfile_name: str,
+        timeout: timedelta,
+        deploy_state: Optional[DeployState] = None,
+        lock_store: Optional[LockStore] = None,
+        lease_ttl: Optional[timedelta] = None,
+        poll_budget: PollBudget = DEFAULT_POLL_BUDGET,
+        queued: bool = False,
+    ):
+        self.gcs_path = os.path.join(GCS_DEPLOY_LOCK_BASE, lockfile_name)
+        self.timeout = timeout
+        self.deploy_state = deploy_state
+        self.lock_store = lock_store
+        self.lease_ttl = lease_ttl
+        self.poll_budget = poll_budget
+        self.queued = queued
+        self.generation: Optional[int] = None
+        self._heartbeat: Optional[LeaseHeartbeat] = None
+        self._hold_span: Optional[Span] = None
+
+    async def __aenter__(self) -> None:
+        # both of these can run subprocesses
+        if self.lock_store is None:
+            self.lock_store = await asyncio.to_thread(default_lock_store)
+        if self.deploy_state is None:
+            self.deploy_state = await asyncio.to_thread(DeployState.latest_commit)
+
+        wait = _wait_for_deploy_lock_async
+        if self.queued:
+            wait = _wait_for_deploy_lock_queued_async
+        attempt = await wait(
+            self.gcs_path,
+            self.deploy_state,
+            self.timeout,
+            self.lock_store,
+            self.lease_ttl,
+            self.poll_budget,
+        )
+        _raise_unless_got_lock(attempt.result)
+        self._hold_span = Span()
+        self.generation = attempt.generation
+        self._heartbeat = _start_heartbeat(
+            self.gcs_path, self.deploy_state, attempt, self.lease_ttl, self.lock_store
+        )
+
+    async def __aexit__(self, _type, _value, _traceback):
+        assert self.lock_store is not None
+        generation = None
+        if self._heartbeat:
+            generation = await asyncio.to_thread(self._heartbeat.stop)
+        await asyncio.to_thread(
+            _release_held_lock,
+            self.gcs_path,
+            self.lock_store,
+            self._heartbeat is not None,
+            generation,
+            self._hold_span,
+        )
 
 
 if __name__ == "__main__":
     import argparse
-    import time
 
     p = argparse.ArgumentParser()
     p.add_argument("-t", type=int, required=False, help="simulated timestamp")
@@ -1,9 +1,31 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Iterator, NamedTuple
+
+import pytest
+
+from gcs_lock.fake_gcs_server import FakeGcsServer
 from gcs_lock.gcs_lock import (
+    AsyncDeployLock,
+    DeployLock,
+    DeployLockSet,
     DeployState,
     DeployLockResult,
+    ExistingDeployWithNewerCommit,
+    LeaseHeartbeat,
     LockResult,
+    PollBudget,
+    TimedOutAcquiringLock,
+    _acquire_deploy_lock_once,
     _lockresult_to_deploylockresult,
+    _wait_for_deploy_lock,
 )
+from gcs_lock.lock_metrics import LockEventKind, LockMetrics
+from gcs_lock.lock_store import GcsJsonApiLockStore, InMemoryLockStore
 
 
 def test_lockresult_to_deploylockresult__no_existing_lock() -> None:
@@ -41,8 +63,434 @@ def test_lockresult_to_deploylockresult__failed_to_read_state() -> None:
     assert dlr == DeployLockResult.failed_to_get_lock_and_lock_state
 
 
-# TODO: do deeper tests by mocking out acquire_lock and release_lock...
-# - _wait_for_deploy_lock returns immediately if no existing lock
-# - _wait_for_deploy_lock retries if existing lock, and then returns successful acquisition after lock goes away
-# - _wait_for_deploy_lock retries if existing lock and return timeout after time expires
-# - BlueroseDeployLock succeeds / raises the right exceptions
+def test_lockresult_to_deploylockresult__existing_lease_expired() -> None:
+    expired = DeployState('abc', 100, '2021-01-02', 'host', lease_expires=1.0)
+    lr = LockResult(acquired=False, existing_state=expired.to_json())
+    # even though the existing deploy is newer
+    this_deploy = DeployState('abc', 99, '2021-01-01', 'host')
+    dlr = _lockresult_to_deploylockresult(lr, this_deploy)
+    assert dlr == DeployLockResult.existing_lease_expired
+
+
+def test_deploy_state__from_json_without_lease() -> None:
+    data = '{"git_sha": "abc", "git_timestamp": 1, "deploy_datetime": "d", '
+    data += '"deploy_hostname": "h"}'
+    state = DeployState.from_json(data)
+    assert state.lease_expires is None
+    assert not state.lease_expired()
+
+
+def test_deploy_state__from_json_ignores_unknown_fields() -> None:
+    data = '{"git_sha": "abc", "git_timestamp": 1, "deploy_datetime": "d", '
+    data += '"deploy_hostname": "h", "added_later": true}'
+    assert DeployState.from_json(data) == DeployState('abc', 1, 'd', 'h')
+
+
+class BaselineDeployState(NamedTuple):
+    """DeployState as deployers from before leases have it."""
+
+    git_sha: str
+    git_timestamp: int
+    deploy_datetime: str
+    deploy_hostname: str
+
+
+def test_deploy_state__to_json_without_lease_parses_in_older_deployers() -> None:
+    state = DeployState('abc', 1, 'd', 'h')
+    # how those deployers parse locks
+    old = BaselineDeployState(**json.loads(state.to_json()))
+    assert old == BaselineDeployState('abc', 1, 'd', 'h')
+    assert DeployState.from_json(state.to_json()) == state
+
+
+def test_deploy_state__to_json_round_trips_lease() -> None:
+    state = DeployState('abc', 1, 'd', 'h', lease_expires=2.5)
+    assert DeployState.from_json(state.to_json()) == state
+
+
+@pytest.fixture
+def json_store() -> Iterator[GcsJsonApiLockStore]:
+    with FakeGcsServer() as server:
+        yield GcsJsonApiLockStore(endpoint=server.endpoint)
+
+
+def test_acquire_deploy_lock_once__breaks_expired_lease(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    crashed = DeployState('abc', 100, '2021-01-02', 'host', lease_expires=1.0)
+    assert json_store.acquire('gs://b/lock.json', crashed.to_json()).acquired
+    this_deploy = DeployState('abc', 99, '2021-01-01', 'host')
+    attempt = _acquire_deploy_lock_once(
+        'gs://b/lock.json', this_deploy, json_store, lease_ttl=timedelta(minutes=1)
+    )
+    assert attempt.result == DeployLockResult.got_lock
+    existing = json_store.acquire('gs://b/lock.json', '{}').existing_state
+    assert existing is not None
+    assert DeployState.from_json(existing).git_timestamp == 99
+
+
+def test_lease_heartbeat__renews_lease(json_store: GcsJsonApiLockStore) -> None:
+    ttl = timedelta(seconds=0.15)
+    state = DeployState('abc', 1, '2021-01-01', 'host').with_lease(ttl)
+    first = json_store.acquire('gs://b/lock.json', state.to_json())
+    assert first.generation is not None
+    heartbeat = LeaseHeartbeat(
+        'gs://b/lock.json', state, first.generation, ttl, json_store
+    )
+    heartbeat.start()
+    time.sleep(0.2)
+    generation = heartbeat.stop()
+    assert generation is not None and generation != first.generation
+    existing = json_store.acquire('gs://b/lock.json', '{}')
+    assert existing.generation == generation
+    assert existing.existing_state is not None
+    renewed = DeployState.from_json(existing.existing_state)
+    assert renewed.lease_expires is not None
+    assert state.lease_expires is not None
+    assert renewed.lease_expires > state.lease_expires
+
+
+def test_deploy_lock__does_not_release_lock_taken_over_by_someone_else(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    this_deploy = DeployState('abc', 1, '2021-01-01', 'host')
+    lock = DeployLock(
+        'lock.json', timedelta(seconds=1), this_deploy, json_store, timedelta(hours=1)
+    )
+    with lock:
+        # someone broke our lease and took over
+        assert lock.generation is not None
+        assert json_store.release_generation('gs://b/lock.json', lock.generation)
+        assert json_store.acquire('gs://b/lock.json', '{"other": 1}').acquired
+    existing = json_store.acquire('gs://b/lock.json', '{}')
+    assert existing.existing_state == '{"other": 1}'
+
+
+FAST_POLL = PollBudget(timedelta(milliseconds=10), timedelta(milliseconds=20))
+
+
+def test_wait_for_deploy_lock__returns_immediately_if_no_existing_lock(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    this_deploy = DeployState('abc', 1, '2021-01-01', 'host')
+    attempt = _wait_for_deploy_lock(
+        'gs://b/lock.json', this_deploy, timedelta(seconds=1), json_store
+    )
+    assert attempt.result == DeployLockResult.got_lock
+
+
+def test_wait_for_deploy_lock__acquires_soon_after_release(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    holder = DeployState('abc', 1, '2021-01-01', 'host')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    release_timer = threading.Timer(0.2, json_store.release, ['gs://b/lock.json'])
+    release_timer.start()
+    start = time.monotonic()
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    attempt = _wait_for_deploy_lock(
+        'gs://b/lock.json',
+        this_deploy,
+        timedelta(seconds=5),
+        json_store,
+        poll_budget=FAST_POLL,
+    )
+    assert attempt.result == DeployLockResult.got_lock
+    assert time.monotonic() - start < 0.5
+
+
+def test_wait_for_deploy_lock__times_out(json_store: GcsJsonApiLockStore) -> None:
+    holder = DeployState('abc', 1, '2021-01-01', 'host')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    attempt = _wait_for_deploy_lock(
+        'gs://b/lock.json',
+        this_deploy,
+        timedelta(seconds=0.2),
+        json_store,
+        poll_budget=FAST_POLL,
+    )
+    assert attempt.result == DeployLockResult.timed_out
+
+
+def test_async_deploy_lock__waiters_take_turns_without_blocking_loop(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    events: list[str] = []
+
+    async def deploy(name: str, timestamp: int, delay: float = 0) -> None:
+        # the older deploy has to get there first, or it gives up
+        await asyncio.sleep(delay)
+        state = DeployState('abc', timestamp, '2021-01-01', name)
+        lock = AsyncDeployLock(
+            'lock.json', timedelta(seconds=5), state, json_store, None, FAST_POLL
+        )
+        async with lock:
+            events.append(f'{name} start')
+            await asyncio.sleep(0.1)
+            events.append(f'{name} end')
+
+    async def ticker() -> int:
+        ticks = 0
+        while len(events) < 4:
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks
+
+    async def main() -> int:
+        ticks, *_ = await asyncio.gather(
+            ticker(), deploy('a', 1), deploy('b', 2, delay=0.05)
+        )
+        return ticks
+
+    ticks = asyncio.run(main())
+    assert events == ['a start', 'a end', 'b start', 'b end']
+    # the event loop kept running while both locks waited
+    assert ticks > 10
+
+
+def test_async_deploy_lock__existing_deploy_is_newer(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 2, '2021-01-02', 'host')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+
+    async def deploy() -> None:
+        state = DeployState('abc', 1, '2021-01-01', 'host')
+        lock = AsyncDeployLock('lock.json', timedelta(seconds=1), state, json_store)
+        async with lock:
+            pass
+
+    with pytest.raises(ExistingDeployWithNewerCommit):
+        asyncio.run(deploy())
+
+
+def test_deploy_lock_set__acquires_and_releases_all(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    this_deploy = DeployState('abc', 1, '2021-01-01', 'host')
+    names = ['c.json', 'a.json', 'b.json']
+    with DeployLockSet(names, timedelta(seconds=1), this_deploy, json_store):
+        for name in names:
+            assert json_store.stat(f'gs://b/{name}') is not None
+    for name in names:
+        assert json_store.stat(f'gs://b/{name}') is None
+
+
+def test_deploy_lock_set__holds_lower_ranked_locks_while_waiting(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 1, '2021-01-01', 'other')
+    assert json_store.acquire('gs://b/b.json', holder.to_json()).acquired
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    lock_sets: list[DeployLockSet] = []
+    waiter = threading.Thread(
+        target=lambda: lock_sets.append(
+            DeployLockSet(
+                ['a.json', 'b.json', 'c.json'],
+                timedelta(seconds=5),
+                this_deploy,
+                json_store,
+                poll_budget=FAST_POLL,
+            )
+        )
+    )
+    waiter.start()
+    time.sleep(0.2)
+    # a.json is ranked before the lock we're waiting on, c.json after
+    assert json_store.stat('gs://b/a.json') is not None
+    assert json_store.stat('gs://b/c.json') is None
+    json_store.release('gs://b/b.json')
+    waiter.join()
+    with lock_sets[0]:
+        assert json_store.stat('gs://b/c.json') is not None
+
+
+def test_deploy_lock_set__rolls_back_on_newer_deploy(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 2, '2021-01-02', 'other')
+    assert json_store.acquire('gs://b/b.json', holder.to_json()).acquired
+    this_deploy = DeployState('abc', 1, '2021-01-01', 'host')
+    with pytest.raises(ExistingDeployWithNewerCommit):
+        names = ['a.json', 'b.json', 'c.json']
+        DeployLockSet(names, timedelta(seconds=1), this_deploy, json_store)
+    assert json_store.stat('gs://b/a.json') is None
+    assert json_store.stat('gs://b/c.json') is None
+
+
+def test_deploy_lock_set__rolls_back_on_timeout(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 1, '2021-01-01', 'other')
+    assert json_store.acquire('gs://b/b.json', holder.to_json()).acquired
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    with pytest.raises(TimedOutAcquiringLock):
+        DeployLockSet(
+            ['a.json', 'b.json'],
+            timedelta(seconds=0.2),
+            this_deploy,
+            json_store,
+            poll_budget=FAST_POLL,
+        )
+    assert json_store.stat('gs://b/a.json') is None
+
+
+def _wait_for_queue_length(
+    json_store: GcsJsonApiLockStore, prefix: str, length: int
+) -> None:
+    deadline = time.monotonic() + 5
+    while len(json_store.list_objects(prefix)) < length:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_queued_deploy_lock__waiters_get_lock_in_arrival_order(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 1, '2021-01-01', 'other')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    order: list[int] = []
+
+    def wait(git_timestamp: int) -> None:
+        this_deploy = DeployState('abc', git_timestamp, '2021-01-02', 'host')
+        with DeployLock(
+            'lock.json',
+            timedelta(seconds=5),
+            this_deploy,
+            json_store,
+            None,
+            FAST_POLL,
+            queued=True,
+        ):
+            order.append(git_timestamp)
+            time.sleep(0.05)
+
+    waiters = []
+    for i, git_timestamp in enumerate([2, 3, 4]):
+        waiter = threading.Thread(target=wait, args=(git_timestamp,))
+        waiter.start()
+        waiters.append(waiter)
+        _wait_for_queue_length(json_store, 'gs://b/lock.json.queue/', i + 1)
+    json_store.release('gs://b/lock.json')
+    for waiter in waiters:
+        waiter.join()
+    # if 4 had barged ahead, 2 and 3 would have given up
+    assert order == [2, 3, 4]
+    assert json_store.list_objects('gs://b/lock.json.queue/') == []
+
+
+def test_async_queued_waiters_dont_starve_the_executor(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    order: list[int] = []
+
+    async def deploy(git_timestamp: int) -> None:
+        # in arrival order, so nobody's older than the lock holder
+        await asyncio.sleep(0.02 * git_timestamp)
+        state = DeployState('abc', git_timestamp, '2021-01-01', 'host')
+        lock = AsyncDeployLock(
+            'lock.json',
+            timedelta(seconds=5),
+            state,
+            json_store,
+            None,
+            FAST_POLL,
+            queued=True,
+        )
+        async with lock:
+            order.append(git_timestamp)
+            await asyncio.sleep(0.2 if git_timestamp == 0 else 0.01)
+
+    async def main() -> None:
+        # fewer threads than waiters
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+        await asyncio.gather(*(deploy(t) for t in range(6)))
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert order == list(range(6))
+    assert time.monotonic() - start < 2
+
+
+def test_queued_wait__skips_expired_tickets(json_store: GcsJsonApiLockStore) -> None:
+    holder = DeployState('abc', 1, '2021-01-01', 'other')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    # a waiter that died long ago
+    assert json_store.acquire('gs://b/lock.json.queue/dead', '{}').acquired
+    assert json_store.update_metadata('gs://b/lock.json.queue/dead', {'expires': '1'})
+    threading.Timer(0.1, json_store.release, ['gs://b/lock.json']).start()
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    attempt = _wait_for_deploy_lock(
+        'gs://b/lock.json',
+        this_deploy,
+        timedelta(seconds=5),
+        json_store,
+        poll_budget=FAST_POLL,
+        queued=True,
+    )
+    assert attempt.result == DeployLockResult.got_lock
+    assert json_store.list_objects('gs://b/lock.json.queue/') == []
+
+
+@pytest.fixture
+def lock_metrics() -> Iterator[LockMetrics]:
+    metrics = LockMetrics().install()
+    yield metrics
+    metrics.uninstall()
+
+
+def test_lock_metrics__records_deploy_lock_lifecycle(
+    json_store: GcsJsonApiLockStore,
+    monkeypatch: pytest.MonkeyPatch,
+    lock_metrics: LockMetrics,
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    holder = DeployState('abc', 1, '2021-01-01', 'other')
+    assert json_store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    threading.Timer(0.1, json_store.release, ['gs://b/lock.json']).start()
+    this_deploy = DeployState('abc', 2, '2021-01-02', 'host')
+    lock = DeployLock(
+        'lock.json', timedelta(seconds=5), this_deploy, json_store, None, FAST_POLL
+    )
+    with lock:
+        time.sleep(0.05)
+
+    counts = lock_metrics.outcome_counts
+    assert counts[LockEventKind.acquire, 'held'] >= 1
+    assert counts[LockEventKind.acquire, 'acquired'] == 1
+    assert counts[LockEventKind.wait, 'got_lock'] == 1
+    assert counts[LockEventKind.hold, 'released'] == 1
+    assert counts[LockEventKind.release, 'released'] == 1
+    assert lock_metrics.retries >= 1
+    assert lock_metrics.histograms[LockEventKind.wait].total >= 0.1
+    assert lock_metrics.histograms[LockEventKind.hold].total >= 0.05
+    assert 'wait' in lock_metrics.summary()
+
+
+def test_deploy_lock__raises_for_newer_deploy_and_timeout(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr('gcs_lock.gcs_lock.GCS_DEPLOY_LOCK_BASE', 'gs://b')
+    store = InMemoryLockStore()
+    holder = DeployState('abc', 2, '2021-01-02', 'other')
+    assert store.acquire('gs://b/lock.json', holder.to_json()).acquired
+    older = DeployState('abc', 1, '2021-01-01', 'host')
+    with pytest.raises(ExistingDeployWithNewerCommit):
+        DeployLock('lock.json', timedelta(seconds=1), older, store)
+    newer = DeployState('abc', 3, '2021-01-03', 'host')
+    with pytest.raises(TimedOutAcquiringLock):
+        DeployLock('lock.json', timedelta(seconds=0.1), newer, store, None, FAST_POLL)
+    store.release('gs://b/lock.json')
+    with DeployLock('lock.json', timedelta(seconds=1), newer, store):
+        assert store.stat('gs://b/lock.json') is not None
+    assert store.stat('gs://b/lock.json') is None
@@ -0,0 +1,198 @@
+"""Instrumentation for gcs_lock: how long we spend acquiring, waiting for, and
+holding locks.
+
+gcs_lock emits a LockEvent when each operation finishes. To see them, register
+a listener:
+
+    add_lock_listener(lambda event: print(event))
+
+or aggregate them with LockMetrics:
+
+    metrics = LockMetrics().install()
+    with DeployLock(...):
+        ...
+    print(metrics.summary())
+"""
+
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from collections import Counter
+from enum import Enum, auto
+from typing import Callable, NamedTuple
+
+
+class LockEventKind(Enum):
+    # one acquire_lock call (a create and/or read of the lock object)
+    acquire = auto()
+    # one release_lock call
+    release = auto()
+    # all attempts at getting a lock, e.g. _wait_for_deploy_lock
+    wait = auto()
+    # from getting a lock to releasing it
+    hold = auto()
+
+
+class LockEvent(NamedTuple):
+    kind: LockEventKind
+    # for lock sets, the comma-separated paths
+    gcs_path: str
+    # epoch seconds, for lining events up with other traces
+    start: float
+    # seconds
+    duration: float
+    # acquire: "acquired", "held", or "vanished". release: "released" or
+    # "taken_over". wait: a DeployLockResult name. hold: "released" or
+    # "lost_lease".
+    outcome: str
+    # for waits, the number of acquisition attempts made
+    attempts: int = 1
+
+
+LockListener = Callable[[LockEvent], None]
+
+_listeners: list[LockListener] = []
+_listeners_lock = threading.Lock()
+
+
+def add_lock_listener(listener: LockListener) -> None:
+    """Calls `listener` with every LockEvent, from whichever thread emits it."""
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_lock_listener(listener: LockListener) -> None:
+    with _listeners_lock:
+        _listeners.remove(listener)
+
+
+def emit_lock_event(event: LockEvent) -> None:
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception as e:
+            # instrumentation shouldn't break locking
+            print(f"Lock listener {listener} failed on {event}: {e!r}")
+
+
+class Span:
+    """Times an operation, then emits it as a LockEvent."""
+
+    def __init__(self):
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+
+    def emit(
+        self, kind: LockEventKind, gcs_path: str, outcome: str, attempts: int = 1
+    ) -> LockEvent:
+        duration = time.perf_counter() - self._start_perf
+        event = LockEvent(kind, gcs_path, self.start, duration, outcome, attempts)
+        emit_lock_event(event)
+        return event
+
+
+##### aggregation
+
+# Histogram bucket upper bounds, in seconds. Covers a single fast request up
+# through waiting on a long deploy.
+HISTOGRAM_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1800,
+    float("inf"),
+)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram. Not thread-safe on its own."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile (0 < q <= 1)."""
+        if not self.count:
+            return float("nan")
+        target = q * self.count
+        seen = 0
+        for upper, bucket_count in zip(HISTOGRAM_BUCKETS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                # the max is a tighter bound for the top bucket(s)
+                return min(upper, self.max)
+        return self.max
+
+
+class LockMetrics:
+    """A lock listener that keeps outcome counts and latency histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outcome_counts: Counter[tuple[LockEventKind, str]] = Counter()
+        self.histograms = {kind: Histogram() for kind in LockEventKind}
+        # acquisition attempts beyond the first, summed over all waits
+        self.retries = 0
+
+    def __call__(self, event: LockEvent) -> None:
+        with self._lock:
+            self.outcome_counts[event.kind, event.outcome] += 1
+            self.histograms[event.kind].add(event.duration)
+            if event.kind == LockEventKind.wait:
+                self.retries += event.attempts - 1
+
+    def install(self) -> LockMetrics:
+        add_lock_listener(self)
+        return self
+
+    def uninstall(self) -> None:
+        remove_lock_listener(self)
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = []
+            for kind, hist in self.histograms.items():
+                if not hist.count:
+                    continue
+                lines.append(
+                    f"{kind.name:>8}: n={hist.count} total={hist.total:.3f}s "
+                    f"p50<={hist.quantile(0.5):.3f}s p90<={hist.quantile(0.9):.3f}s "
+                    f"p99<={hist.quantile(0.99):.3f}s max={hist.max:.3f}s"
+                )
+                outcomes = sorted(
+                    (outcome, n)
+                    for (k, outcome), n in self.outcome_counts.items()
+                    if k == kind
+                )
+                for outcome, n in outcomes:
+                    lines.append(f"          {outcome}: {n}")
+            lines.append(f"retries: {self.retries}")
+            return "\n".join(lines)
@@ -0,0 +1,870 @@
+"""Lock stores: the object storage operations that gcs_lock is built on.
+
+A lock store needs to support "create this object only if it doesn't exist
+yet", "read it", and "delete it". GCS does the first one with generation
+preconditions (`ifGenerationMatch=0`).
+
+- GcsJsonApiLockStore: talks to the GCS JSON API directly, reusing one HTTP
+  connection per thread. Each operation is a single request/response instead of
+  a fresh `gsutil` process (which costs ~1-2s of Python startup).
+- GsutilLockStore: shells out to `gsutil`. This is the original implementation,
+  kept as a fallback for when we can't get an access token.
+- InMemoryLockStore and LocalFileLockStore: same semantics without GCS, for
+  tests, benchmarks, and locking between processes on one machine.
+
+`default_lock_store()` picks one. Setting STORAGE_EMULATOR_HOST (same env var
+the official client libraries use) points the JSON API store at a stand-in
+server, e.g. `gcs_lock.fake_gcs_server.FakeGcsServer`.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import functools
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from typing import Callable, Iterator, NamedTuple, Optional, Protocol
+
+
+class LockResult(NamedTuple):
+    # Whether the lock was acquired successfully.
+    acquired: bool
+    # If we failed to acquire the lock, contains existing lock state.
+    # Note: if acquired==False and existing_state==None, then the lock kept
+    # disappearing in between our create and read attempts (see
+    # MAX_ACQUIRE_ROUNDS). Should be very rare.
+    existing_state: Optional[str]
+    # Generation of the lock object: ours if acquired, otherwise the one that
+    # `existing_state` was read from.
+    generation: Optional[int] = None
+
+
+class ObjectMeta(NamedTuple):
+    generation: int
+    # bumped by metadata-only updates; generation is bumped by content updates
+    metageneration: int
+
+
+class ListedObject(NamedTuple):
+    gcs_path: str
+    generation: int
+    # custom metadata (x-goog-meta-* headers / JSON API "metadata")
+    metadata: dict[str, str]
+
+
+# Lock stores retry "create failed, but then the lock was gone when we read it"
+# this many times before giving up with LockResult(False, None).
+MAX_ACQUIRE_ROUNDS = 3
+
+
+class LockStore(Protocol):
+    def acquire(
+        self, gcs_path: str, data: str, expect_held: bool = False
+    ) -> LockResult:
+        """Creates `gcs_path` with `data` iff it doesn't exist yet.
+
+        If the lock is held, the result includes the holder's data. With
+        `expect_held`, the store reads before trying to create, which saves a
+        round trip when the lock is usually held (e.g. when waiting on it).
+        """
+        ...
+
+    def replace(self, gcs_path: str, data: str, generation: int) -> Optional[int]:
+        """Overwrites `gcs_path` iff it's still at `generation`.
+
+        Returns the new generation, or None if the object changed or is gone.
+        """
+        ...
+
+    def stat(self, gcs_path: str) -> Optional[ObjectMeta]:
+        """Cheap metadata-only read. None if `gcs_path` doesn't exist."""
+        ...
+
+    def release(self, gcs_path: str) -> None:
+        """Deletes `gcs_path`. Raises exception if it isn't present."""
+        ...
+
+    def release_generation(self, gcs_path: str, generation: int) -> bool:
+        """Deletes `gcs_path` iff it's still at `generation`.
+
+        Returns False if the object changed or is already gone. Use this rather
+        than `release` when someone else might have taken the lock over.
+        """
+        ...
+
+    def list_objects(self, gcs_prefix: str) -> list[ListedObject]:
+        """Lists objects whose paths start with `gcs_prefix`."""
+        ...
+
+    def update_metadata(self, gcs_path: str, metadata: dict[str, str]) -> bool:
+        """Merges `metadata` into the object's custom metadata.
+
+        Only the metageneration changes, not the generation. Returns False if
+        the object doesn't exist.
+        """
+        ...
+
+
+def split_gcs_path(gcs_path: str) -> tuple[str, str]:
+    """Splits "gs://bucket/some/object" into ("bucket", "some/object")."""
+    if not gcs_path.startswith("gs://"):
+        raise ValueError(f"Not a gs:// path: {gcs_path}")
+    bucket, _, obj = gcs_path[len("gs://") :].partition("/")
+    if not bucket or not obj:
+        raise ValueError(f"Expected gs://BUCKET/OBJECT, got: {gcs_path}")
+    return bucket, obj
+
+
+##### gsutil
+
+
+class GsutilLockStore:
+    """Lock store that shells out to `gsutil` for every operation.
+
+    Requires the `gsutil` command (raises FileNotFoundError otherwise).
+    `gsutil cp -v` prints the generation it wrote, but `gsutil cat` doesn't
+    print the one it read, so reads take an extra `gsutil stat`.
+    """
+
+    def stat(self, gcs_path: str) -> Optional[ObjectMeta]:
+        result = subprocess.run(
+            ["gsutil", "stat", gcs_path], text=True, stdout=subprocess.PIPE
+        )
+        if result.returncode != 0:
+            return None
+        fields = dict(
+            re.findall(
+                r"^\s*(Generation|Metageneration):\s*(\d+)",
+                result.stdout,
+                re.MULTILINE,
+            )
+        )
+        if "Generation" not in fields:
+            return None
+        return ObjectMeta(
+            int(fields["Generation"]), int(fields.get("Metageneration", 1))
+        )
+
+    def _stat_generation(self, gcs_path: str) -> Optional[int]:
+        meta = self.stat(gcs_path)
+        return meta.generation if meta else None
+
+    def _create(
+        self, gcs_path: str, data: str, if_generation: int = 0
+    ) -> Optional[int]:
+        precondition = f"x-goog-if-generation-match:{if_generation}"
+        # -v prints "Created: gs://BUCKET/OBJECT#GENERATION", which saves a
+        # `gsutil stat` (another ~1-2s of startup)
+        cp_result = subprocess.run(
+            ["gsutil", "-h", precondition, "cp", "-v", "-", gcs_path],
+            text=True,
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # still show gsutil's progress and errors
+        sys.stderr.write(cp_result.stderr)
+        if cp_result.returncode != 0:
+            return None
+        return self._created_generation(cp_result.stdout + cp_result.stderr, gcs_path)
+
+    def _created_generation(self, cp_output: str, gcs_path: str) -> int:
+        match = re.search(rf"Created: {re.escape(gcs_path)}#(\d+)", cp_output)
+        if match:
+            return int(match.group(1))
+        # in case some gsutil version prints it differently
+        generation = self._stat_generation(gcs_path)
+        if generation is None:
+            raise RuntimeError(f"Wrote {gcs_path} but couldn't stat it.")
+        return generation
+
+    def _read(self, gcs_path: str) -> Optional[tuple[str, int]]:
+        generation = self._stat_generation(gcs_path)
+        if generation is None:
+            return None
+        # Read that exact generation, so the data matches it.
+        cat_result = subprocess.run(
+            ["gsutil", "cat", f"{gcs_path}#{generation}"],
+            text=True,
+            stdout=subprocess.PIPE,
+        )
+        if cat_result.returncode != 0:
+            return None
+        return cat_result.stdout, generation
+
+    def acquire(
+        self, gcs_path: str, data: str, expect_held: bool = False
+    ) -> LockResult:
+        read_first = expect_held
+        for _ in range(MAX_ACQUIRE_ROUNDS):
+            if not read_first:
+                generation = self._create(gcs_path, data)
+                if generation is not None:
+                    return LockResult(True, None, generation)
+                print("Lock acquisition failed. Attempting to get lock data...")
+            read_first = False
+
+            existing = self._read(gcs_path)
+            if existing is not None:
+                print("Got existing lock state.")
+                return LockResult(False, *existing)
+            # The lock was released in between `gsutil cp` and `gsutil cat`.
+            # Try again rather than making the caller back off.
+            print("Lock disappeared before we could read it. Retrying...")
+
+        return LockResult(False, None)
+
+    def replace(self, gcs_path: str, data: str, generation: int) -> Optional[int]:
+        return self._create(gcs_path, data, if_generation=generation)
+
+    def release(self, gcs_path: str) -> None:
+        subprocess.run(["gsutil", "rm", gcs_path], check=True)
+
+    def release_generation(self, gcs_path: str, generation: int) -> bool:
+        precondition = f"x-goog-if-generation-match:{generation}"
+        rm_result = subprocess.run(["gsutil", "-h", precondition, "rm", gcs_path])
+        return rm_result.returncode == 0
+
+    def list_objects(self, gcs_prefix: str) -> list[ListedObject]:
+        # -L prints each object's generation and custom metadata. Not -a: in
+        # a versioned bucket that lists deleted objects' old versions too.
+        ls_result = subprocess.run(
+            ["gsutil", "ls", "-L", f"{gcs_prefix}**"],
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if ls_result.returncode != 0:
+            if "matched no objects" in ls_result.stderr:
+                return []
+            raise RuntimeError(f"gsutil ls failed: {ls_result.stderr}")
+        return sorted(_parse_ls_long(ls_result.stdout))
+
+    def update_metadata(self, gcs_path: str, metadata: dict[str, str]) -> bool:
+        # unlike cp's, setmeta's -h is an option of the command itself
+        args = ["gsutil", "setmeta"]
+        for key, value in metadata.items():
+            args += ["-h", f"x-goog-meta-{key}:{value}"]
+        setmeta_result = subprocess.run(args + [gcs_path])
+        return setmeta_result.returncode == 0
+
+
+def _parse_ls_long(output: str) -> Iterator[ListedObject]:
+    """Parses `gsutil ls -L` output, which looks like:
+
+    gs://bucket/object:
+        Creation time:          Tue, 02 Jan 2024 03:04:05 GMT
+        ...
+        Metadata:
+            expires:            1704164645.0
+        Generation:             1704164585123456
+        Metageneration:         2
+    """
+    gcs_path: Optional[str] = None
+    generation: Optional[int] = None
+    metadata: dict[str, str] = {}
+    in_metadata = False
+    for line in output.splitlines() + ["gs://end:"]:
+        if line.startswith("gs://") and line.endswith(":"):
+            if gcs_path is not None and generation is not None:
+                yield ListedObject(gcs_path, generation, metadata)
+            gcs_path, generation, metadata = line[:-1], None, {}
+            in_metadata = False
+            continue
+        field = line.strip()
+        indent = len(line) - len(line.lstrip())
+        if in_metadata and indent > 4:
+            key, _, value = field.partition(":")
+            metadata[key] = value.strip()
+            continue
+        in_metadata = field == "Metadata:"
+        if match := re.fullmatch(r"Generation:\s*(\d+)", field):
+            generation = int(match.group(1))
+
+
+##### GCS JSON API
+
+
+class GcsApiError(Exception):
+    def __init__(self, method: str, url: str, status: int, body: bytes):
+        super().__init__(f"{method} {url} -> HTTP {status}: {body[:500]!r}")
+        self.status = status
+
+
+class _HttpResponse(NamedTuple):
+    status: int
+    headers: http.client.HTTPMessage
+    body: bytes
+
+
+class _HttpConnectionPool:
+    """Keeps one persistent HTTP(S) connection per thread.
+
+    http.client connections aren't thread-safe, and a per-thread connection is
+    all the pooling we need: lock operations on a thread are sequential.
+    """
+
+    def __init__(self, endpoint: str, timeout: float):
+        parts = urllib.parse.urlsplit(endpoint)
+        self._connection_cls = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connection_cls(self._netloc, timeout=self._timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[dict[str, str]] = None,
+        retry: bool = True,
+    ) -> _HttpResponse:
+        """With `retry`, a request that fails on a connection error is resent
+        once, on a fresh connection: a kept-alive connection may have been
+        closed by the server since we last used it. Requests that aren't safe
+        to send twice should pass retry=False and handle the error."""
+        url = self.base_path + url
+        for attempt in range(2 if retry else 1):
+            conn = self._connection()
+            try:
+                conn.request(method, url, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                return _HttpResponse(resp.status, resp.headers, resp.read())
+            except (ConnectionError, http.client.CannotSendRequest):
+                conn.close()
+                self._local.conn = None
+                if attempt > 0 or not retry:
+                    raise
+        assert False, "unreachable"
+
+
+class GcloudTokenProvider:
+    """Gets an OAuth access token from GCS_ACCESS_TOKEN or `gcloud`.
+
+    `gcloud auth print-access-token` is only run once per `refresh_after`
+    seconds, not per lock operation. Tokens are valid for an hour.
+    """
+
+    def __init__(self, refresh_after: float = 45 * 60):
+        self._refresh_after = refresh_after
+        self._token: Optional[str] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> Optional[str]:
+        if token := os.environ.get("GCS_ACCESS_TOKEN"):
+            return token
+        with self._lock:
+            if (
+                self._token is None
+                or time.monotonic() - self._fetched_at > self._refresh_after
+            ):
+                result = subprocess.run(
+                    ["gcloud", "auth", "print-access-token"],
+                    text=True,
+                    stdout=subprocess.PIPE,
+                    check=True,
+                )
+                self._token = result.stdout.strip()
+                self._fetched_at = time.monotonic()
+            return self._token
+
+
+GCS_API_ENDPOINT = "https://storage.googleapis.com"
+
+
+class GcsJsonApiLockStore:
+    """Lock store that uses the GCS JSON API over persistent connections.
+
+    https://cloud.google.com/storage/docs/json_api/v1/objects
+    """
+
+    def __init__(
+        self,
+        endpoint: Optional[str] = None,
+        token_provider: Optional[Callable[[], Optional[str]]] = None,
+        timeout: float = 30,
+    ):
+        emulator_host = os.environ.get("STORAGE_EMULATOR_HOST")
+        if endpoint is None and emulator_host:
+            endpoint = emulator_host
+        if endpoint is None:
+            endpoint = GCS_API_ENDPOINT
+        elif token_provider is None:
+            # emulators / stand-in servers don't need auth
+            token_provider = lambda: None  # noqa: E731
+        if "://" not in endpoint:
+            endpoint = f"http://{endpoint}"
+        self.endpoint = endpoint
+        self._token_provider = token_provider or GcloudTokenProvider()
+        self._pool = _HttpConnectionPool(endpoint, timeout)
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[dict[str, str]] = None,
+        retry: bool = True,
+    ) -> _HttpResponse:
+        headers = dict(headers or {})
+        if token := self._token_provider():
+            headers["Authorization"] = f"Bearer {token}"
+        return self._pool.request(method, url, body=body, headers=headers, retry=retry)
+
+    @staticmethod
+    def _object_url(gcs_path: str) -> str:
+        bucket, obj = split_gcs_path(gcs_path)
+        return f"/storage/v1/b/{bucket}/o/{urllib.parse.quote(obj, safe='')}"
+
+    def _create(
+        self, gcs_path: str, data: str, if_generation: int = 0
+    ) -> Optional[int]:
+        """Uploads `data` if the generation matches. Returns new generation,
+        or None if the precondition failed."""
+        try:
+            return self._upload(gcs_path, data, if_generation)
+        except (ConnectionError, http.client.CannotSendRequest):
+            pass
+        # We don't know if the upload landed. Resending it blindly would get a
+        # 412 if it did, and we'd think our own lock was someone else's. So
+        # look at what's there now (lock data is unique per deploy).
+        existing = self._read(gcs_path)
+        current_generation = existing[1] if existing is not None else 0
+        if current_generation == if_generation:
+            # it didn't land, and the precondition still holds
+            return self._upload(gcs_path, data, if_generation)
+        if existing is not None and existing[0] == data:
+            return current_generation
+        return None
+
+    def _upload(self, gcs_path: str, data: str, if_generation: int) -> Optional[int]:
+        bucket, obj = split_gcs_path(gcs_path)
+        query = urllib.parse.urlencode(
+            {
+                "uploadType": "media",
+                "name": obj,
+                "ifGenerationMatch": str(if_generation),
+            }
+        )
+        url = f"/upload/storage/v1/b/{bucket}/o?{query}"
+        resp = self._request(
+            "POST",
+            url,
+            body=data.encode(),
+            headers={"Content-Type": "application/json"},
+            retry=False,
+        )
+        if resp.status == 412:
+            return None
+        if resp.status != 200:
+            raise GcsApiError("POST", url, resp.status, resp.body)
+        return int(json.loads(resp.body)["generation"])
+
+    def _read(self, gcs_path: str) -> Optional[tuple[str, int]]:
+        """Returns (data, generation), or None if the object doesn't exist.
+
+        The generation comes back in the same response as the data, so it's
+        always the generation that `data` belongs to.
+        """
+        url = f"{self._object_url(gcs_path)}?alt=media"
+        resp = self._request("GET", url)
+        if resp.status == 404:
+            return None
+        if resp.status != 200:
+            raise GcsApiError("GET", url, resp.status, resp.body)
+        return resp.body.decode(), int(resp.headers["x-goog-generation"])
+
+    def acquire(
+        self, gcs_path: str, data: str, expect_held: bool = False
+    ) -> LockResult:
+        read_first = expect_held
+        for _ in range(MAX_ACQUIRE_ROUNDS):
+            if not read_first:
+                generation = self._create(gcs_path, data)
+                if generation is not None:
+                    return LockResult(True, None, generation)
+                print("Lock acquisition failed. Attempting to get lock data...")
+            read_first = False
+
+            existing = self._read(gcs_path)
+            if existing is not None:
+                print("Got existing lock state.")
+                return LockResult(False, *existing)
+            # The lock was released in between our create and read. Try again
+            # rather than making the caller back off.
+            print("Lock disappeared before we could read it. Retrying...")
+
+        return LockResult(False, None)
+
+    def replace(self, gcs_path: str, data: str, generation: int) -> Optional[int]:
+        return self._create(gcs_path, data, if_generation=generation)
+
+    def stat(self, gcs_path: str) -> Optional[ObjectMeta]:
+        url = f"{self._object_url(gcs_path)}?fields=generation,metageneration"
+        resp = self._request("GET", url)
+        if resp.status == 404:
+            return None
+        if resp.status != 200:
+            raise GcsApiError("GET", url, resp.status, resp.body)
+        resource = json.loads(resp.body)
+        return ObjectMeta(
+            int(resource["generation"]), int(resource["metageneration"])
+        )
+
+    def release(self, gcs_path: str) -> None:
+        url = self._object_url(gcs_path)
+        resp = self._request("DELETE", url)
+        if resp.status not in (200, 204):
+            raise GcsApiError("DELETE", url, resp.status, resp.body)
+
+    def release_generation(self, gcs_path: str, generation: int) -> bool:
+        url = f"{self._object_url(gcs_path)}?ifGenerationMatch={generation}"
+        resp = self._request("DELETE", url)
+        if resp.status in (404, 412):
+            return False
+        if resp.status not in (200, 204):
+            raise GcsApiError("DELETE", url, resp.status, resp.body)
+        return True
+
+    def list_objects(self, gcs_prefix: str) -> list[ListedObject]:
+        bucket, prefix = split_gcs_path(gcs_prefix)
+        listed = []
+        page_token = None
+        while True:
+            params = {
+                "prefix": prefix,
+                "fields": "items(name,generation,metadata),nextPageToken",
+            }
+            if page_token:
+                params["pageToken"] = page_token
+            url = f"/storage/v1/b/{bucket}/o?{urllib.parse.urlencode(params)}"
+            resp = self._request("GET", url)
+            if resp.status != 200:
+                raise GcsApiError("GET", url, resp.status, resp.body)
+            page = json.loads(resp.body)
+            for item in page.get("items", []):
+                listed.append(
+                    ListedObject(
+                        f"gs://{bucket}/{item['name']}",
+                        int(item["generation"]),
+                        item.get("metadata", {}),
+                    )
+                )
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return listed
+
+    def update_metadata(self, gcs_path: str, metadata: dict[str, str]) -> bool:
+        url = self._object_url(gcs_path)
+        resp = self._request(
+            "PATCH",
+            url,
+            body=json.dumps({"metadata": metadata}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        if resp.status == 404:
+            return False
+        if resp.status != 200:
+            raise GcsApiError("PATCH", url, resp.status, resp.body)
+        return True
+
+
+##### local backends
+
+
+def _next_generation(last: int) -> int:
+    # Like GCS, use creation times in microseconds (which queue tickets rely
+    # on), but always move forward.
+    return max(last + 1, time.time_ns() // 1000)
+
+
+class _StoredObject(NamedTuple):
+    data: str
+    generation: int
+    metageneration: int = 1
+    metadata: dict[str, str] = {}
+
+
+class InMemoryLockStore:
+    """Lock store backed by a dict, for tests and benchmarks.
+
+    Only shared between threads of one process. Every operation is atomic, so
+    acquire never has to retry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects: dict[str, _StoredObject] = {}
+        self._last_generation = 0
+
+    def _put(self, gcs_path: str, data: str) -> int:
+        self._last_generation = _next_generation(self._last_generation)
+        self._objects[gcs_path] = _StoredObject(data, self._last_generation)
+        return self._last_generation
+
+    def acquire(
+        self, gcs_path: str, data: str, expect_held: bool = False
+    ) -> LockResult:
+        # raise the same errors as the other stores
+        split_gcs_path(gcs_path)
+        with self._lock:
+            existing = self._objects.get(gcs_path)
+            if existing is not None:
+                return LockResult(False, existing.data, existing.generation)
+            return LockResult(True, None, self._put(gcs_path, data))
+
+    def replace(self, gcs_path: str, data: str, generation: int) -> Optional[int]:
+        with self._lock:
+            existing = self._objects.get(gcs_path)
+            if existing is None or existing.generation != generation:
+                return None
+            return self._put(gcs_path, data)
+
+    def stat(self, gcs_path: str) -> Optional[ObjectMeta]:
+        with self._lock:
+            existing = self._objects.get(gcs_path)
+        if existing is None:
+            return None
+        return ObjectMeta(existing.generation, existing.metageneration)
+
+    def release(self, gcs_path: str) -> None:
+        with self._lock:
+            del self._objects[gcs_path]
+
+    def release_generation(self, gcs_path: str, generation: int) -> bool:
+        with self._lock:
+            existing = self._objects.get(gcs_path)
+            if existing is None or existing.generation != generation:
+                return False
+            del self._objects[gcs_path]
+            return True
+
+    def list_objects(self, gcs_prefix: str) -> list[ListedObject]:
+        with self._lock:
+            return [
+                ListedObject(path, obj.generation, obj.metadata)
+                for path, obj in sorted(self._objects.items())
+                if path.startswith(gcs_prefix)
+            ]
+
+    def update_metadata(self, gcs_path: str, metadata: dict[str, str]) -> bool:
+        with self._lock:
+            existing = self._objects.get(gcs_path)
+            if existing is None:
+                return False
+            self._objects[gcs_path] = existing._replace(
+                metageneration=existing.metageneration + 1,
+                metadata={**existing.metadata, **metadata},
+            )
+            return True
+
+
+class LocalFileLockStore:
+    """Lock store backed by files under `root`, e.g. for locking between
+    processes on one machine.
+
+    gs://BUCKET/OBJECT is stored at ROOT/BUCKET/OBJECT, as JSON holding the
+    data, generation, and metadata. Objects are always written to a temp file
+    first, so readers never see partial writes:
+    - creating links the temp file into place, which fails if the object
+      already exists (like O_EXCL, but for a complete file)
+    - conditional updates and deletes hold an flock on ROOT/BUCKET/.lock
+      while they check the generation
+    - generations come from ROOT/BUCKET/.generations/OBJECT, the highest
+      the object has had, under the same flock, so a stale holder's
+      generation is never reused (e.g. after a clock step backwards)
+
+    Object names starting with "." aren't supported.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, gcs_path: str) -> str:
+        bucket, obj = split_gcs_path(gcs_path)
+        return os.path.join(self.root, bucket, obj)
+
+    @contextlib.contextmanager
+    def _bucket_lock(self, gcs_path: str) -> Iterator[None]:
+        bucket, _ = split_gcs_path(gcs_path)
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+        with open(os.path.join(self.root, bucket, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self, gcs_path: str) -> Optional[_StoredObject]:
+        try:
+            with open(self._path(gcs_path)) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return None
+        return _StoredObject(**stored)
+
+    def _write_temp(self, gcs_path: str, obj: _StoredObject) -> str:
+        bucket, _ = split_gcs_path(gcs_path)
+        temp_dir = os.path.join(self.root, bucket, ".tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+        with open(temp_path, "w") as f:
+            json.dump(obj._asdict(), f)
+        return temp_path
+
+    def _claim_generation(self, gcs_path: str) -> int:
+        # callers hold the bucket lock
+        bucket, obj = split_gcs_path(gcs_path)
+        path = os.path.join(self.root, bucket, ".generations", obj)
+        try:
+            with open(path) as f:
+                last = int(f.read())
+        except FileNotFoundError:
+            last = 0
+        generation = _next_generation(last)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(self.root, bucket, ".tmp", uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        with open(temp_path, "w") as f:
+            f.write(str(generation))
+        os.replace(temp_path, path)
+        return generation
+
+    def _create(self, gcs_path: str, data: str) -> Optional[int]:
+        with self._bucket_lock(gcs_path):
+            generation = self._claim_generation(gcs_path)
+        temp_path = self._write_temp(gcs_path, _StoredObject(data, generation))
+        path = self._path(gcs_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            return None
+        finally:
+            os.unlink(temp_path)
+        return generation
+
+    def _overwrite(self, gcs_path: str, obj: _StoredObject) -> None:
+        # callers hold the bucket lock
+        os.replace(self._write_temp(gcs_path, obj), self._path(gcs_path))
+
+    def acquire(
+        self, gcs_path: str, data: str, expect_held: bool = False
+    ) -> LockResult:
+        read_first = expect_held
+        for _ in range(MAX_ACQUIRE_ROUNDS):
+            if not read_first:
+                generation = self._create(gcs_path, data)
+                if generation is not None:
+                    return LockResult(True, None, generation)
+            read_first = False
+
+            existing = self._load(gcs_path)
+            if existing is not None:
+                return LockResult(False, existing.data, existing.generation)
+            # The lock was released in between our create and read.
+
+        return LockResult(False, None)
+
+    def replace(self, gcs_path: str, data: str, generation: int) -> Optional[int]:
+        with self._bucket_lock(gcs_path):
+            existing = self._load(gcs_path)
+            if existing is None or existing.generation != generation:
+                return None
+            new_generation = self._claim_generation(gcs_path)
+            self._overwrite(gcs_path, _StoredObject(data, new_generation))
+            return new_generation
+
+    def stat(self, gcs_path: str) -> Optional[ObjectMeta]:
+        existing = self._load(gcs_path)
+        if existing is None:
+            return None
+        return ObjectMeta(existing.generation, existing.metageneration)
+
+    def release(self, gcs_path: str) -> None:
+        with self._bucket_lock(gcs_path):
+            os.unlink(self._path(gcs_path))
+
+    def release_generation(self, gcs_path: str, generation: int) -> bool:
+        with self._bucket_lock(gcs_path):
+            existing = self._load(gcs_path)
+            if existing is None or existing.generation != generation:
+                return False
+            os.unlink(self._path(gcs_path))
+            return True
+
+    def list_objects(self, gcs_prefix: str) -> list[ListedObject]:
+        bucket, prefix = split_gcs_path(gcs_prefix)
+        bucket_dir = os.path.join(self.root, bucket)
+        listed = []
+        for dirpath, dirnames, filenames in os.walk(bucket_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), bucket_dir)
+                gcs_path = f"gs://{bucket}/{name}"
+                if not name.startswith(prefix):
+                    continue
+                existing = self._load(gcs_path)
+                if existing is not None:
+                    listed.append(
+                        ListedObject(gcs_path, existing.generation, existing.metadata)
+                    )
+        return sorted(listed)
+
+    def update_metadata(self, gcs_path: str, metadata: dict[str, str]) -> bool:
+        with self._bucket_lock(gcs_path):
+            existing = self._load(gcs_path)
+            if existing is None:
+                return False
+            self._overwrite(
+                gcs_path,
+                existing._replace(
+                    metageneration=existing.metageneration + 1,
+                    metadata={**existing.metadata, **metadata},
+                ),
+            )
+            return True
+
+
+@functools.lru_cache(maxsize=None)
+def default_lock_store() -> LockStore:
+    """JSON API store if we can authenticate (or there's an emulator), else gsutil.
+
+    Cached so that all locks in a process share one connection pool.
+    """
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        return GcsJsonApiLockStore()
+    token_provider = GcloudTokenProvider()
+    try:
+        token = token_provider()
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f"Couldn't get a GCS access token ({e}).")
+        token = None
+    if token:
+        return GcsJsonApiLockStore(token_provider=token_provider)
+    print("Falling back to gsutil for GCS locking.")
+    return GsutilLockStore()
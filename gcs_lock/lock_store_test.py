@@ -0,0 +1,269 @@
+import subprocess
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pytest
+
+from gcs_lock.fake_gcs_server import FakeGcsServer
+from gcs_lock.lock_store import (
+    GcsApiError,
+    GcsJsonApiLockStore,
+    GsutilLockStore,
+    InMemoryLockStore,
+    LocalFileLockStore,
+    LockStore,
+    split_gcs_path,
+)
+
+
+@pytest.fixture
+def json_store() -> Iterator[GcsJsonApiLockStore]:
+    with FakeGcsServer() as server:
+        yield GcsJsonApiLockStore(endpoint=server.endpoint)
+
+
+@pytest.fixture(params=['json', 'memory', 'file'])
+def any_store(request: pytest.FixtureRequest, tmp_path: Path) -> Iterator[LockStore]:
+    if request.param == 'json':
+        with FakeGcsServer() as server:
+            yield GcsJsonApiLockStore(endpoint=server.endpoint)
+    elif request.param == 'memory':
+        yield InMemoryLockStore()
+    else:
+        yield LocalFileLockStore(str(tmp_path))
+
+
+def test_split_gcs_path() -> None:
+    assert split_gcs_path('gs://bucket/a/b.json') == ('bucket', 'a/b.json')
+    with pytest.raises(ValueError):
+        split_gcs_path('gs://bucket')
+    with pytest.raises(ValueError):
+        split_gcs_path('/local/path')
+
+
+def test_json_store__acquire_free_lock(json_store: GcsJsonApiLockStore) -> None:
+    result = json_store.acquire('gs://b/lock.json', '{"a": 1}')
+    assert result.acquired
+    assert result.existing_state is None
+
+
+def test_json_store__acquire_held_lock_returns_state(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    assert json_store.acquire('gs://b/lock.json', '{"a": 1}').acquired
+    result = json_store.acquire('gs://b/lock.json', '{"a": 2}')
+    assert not result.acquired
+    assert result.existing_state == '{"a": 1}'
+
+
+def test_json_store__release_then_reacquire(json_store: GcsJsonApiLockStore) -> None:
+    assert json_store.acquire('gs://b/lock.json', '{"a": 1}').acquired
+    json_store.release('gs://b/lock.json')
+    assert json_store.acquire('gs://b/lock.json', '{"a": 2}').acquired
+
+
+def test_json_store__release_missing_lock_raises(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    with pytest.raises(GcsApiError) as e:
+        json_store.release('gs://b/lock.json')
+    assert e.value.status == 404
+
+
+def test_json_store__held_lock_result_has_generation(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    ours = json_store.acquire('gs://b/lock.json', '{"a": 1}')
+    assert ours.generation is not None
+    theirs = json_store.acquire('gs://b/lock.json', '{"a": 2}')
+    assert theirs.generation == ours.generation
+
+
+def test_json_store__expect_held_is_one_round_trip() -> None:
+    with FakeGcsServer() as server:
+        store = GcsJsonApiLockStore(endpoint=server.endpoint)
+        assert store.acquire('gs://b/lock.json', '{"a": 1}').acquired
+        before = server.request_count
+        result = store.acquire('gs://b/lock.json', '{"a": 2}', expect_held=True)
+        assert result.existing_state == '{"a": 1}'
+        assert server.request_count - before == 1
+
+
+def test_json_store__expect_held_acquires_free_lock(
+    json_store: GcsJsonApiLockStore,
+) -> None:
+    assert json_store.acquire('gs://b/lock.json', '{}', expect_held=True).acquired
+
+
+def test_json_store__retries_if_lock_released_before_read(
+    json_store: GcsJsonApiLockStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    assert json_store.acquire('gs://b/lock.json', '{"a": 1}').acquired
+    real_read = json_store._read
+
+    def read_after_holder_releases(gcs_path: str) -> Optional[tuple[str, int]]:
+        json_store.release(gcs_path)
+        monkeypatch.setattr(json_store, '_read', real_read)
+        return real_read(gcs_path)
+
+    monkeypatch.setattr(json_store, '_read', read_after_holder_releases)
+    assert json_store.acquire('gs://b/lock.json', '{"a": 2}').acquired
+
+
+def test_json_store__create_lands_but_response_is_lost() -> None:
+    with FakeGcsServer() as server:
+        store = GcsJsonApiLockStore(endpoint=server.endpoint)
+        server.drop_upload_responses()
+        ours = store.acquire('gs://b/lock.json', '{"a": 1}')
+        assert ours.acquired
+        assert store.stat('gs://b/lock.json').generation == ours.generation
+
+
+def test_json_store__lost_create_response_for_held_lock() -> None:
+    with FakeGcsServer() as server:
+        store = GcsJsonApiLockStore(endpoint=server.endpoint)
+        theirs = store.acquire('gs://b/lock.json', '{"a": 1}')
+        server.drop_upload_responses()
+        result = store.acquire('gs://b/lock.json', '{"a": 2}')
+        assert not result.acquired
+        assert result.existing_state == '{"a": 1}'
+        assert result.generation == theirs.generation
+
+
+def test_gsutil_store__acquire_takes_generation_from_cp(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    commands = []
+
+    def fake_run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        commands.append(args)
+        stderr = 'Copying from <STDIN>...\nCreated: gs://b/lock.json#1234\n'
+        return subprocess.CompletedProcess(args, 0, '', stderr)
+
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    result = GsutilLockStore().acquire('gs://b/lock.json', '{}')
+    assert result.acquired and result.generation == 1234
+    assert [args[3:5] for args in commands] == [['cp', '-v']]
+
+
+GSUTIL_LS_LONG = """\
+gs://b/queue/2:
+    Creation time:          Tue, 02 Jan 2024 03:04:06 GMT
+    Update time:            Tue, 02 Jan 2024 03:04:06 GMT
+    Storage class:          STANDARD
+    Content-Length:         2
+    Content-Type:           application/octet-stream
+    Hash (crc32c):          AAAAAA==
+    Hash (md5):             mZFLkyvTelC5g8XnyQrpOw==
+    ETag:                   CID7ltGS+4MDEAE=
+    Generation:             1704164646000002
+    Metageneration:         1
+gs://b/queue/1:
+    Creation time:          Tue, 02 Jan 2024 03:04:05 GMT
+    Metadata:
+        expires:            1704164705.5
+        note:               a:b
+    Generation:             1704164645000001
+    Metageneration:         2
+TOTAL: 2 objects, 4 bytes (4 B)
+"""
+
+
+def test_gsutil_store__list_objects_and_update_metadata(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    commands = []
+
+    def fake_run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        commands.append(args)
+        if args[1] == 'ls':
+            return subprocess.CompletedProcess(args, 0, GSUTIL_LS_LONG, '')
+        return subprocess.CompletedProcess(args, 0 if 'gs://b/queue/1' in args else 1)
+
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    store = GsutilLockStore()
+    listed = store.list_objects('gs://b/queue/')
+    assert commands[-1] == ['gsutil', 'ls', '-L', 'gs://b/queue/**']
+    assert [(o.gcs_path, o.generation) for o in listed] == [
+        ('gs://b/queue/1', 1704164645000001),
+        ('gs://b/queue/2', 1704164646000002),
+    ]
+    assert listed[0].metadata == {'expires': '1704164705.5', 'note': 'a:b'}
+    assert listed[1].metadata == {}
+    assert store.update_metadata('gs://b/queue/1', {'expires': '123'})
+    assert commands[-1] == [
+        'gsutil', 'setmeta', '-h', 'x-goog-meta-expires:123', 'gs://b/queue/1'
+    ]
+    assert not store.update_metadata('gs://b/queue/3', {'expires': '123'})
+
+
+def test_gsutil_store__list_no_objects(monkeypatch: pytest.MonkeyPatch) -> None:
+    def fake_run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        stderr = 'CommandException: One or more URLs matched no objects.\n'
+        return subprocess.CompletedProcess(args, 1, '', stderr)
+
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    assert GsutilLockStore().list_objects('gs://b/queue/') == []
+
+
+def test_lock_store__acquire_and_release(any_store: LockStore) -> None:
+    ours = any_store.acquire('gs://b/dir/lock.json', '{"a": 1}')
+    assert ours.acquired and ours.generation is not None
+    for expect_held in (False, True):
+        theirs = any_store.acquire('gs://b/dir/lock.json', '{}', expect_held)
+        assert not theirs.acquired
+        assert theirs.existing_state == '{"a": 1}'
+        assert theirs.generation == ours.generation
+    any_store.release('gs://b/dir/lock.json')
+    assert any_store.stat('gs://b/dir/lock.json') is None
+    assert any_store.acquire('gs://b/dir/lock.json', '{}', expect_held=True).acquired
+
+
+def test_lock_store__generation_preconditions(any_store: LockStore) -> None:
+    first = any_store.acquire('gs://b/lock.json', '{"a": 1}').generation
+    assert first is not None
+    second = any_store.replace('gs://b/lock.json', '{"a": 2}', first)
+    assert second is not None and second != first
+    assert any_store.replace('gs://b/lock.json', '{"a": 3}', first) is None
+    assert any_store.acquire('gs://b/lock.json', '{}').existing_state == '{"a": 2}'
+    assert not any_store.release_generation('gs://b/lock.json', first)
+    assert any_store.release_generation('gs://b/lock.json', second)
+    assert not any_store.release_generation('gs://b/lock.json', second)
+
+
+@pytest.mark.parametrize('kind', ['memory', 'file'])
+def test_lock_store__generations_are_not_reused(
+    kind: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stores: list[LockStore] = [InMemoryLockStore()] * 2
+    if kind == 'file':
+        # as if in two processes
+        stores = [LocalFileLockStore(str(tmp_path)) for _ in range(2)]
+    now_ns = 2_000_000_000_000
+    monkeypatch.setattr(time, 'time_ns', lambda: now_ns)
+    stale = stores[0].acquire('gs://b/lock.json', '{"a": 1}').generation
+    assert stale is not None
+    stores[0].release('gs://b/lock.json')
+    # the clock steps back
+    now_ns -= 1_000_000_000
+    ours = stores[1].acquire('gs://b/lock.json', '{"a": 2}').generation
+    assert ours is not None and ours > stale
+    assert not stores[0].release_generation('gs://b/lock.json', stale)
+    assert stores[0].replace('gs://b/lock.json', '{"a": 3}', stale) is None
+    replaced = stores[1].replace('gs://b/lock.json', '{"a": 4}', ours)
+    assert replaced is not None and replaced > ours
+
+
+def test_lock_store__list_objects_and_update_metadata(any_store: LockStore) -> None:
+    first = any_store.acquire('gs://b/queue/1', '{}')
+    any_store.acquire('gs://b/queue/2', '{}')
+    any_store.acquire('gs://b/other', '{}')
+    assert any_store.update_metadata('gs://b/queue/1', {'expires': '123'})
+    assert not any_store.update_metadata('gs://b/queue/3', {'expires': '123'})
+    listed = any_store.list_objects('gs://b/queue/')
+    assert [o.gcs_path for o in listed] == ['gs://b/queue/1', 'gs://b/queue/2']
+    # metadata updates don't change the generation
+    assert listed[0].generation == first.generation
+    assert listed[0].metadata == {'expires': '123'}
+    assert listed[1].metadata == {}
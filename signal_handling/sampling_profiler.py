@@ -0,0 +1,174 @@
+"""A sampling profiler, grown from sighandler_traceback.py's stack dumps.
+
+setitimer sends SIGPROF every `interval` seconds of CPU time (or SIGALRM
+every `interval` seconds of wall time, with wall=True), and the handler
+counts the interrupted stack. Stacks are counted as tuples of code
+objects, so a sample is just a frame walk and a dict update; names are
+only formatted when dumping.
+
+SIGUSR2 (or dump()) writes the counts as collapsed stacks, one
+"outer;...;inner count" line per stack, for flamegraph.pl or speedscope:
+
+    kill -USR2 <pid>
+    flamegraph.pl /tmp/profile-<pid>.collapsed > profile.svg
+
+To attach it to a script, import it first thing, which starts it,
+configured by environment variables (see from_env):
+
+    import sampling_profiler
+
+or run the script under it:
+
+    python sampling_profiler.py some_script.py args...
+
+Python runs signal handlers in the main thread, between bytecodes, so a
+main thread stuck in a long C call is sampled late. Other threads are
+only sampled with all_threads=True.
+"""
+
+import atexit
+import os
+import runpy
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from types import CodeType, FrameType
+from typing import Optional
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        interval: float = 0.01,
+        wall: bool = False,
+        all_threads: bool = False,
+        dump_signal: int = signal.SIGUSR2,
+        output: Optional[str] = None,
+        max_depth: int = 256,
+    ):
+        self.interval = interval
+        self.timer, self.signal = (
+            (signal.ITIMER_REAL, signal.SIGALRM)
+            if wall
+            else (signal.ITIMER_PROF, signal.SIGPROF)
+        )
+        self.all_threads = all_threads
+        self.dump_signal = dump_signal
+        self.output = output or f"/tmp/profile-{os.getpid()}.collapsed"
+        self.max_depth = max_depth
+        # stack, innermost first -> samples
+        self.counts: Counter[tuple[CodeType, ...]] = Counter()
+        self.samples = 0
+        # seconds spent in the sampling handler
+        self.overhead = 0.0
+        self._previous_handlers: dict[int, object] = {}
+
+    @classmethod
+    def from_env(cls) -> "SamplingProfiler":
+        """Configured by SAMPLING_PROFILER_HZ (default 100),
+        SAMPLING_PROFILER_WALL=1, SAMPLING_PROFILER_ALL_THREADS=1 and
+        SAMPLING_PROFILER_OUTPUT (a path)."""
+        env = os.environ
+        return cls(
+            interval=1 / float(env.get("SAMPLING_PROFILER_HZ", 100)),
+            wall=env.get("SAMPLING_PROFILER_WALL") == "1",
+            all_threads=env.get("SAMPLING_PROFILER_ALL_THREADS") == "1",
+            output=env.get("SAMPLING_PROFILER_OUTPUT"),
+        )
+
+    def start(self) -> "SamplingProfiler":
+        """Starts sampling. Call from the main thread."""
+        handlers = {self.signal: self._sample, self.dump_signal: self._dump}
+        for sig, handler in handlers.items():
+            self._previous_handlers[sig] = signal.signal(sig, handler)
+        signal.setitimer(self.timer, self.interval, self.interval)
+        atexit.register(self._at_exit)
+        return self
+
+    def stop(self) -> None:
+        signal.setitimer(self.timer, 0)
+        for sig, handler in self._previous_handlers.items():
+            signal.signal(sig, handler)
+        self._previous_handlers.clear()
+        atexit.unregister(self._at_exit)
+
+    def _at_exit(self) -> None:
+        # the timer outlives our handler, and SIGPROF's default is to exit
+        self.stop()
+        self.dump()
+
+    def _sample(self, sig: int, frame: Optional[FrameType]) -> None:
+        start = time.perf_counter()
+        if self.all_threads:
+            frames = sys._current_frames()
+            # instead of this handler's own frame
+            frames[threading.get_ident()] = frame
+            stacks = frames.values()
+        else:
+            stacks = (frame,)
+        for f in stacks:
+            stack = []
+            while f is not None and len(stack) < self.max_depth:
+                stack.append(f.f_code)
+                f = f.f_back
+            self.counts[tuple(stack)] += 1
+        self.samples += 1
+        self.overhead += time.perf_counter() - start
+
+    def _dump(self, sig: int, frame: Optional[FrameType]) -> None:
+        self.dump()
+
+    def collapsed(self) -> list[str]:
+        """The counts as collapsed stack lines."""
+        names: dict[CodeType, str] = {}
+
+        def name(code: CodeType) -> str:
+            if code not in names:
+                # ';' separates frames (and the last ' ', the count)
+                names[code] = (
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{code.co_firstlineno})"
+                ).replace(";", ":")
+            return names[code]
+
+        return [
+            ";".join(name(code) for code in reversed(stack)) + f" {count}"
+            for stack, count in self.counts.most_common()
+        ]
+
+    def dump(self, path: Optional[str] = None) -> None:
+        """Writes the collapsed stacks to `path` (default self.output)."""
+        if not self.counts:
+            # e.g. a CPU time profile of a process that's been idle
+            print("sampling_profiler: no samples yet", file=sys.stderr)
+            return
+        path = path or self.output
+        with open(path, "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+        print(
+            f"sampling_profiler: wrote {self.samples} samples"
+            f" ({len(self.counts)} stacks) to {path}, overhead"
+            f" {1000 * self.overhead / self.samples:.3f}ms/sample",
+            file=sys.stderr,
+        )
+
+
+def main():
+    """Runs a script under the profiler: sampling_profiler.py script.py args"""
+    if len(sys.argv) < 2:
+        sys.exit(f"usage: {sys.argv[0]} script.py [args...]")
+    sys.argv = sys.argv[1:]
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+    PROFILER.start()
+    runpy.run_path(sys.argv[0], run_name="__main__")
+
+
+if __name__ == "__main__":
+    PROFILER = SamplingProfiler.from_env()
+    main()
+else:
+    # importing it is enough
+    PROFILER = SamplingProfiler.from_env().start()
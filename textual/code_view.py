@@ -0,0 +1,237 @@
+"""A code view for example_codeviewer.py that only highlights what's visible.
+
+Files are highlighted in chunks of CHUNK_LINES lines, in a worker thread,
+when a chunk first scrolls into view. Until then its lines show as plain
+text. Highlighted chunks are kept in an LRU cache keyed by path, mtime and
+chunk, so reopening a file, or scrolling back, doesn't highlight again.
+
+Each chunk is highlighted on its own, so a construct that spans chunks (a
+long docstring, say) can be colored wrong near a chunk boundary. Lines
+aren't wrapped.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from rich.console import Console, ConsoleOptions, RenderableType, RenderResult
+from rich.segment import Segment
+from rich.style import Style
+from rich.syntax import Syntax
+from rich.text import Text
+from rich.traceback import Traceback
+from textual import events
+from textual.reactive import Reactive
+from textual.widget import Widget
+
+CHUNK_LINES = 200
+LINE_NUMBER_STYLE = Style(dim=True)
+
+
+class SourceFile(NamedTuple):
+    path: str
+    mtime_ns: int
+    lines: list[str]
+    lexer: str
+
+
+@functools.lru_cache(maxsize=8)
+def load_source(path: str, mtime_ns: int) -> SourceFile:
+    """Reads a text file. Raises UnicodeDecodeError for binary files.
+
+    `mtime_ns` is only there to key the cache.
+    """
+    with open(path, encoding="utf-8") as f:
+        code = f.read()
+    # guessing from the start is enough, and doesn't scan a huge file
+    lexer = Syntax.guess_lexer(path, code[:10_000])
+    return SourceFile(path, mtime_ns, code.splitlines(), lexer)
+
+
+def highlight_chunk(source: SourceFile, chunk: int, theme: str) -> list[Text]:
+    start = chunk * CHUNK_LINES
+    lines = source.lines[start : start + CHUNK_LINES]
+    code = "\n".join(lines)
+    text = Syntax(code, source.lexer, theme=theme).highlight(code)
+    return text.split("\n", allow_blank=True)[: len(lines)]
+
+
+class ChunkKey(NamedTuple):
+    path: str
+    mtime_ns: int
+    chunk: int
+
+
+class HighlightCache:
+    """LRU cache of highlighted chunks."""
+
+    def __init__(self, max_chunks: int = 500):
+        self.max_chunks = max_chunks
+        self._chunks: OrderedDict[ChunkKey, list[Text]] = OrderedDict()
+
+    def get(self, key: ChunkKey) -> Optional[list[Text]]:
+        lines = self._chunks.get(key)
+        if lines is not None:
+            self._chunks.move_to_end(key)
+        return lines
+
+    def put(self, key: ChunkKey, lines: list[Text]) -> None:
+        self._chunks[key] = lines
+        self._chunks.move_to_end(key)
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+
+
+class CodeLines:
+    """Rich renderable for lines of code, cropped or padded to the width."""
+
+    def __init__(self, lines: list[Text], height: int, style: Style):
+        self.lines = lines
+        self.height = height
+        self.style = style
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        width = options.max_width
+        new_line = Segment.line()
+        for line in self.lines:
+            segments = list(line.render(console))
+            yield from Segment.adjust_line_length(segments, width, self.style)
+            yield new_line
+        for _ in range(self.height - len(self.lines)):
+            yield Segment(" " * width, self.style)
+            yield new_line
+
+
+class CodeView(Widget):
+    """Shows a file, scrolling itself and highlighting only what's visible."""
+
+    # first line shown
+    scroll_offset: Reactive[int] = Reactive(0)
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        theme: str = "monokai",
+        cache: Optional[HighlightCache] = None,
+    ):
+        super().__init__(name)
+        self.theme = theme
+        self.background = Syntax.get_theme(theme).get_background_style()
+        self.cache = cache or HighlightCache()
+        self.path: Optional[str] = None
+        self.source: Optional[SourceFile] = None
+        # shown instead of the source, if it couldn't be loaded
+        self.error: Optional[RenderableType] = None
+        # chunks being highlighted
+        self._pending: set[ChunkKey] = set()
+
+    async def open(self, path: str) -> None:
+        """Shows `path`, reading it in a worker thread."""
+        self.path = path
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            source = await asyncio.to_thread(load_source, path, mtime_ns)
+        except Exception:
+            if self.path == path:
+                # Possibly a binary file. Show the traceback, like
+                # Syntax.from_path failing would.
+                self.source = None
+                self.error = Traceback(theme=self.theme, width=None)
+                self.refresh()
+            return
+        if self.path != path:
+            # another file was opened while this one loaded
+            return
+        self.source = source
+        self.error = None
+        self.scroll_offset = 0
+        self.refresh()
+
+    def validate_scroll_offset(self, offset: int) -> int:
+        num_lines = len(self.source.lines) if self.source else 0
+        return max(0, min(offset, num_lines - self.size.height))
+
+    async def on_mouse_scroll_up(self, event: events.MouseScrollUp) -> None:
+        self.scroll_offset += 3
+
+    async def on_mouse_scroll_down(self, event: events.MouseScrollDown) -> None:
+        self.scroll_offset -= 3
+
+    async def on_key(self, event: events.Key) -> None:
+        page = max(self.size.height - 1, 1)
+        num_lines = len(self.source.lines) if self.source else 0
+        offsets = {
+            "down": self.scroll_offset + 1,
+            "up": self.scroll_offset - 1,
+            "pagedown": self.scroll_offset + page,
+            "pageup": self.scroll_offset - page,
+            "home": 0,
+            "end": num_lines,
+        }
+        if event.key in offsets:
+            self.scroll_offset = offsets[event.key]
+            event.stop()
+
+    def _chunk_key(self, chunk: int) -> ChunkKey:
+        assert self.source is not None
+        return ChunkKey(self.source.path, self.source.mtime_ns, chunk)
+
+    def request_chunk(self, chunk: int) -> None:
+        """Starts highlighting `chunk`, unless it's cached or in progress."""
+        assert self.source is not None
+        if not 0 <= chunk * CHUNK_LINES < len(self.source.lines):
+            return
+        key = self._chunk_key(chunk)
+        if key in self._pending or self.cache.get(key) is not None:
+            return
+        self._pending.add(key)
+        asyncio.create_task(self._highlight(self.source, key))
+
+    async def _highlight(self, source: SourceFile, key: ChunkKey) -> None:
+        try:
+            lines = await asyncio.to_thread(
+                highlight_chunk, source, key.chunk, self.theme
+            )
+        finally:
+            self._pending.discard(key)
+        self.cache.put(key, lines)
+        if self.source is source:
+            self.refresh()
+
+    def render(self) -> RenderableType:
+        if self.error is not None:
+            return self.error
+        height = self.size.height
+        if self.source is None:
+            return CodeLines([], height, self.background)
+        source_lines = self.source.lines
+        first = self.scroll_offset
+        last = min(first + height, len(source_lines))
+        number_width = len(str(len(source_lines)))
+        number_style = self.background + LINE_NUMBER_STYLE
+        lines = []
+        chunk_lines: Optional[list[Text]] = None
+        for n in range(first, last):
+            chunk, index = divmod(n, CHUNK_LINES)
+            if index == 0 or n == first:
+                chunk_lines = self.cache.get(self._chunk_key(chunk))
+                if chunk_lines is None:
+                    self.request_chunk(chunk)
+            if chunk_lines is not None:
+                line = chunk_lines[index]
+            else:
+                line = Text(source_lines[n], self.background)
+                line.expand_tabs(4)
+            number = Text(f"{n + 1:>{number_width}} ", number_style)
+            lines.append(Text.assemble(number, line))
+        # the next and previous pages, so scrolling doesn't show plain text
+        self.request_chunk((last + height) // CHUNK_LINES)
+        if first >= height:
+            self.request_chunk((first - height) // CHUNK_LINES)
+        return CodeLines(lines, height, self.background)
@@ -2,6 +2,8 @@ from textual.app import App
 from textual.reactive import Reactive
 from textual.widgets import Footer, Placeholder
 
+from render_profile import install_profiler
+
 
 class SmoothApp(App):
     """Demonstrates smooth animation. Press 'b' to see it in action."""
@@ -32,6 +34,9 @@ class SmoothApp(App):
 
         self.bar.layout_offset_x = -40
 
+        # "p" shows frame times, e.g. while the bar animates
+        await install_profiler(self)
+
         # self.set_timer(10, lambda: self.action("quit"))
 
 
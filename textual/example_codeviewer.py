@@ -1,19 +1,19 @@
 import os
 import sys
-from rich.console import RenderableType
-
-from rich.syntax import Syntax
-from rich.traceback import Traceback
 
 from textual.app import App
-from textual.widgets import Header, Footer, FileClick, ScrollView, DirectoryTree
+from textual.widgets import Header, Footer, FileClick, ScrollView
+
+from code_view import CodeView
+from lazy_directory_tree import LazyDirectoryTree
+from render_profile import install_profiler
 
 
 class MyApp(App):
     """An example of a very simple Textual App"""
 
     # where we show the code
-    code_view: ScrollView
+    code_view: CodeView
 
     async def on_load(self) -> None:
         """Sent before going in to application mode."""
@@ -34,9 +34,10 @@ class MyApp(App):
             )
 
         # Create our widgets
-        # In this a scroll view for the code and a directory tree
-        self.code_view = ScrollView()
-        directory = ScrollView(DirectoryTree(path, "Code"))
+        # In this a code view, which scrolls itself, and a directory tree
+        self.code_view = CodeView()
+        # lists directories in the background, a page at a time
+        directory = ScrollView(LazyDirectoryTree(path, "Code"))
 
         # Dock our widgets
         await self.view.dock(Header(), edge="top")
@@ -48,25 +49,15 @@ class MyApp(App):
         )
         await self.view.dock(self.code_view, edge="top")
 
-    async def handle_file_clickx(self, message: FileClick) -> None:
+        await install_profiler(self)
+
+    async def handle_file_click(self, message: FileClick) -> None:
         """A message sent by the directory tree when a file is clicked."""
 
-        syntax: RenderableType
-        try:
-            # Construct a Syntax object for the path in the message
-            syntax = Syntax.from_path(
-                message.path,
-                line_numbers=True,
-                word_wrap=True,
-                indent_guides=True,
-                theme="monokai",
-            )
-        except Exception:
-            # Possibly a binary file
-            # For demonstration purposes we will show the traceback
-            syntax = Traceback(theme="monokai", width=None, show_locals=True)
         self.app.sub_title = os.path.basename(message.path)
-        await self.code_view.update(syntax)
+        # Reads the file in a worker thread, then highlights what's visible.
+        # Binary files show a traceback.
+        await self.code_view.open(message.path)
 
 
 # Run our app class
@@ -0,0 +1,227 @@
+"""A DirectoryTree for big trees, for example_codeviewer.py.
+
+textual's DirectoryTree lists and sorts a whole directory on the event loop
+when it's expanded, adding nodes one at a time. LazyDirectoryTree instead:
+- lists directories with os.scandir in a worker thread, SCAN_BATCH entries
+  at a time, adding each batch to the tree as it arrives
+- shows PAGE_SIZE entries per directory, then a "… N more" node that shows
+  another page when clicked
+- polls the mtime of expanded directories every WATCH_INTERVAL seconds, and
+  re-lists only the ones that changed, keeping the nodes (and expanded
+  subdirectories) of entries that are still there
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import os
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from rich.console import RenderableType
+from rich.text import Text
+from textual.widgets import DirectoryTree, FileClick, TreeClick, TreeNode
+from textual.widgets._directory_tree import DirEntry
+from textual.widgets._tree_control import NodeID
+
+PAGE_SIZE = 200
+SCAN_BATCH = 500
+WATCH_INTERVAL = 2.0
+
+
+@dataclass
+class PageEntry(DirEntry):
+    """The "… N more" node after a page of a directory's entries."""
+
+    remaining: int = 0
+
+
+def _sort_key(entry: DirEntry) -> tuple[bool, str]:
+    # directories first, like DirectoryTree
+    return (not entry.is_dir, os.path.basename(entry.path))
+
+
+def _next_batch(entries: Iterator[os.DirEntry]) -> list[DirEntry]:
+    # is_dir() can stat, so this runs in a worker too
+    return [
+        DirEntry(entry.path, entry.is_dir())
+        for entry in itertools.islice(entries, SCAN_BATCH)
+    ]
+
+
+def _mtimes(paths: Iterable[str]) -> list[Optional[int]]:
+    mtimes: list[Optional[int]] = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+class LazyDirectoryTree(DirectoryTree):
+    def __init__(self, path: str, name: Optional[str] = None) -> None:
+        super().__init__(path, name=name)
+        # directory path -> its sorted entries, its node, how many entries
+        # are shown, and its mtime when it was last listed
+        self._listings: dict[str, list[DirEntry]] = {}
+        self._dir_nodes: dict[str, TreeNode[DirEntry]] = {}
+        self._limits: dict[str, int] = {}
+        self._mtimes: dict[str, Optional[int]] = {}
+        # directories being listed
+        self._scanning: set[str] = set()
+
+    async def on_mount(self, event) -> None:
+        await self.root.expand()
+        asyncio.create_task(self.scan(self.root))
+        self.set_interval(WATCH_INTERVAL, self.check_for_changes)
+
+    def render_node(self, node: TreeNode[DirEntry]) -> RenderableType:
+        if isinstance(node.data, PageEntry):
+            label = Text(str(node.label), style="dim italic")
+            label.apply_meta(
+                {"@click": f"click_label({node.id})", "tree_node": node.id}
+            )
+            return label
+        return super().render_node(node)
+
+    async def scan(self, node: TreeNode[DirEntry], stream: bool = True) -> None:
+        """Lists `node`'s directory in a worker thread.
+
+        With `stream`, shows entries as batches arrive. Otherwise (when
+        re-listing) only updates the tree once the listing is complete.
+        """
+        path = node.data.path
+        if path in self._scanning:
+            return
+        self._scanning.add(path)
+        self._dir_nodes[path] = node
+        node.loaded = True
+        try:
+            # before listing, so changes during the listing get noticed
+            [mtime] = await asyncio.to_thread(_mtimes, [path])
+            listing: list[DirEntry] = []
+            # the entries that sort first, while streaming
+            head: list[DirEntry] = []
+            entries = await asyncio.to_thread(os.scandir, path)
+            with entries:
+                while batch := await asyncio.to_thread(_next_batch, entries):
+                    listing.extend(batch)
+                    if stream:
+                        # only what's shown needs sorting until the end
+                        limit = self._limits.get(path, PAGE_SIZE)
+                        head = sorted(head + batch, key=_sort_key)[:limit]
+                        self._show_page(node, head, len(listing))
+            listing.sort(key=_sort_key)
+            self._show_page(node, listing)
+            self._mtimes[path] = mtime
+        except OSError as error:
+            self.log(f"can't list {path}: {error}")
+        finally:
+            self._scanning.discard(path)
+
+    async def check_for_changes(self) -> None:
+        """Re-lists expanded directories whose mtime changed."""
+        nodes = [
+            node
+            for path, node in self._dir_nodes.items()
+            if node.expanded and path not in self._scanning
+        ]
+        paths = [node.data.path for node in nodes]
+        mtimes = await asyncio.to_thread(_mtimes, paths)
+        for node, path, mtime in zip(nodes, paths, mtimes):
+            if mtime is None:
+                # gone; its parent's listing will drop it
+                continue
+            if mtime != self._mtimes.get(path):
+                asyncio.create_task(self.scan(node, stream=False))
+
+    def _show_page(
+        self,
+        node: TreeNode[DirEntry],
+        listing: list[DirEntry],
+        total: Optional[int] = None,
+    ) -> None:
+        """Shows the first page(s) of a directory's sorted `listing`, which
+        may be the start of `total` entries."""
+        path = node.data.path
+        self._listings[path] = listing
+        limit = self._limits.setdefault(path, PAGE_SIZE)
+        entries = listing[:limit]
+        remaining = (len(listing) if total is None else total) - len(entries)
+        if remaining > 0:
+            entries.append(PageEntry(path, False, remaining))
+        self._set_children(node, entries)
+        self.refresh(layout=True)
+
+    def _set_children(
+        self, parent: TreeNode[DirEntry], entries: list[DirEntry]
+    ) -> None:
+        """Makes `parent`'s children show `entries`, reusing existing nodes."""
+        existing = {
+            child.data.path: child
+            for child in parent.children
+            if not isinstance(child.data, PageEntry)
+        }
+        children = []
+        for entry in entries:
+            child = None
+            if not isinstance(entry, PageEntry):
+                child = existing.get(entry.path)
+            if child is None or child.data.is_dir != entry.is_dir:
+                child = self._new_node(parent, entry)
+            children.append(child)
+        kept = {id(child) for child in children}
+        for child in parent.children:
+            if id(child) not in kept:
+                self._forget(child)
+        parent.children = children
+        parent.tree.children = [child.tree for child in children]
+
+    def _new_node(
+        self, parent: TreeNode[DirEntry], entry: DirEntry
+    ) -> TreeNode[DirEntry]:
+        # like TreeControl.add, but leaves placing the node to the caller
+        if isinstance(entry, PageEntry):
+            label = f"… {entry.remaining} more"
+        else:
+            label = os.path.basename(entry.path)
+        self.id = NodeID(self.id + 1)
+        child_tree = parent.tree.add(label)
+        child: TreeNode[DirEntry] = TreeNode(
+            parent, self.id, self, child_tree, label, entry
+        )
+        child_tree.label = child
+        self.nodes[self.id] = child
+        return child
+
+    def _forget(self, node: TreeNode[DirEntry]) -> None:
+        """Drops a removed node and its descendants."""
+        for child in node.children:
+            self._forget(child)
+        del self.nodes[node.id]
+        if self.cursor == node.id:
+            assert node.parent is not None
+            self.cursor = node.parent.id
+        if not isinstance(node.data, PageEntry) and node.data.is_dir:
+            path = node.data.path
+            for state in (self._listings, self._dir_nodes, self._limits, self._mtimes):
+                state.pop(path, None)
+
+    async def handle_tree_click(self, message: TreeClick[DirEntry]) -> None:
+        node = message.node
+        entry = node.data
+        if isinstance(entry, PageEntry):
+            assert node.parent is not None
+            self._limits[entry.path] += PAGE_SIZE
+            # otherwise the listing in progress shows the new page
+            if entry.path not in self._scanning:
+                self._show_page(node.parent, self._listings[entry.path])
+        elif not entry.is_dir:
+            await self.emit(FileClick(self, entry.path))
+        elif not node.loaded:
+            await node.expand()
+            asyncio.create_task(self.scan(node))
+        else:
+            await node.toggle()
@@ -0,0 +1,172 @@
+"""Render loop profiling for the example apps.
+
+In on_mount, after docking everything else:
+
+    self.profile = await install_profiler(self)
+    # optional, app specific
+    self.profile.gauges["queue depth"] = lambda: self.ingest.pending
+    self.profile.counters["rows rendered"] = lambda: self.table.lines.rows_rendered
+
+Then "p" shows an overlay with frame times, layout passes per second, event
+loop lag, and the app's gauges (shown as is) and counters (shown per
+second).
+
+textual 0.1 renders and writes widgets to the terminal in the root view's
+Update and Layout message handlers, so a frame is timed around those.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from rich.panel import Panel
+from rich.table import Table
+from textual import messages
+from textual.app import App
+from textual.widget import Widget
+
+# averages and rates are over this many seconds
+WINDOW = 2.0
+# how often loop lag is measured and the overlay refreshed
+TICK = 0.25
+
+
+class RenderProfile:
+    def __init__(self):
+        # (end time, seconds) of each frame in the last WINDOW
+        self.frames: deque[tuple[float, float]] = deque()
+        # times of layout passes in the last WINDOW
+        self.layouts: deque[float] = deque()
+        # how late the last TICK sleep woke up, and the worst in the window
+        self.loop_lag = 0.0
+        self._loop_lags: deque[tuple[float, float]] = deque()
+        # name -> current value
+        self.gauges: dict[str, Callable[[], int]] = {}
+        # name -> cumulative count; shown per second
+        self.counters: dict[str, Callable[[], int]] = {}
+        self._counter_samples: dict[str, deque[tuple[float, int]]] = {}
+
+    @contextmanager
+    def frame(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.frames.append((end, end - start))
+
+    def layout(self) -> None:
+        self.layouts.append(time.perf_counter())
+
+    async def watch_loop_lag(self) -> None:
+        """Runs forever, measuring how long callbacks delay the event loop."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            now = time.perf_counter()
+            self.loop_lag = now - start - TICK
+            self._loop_lags.append((now, self.loop_lag))
+            self.sample()
+
+    def sample(self) -> None:
+        now = time.perf_counter()
+        for name, counter in self.counters.items():
+            samples = self._counter_samples.setdefault(name, deque())
+            samples.append((now, counter()))
+        self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        start = now - WINDOW
+        for timed in (self.frames, self._loop_lags):
+            while timed and timed[0][0] < start:
+                timed.popleft()
+        while self.layouts and self.layouts[0] < start:
+            self.layouts.popleft()
+        for samples in self._counter_samples.values():
+            # keep one sample from before the window, to take the rate from
+            while len(samples) > 1 and samples[1][0] < start:
+                samples.popleft()
+
+    def summary(self) -> list[tuple[str, str]]:
+        durations = [seconds for _, seconds in self.frames]
+        lines = [
+            ("frames/s", f"{len(durations) / WINDOW:.1f}"),
+            (
+                "frame ms avg",
+                f"{1000 * sum(durations) / len(durations):.2f}" if durations else "-",
+            ),
+            ("frame ms max", f"{1000 * max(durations, default=0):.2f}"),
+            ("layouts/s", f"{len(self.layouts) / WINDOW:.1f}"),
+            ("loop lag ms", f"{1000 * self.loop_lag:.1f}"),
+            (
+                "loop lag ms max",
+                f"{1000 * max((lag for _, lag in self._loop_lags), default=0):.1f}",
+            ),
+        ]
+        for name, gauge in self.gauges.items():
+            lines.append((name, str(gauge())))
+        for name, samples in self._counter_samples.items():
+            (start, first), (end, last) = samples[0], samples[-1]
+            rate = (last - first) / (end - start) if end > start else 0
+            lines.append((f"{name}/s", f"{rate:.0f}"))
+        return lines
+
+
+class ProfileOverlay(Widget):
+    def __init__(self, profile: RenderProfile):
+        super().__init__()
+        self.profile = profile
+
+    def render(self) -> Panel:
+        table = Table.grid(padding=(0, 1))
+        table.add_column()
+        table.add_column(justify="right")
+        for name, value in self.profile.summary():
+            table.add_row(name, value)
+        return Panel(table, title="profile")
+
+
+async def install_profiler(
+    app: App, key: str = "p", width: int = 34
+) -> RenderProfile:
+    """Times the app's frames and docks a hidden overlay that `key` toggles."""
+    profile = RenderProfile()
+    overlay = ProfileOverlay(profile)
+    overlay.visible = False
+
+    view = app.view
+    handle_update = view.handle_update
+    handle_layout = view.handle_layout
+
+    async def timed_update(message: messages.Update) -> None:
+        # don't count the overlay's own refreshes
+        if message.widget is overlay:
+            await handle_update(message)
+            return
+        with profile.frame():
+            await handle_update(message)
+
+    async def timed_layout(message: messages.Layout) -> None:
+        profile.layout()
+        with profile.frame():
+            await handle_layout(message)
+
+    # message handlers are looked up by name on the instance
+    view.handle_update = timed_update
+    view.handle_layout = timed_layout
+
+    # its own layer, so it covers the app instead of taking space from it
+    await view.dock(overlay, edge="right", size=width, z=1, name="profile")
+    await app.bind(key, "view.toggle('profile')", "Profile")
+
+    def refresh_overlay() -> None:
+        if overlay.visible:
+            overlay.refresh()
+
+    app.set_interval(TICK, refresh_overlay)
+    asyncio.create_task(profile.watch_loop_lag())
+    return profile
@@ -1,12 +1,16 @@
+import argparse
 import asyncio
+import random
+import re
+from array import array
 from math import sin
 from typing import Any, AsyncIterable, Literal, Optional, Union
 
-from rich.table import Table
 from rich.text import Text
 from textual.app import App
 from textual import events
 from textual.message import Message
+from textual.messages import CursorMove
 from textual.reactive import Reactive
 from textual.layouts.grid import GridLayout
 from textual.widget import Widget
@@ -19,22 +23,53 @@ from textual.widgets import (
     DirectoryTree,
 )
 
+from render_profile import install_profiler
+from stream_table_model import (
+    EMPTY_ROWS,
+    ColumnarRows,
+    DeleteRow,
+    RenderedRows,
+    RowIngest,
+    RowQuery,
+    Snapshot,
+    TableLines,
+    TableUpdate,
+    UpsertRow,
+    WindowedRows,
+)
+
 
-async def stream_table_data() -> AsyncIterable[list[list[str]]]:
+async def stream_table_data(
+    fixed_num_rows: Optional[int] = None,
+) -> AsyncIterable[ColumnarRows]:
     count = 0
     while True:
-        rows: list[list[str]] = []
-        num_rows = 30 + round(sin(count / 2) * 9)
-        for r in range(num_rows):
-            row = [f'row {r}']
-            for c in range(8):
-                row.append(str(count * r * c))
-            rows.append(row)
-        yield rows
+        num_rows = fixed_num_rows or 30 + round(sin(count / 2) * 9)
+        names = [f'row {r}' for r in range(num_rows)]
+        columns = [
+            array('q', (count * r * c for r in range(num_rows))) for c in range(8)
+        ]
+        yield ColumnarRows(names, columns)
         await asyncio.sleep(4)
         count += 1
 
 
+async def stream_table_deltas(
+    num_rows: int, per_second: float = 1000
+) -> AsyncIterable[TableUpdate]:
+    """Single-row updates, much faster than it's worth re-rendering."""
+    count = 0
+    while True:
+        # a few rows past num_rows, so rows come and go
+        r = random.randrange(num_rows + 5)
+        if r >= num_rows and random.random() < 0.5:
+            yield DeleteRow(f'row {r}')
+        else:
+            yield UpsertRow(f'row {r}', [count * c for c in range(8)])
+        count += 1
+        await asyncio.sleep(1 / per_second)
+
+
 # async def main():
 #     async for rows in stream_table_data():
 #         print(rows)
@@ -59,56 +94,236 @@ class RowDetails(Widget):
 
 # TODO: how do i update the outer scrollview from here when rows changes?
 class StreamTable(Widget):
-    rows: Reactive[list[list[str]]] = Reactive([])
+    # watch_rows decides what to refresh
+    rows: Reactive[ColumnarRows] = Reactive(EMPTY_ROWS, repaint=False)
     selected_row: Reactive[Optional[tuple[str, int]]] = Reactive(("row 2", 2))
     # hide_higlight = False
+    # first row shown, in virtual mode
+    scroll_offset: Reactive[int] = Reactive(0)
+    # which rows are shown, in what order
+    query: Reactive[RowQuery] = Reactive(RowQuery(), repaint=False)
+    # typed row number, for "g"
+    jump_digits = ""
+    # row name prefix being typed after "/", or None
+    search: Optional[str] = None
+    # row name regex being typed after "f", or None
+    filter_text: Optional[str] = None
+
+    def __init__(self, name: Optional[str] = None, virtual: bool = False):
+        """In `virtual` mode, the table scrolls itself and only renders the
+        rows that fit in it, instead of rendering every row for an outer
+        ScrollView. Use it for big tables."""
+        super().__init__(name)
+        # rendered lines per row, so refreshes only re-render changed rows
+        self.lines = TableLines()
+        self.virtual = virtual
+
+    @property
+    def shown_rows(self) -> ColumnarRows:
+        """The rows after sorting and filtering."""
+        return self.lines.rows
+
+    @property
+    def visible_rows(self) -> int:
+        # minus the header
+        return max(self.size.height - self.lines.header_height, 1)
+
+    def validate_scroll_offset(self, offset: int) -> int:
+        return max(0, min(offset, len(self.shown_rows) - self.visible_rows))
+
+    def scroll_to_row(self, index: int) -> None:
+        if index < self.scroll_offset:
+            self.scroll_offset = index
+        elif index >= self.scroll_offset + self.visible_rows:
+            self.scroll_offset = index - self.visible_rows + 1
+
+    def watch_selected_row(self, selected_row):
+        if not selected_row:
+            return
+        if self.virtual:
+            self.scroll_to_row(selected_row[1])
+        else:
+            # the outer ScrollView scrolls to this; skip the header
+            line = selected_row[1] + self.lines.header_height
+            self.emit_no_wait(CursorMove(self, line))
+
+    async def on_mouse_scroll_up(self, event: events.MouseScrollUp) -> None:
+        if self.virtual:
+            self.scroll_offset += 3
+
+    async def on_mouse_scroll_down(self, event: events.MouseScrollDown) -> None:
+        if self.virtual:
+            self.scroll_offset -= 3
+
+    @property
+    def page_rows(self) -> int:
+        # without virtual mode, we're as tall as all our rows
+        return self.visible_rows if self.virtual else 20
+
+    def select_index(self, index: int) -> None:
+        rows = self.shown_rows
+        if not rows:
+            return
+        index = max(0, min(index, len(rows) - 1))
+        self.selected_row = (rows.names[index], index)
+
+    def sort_by(self, column: Optional[int], reverse: bool = False) -> None:
+        """Sorts rows by `column` (0 is the name), or not at all for None."""
+        self.query = self.query._replace(sort_column=column, reverse=reverse)
+
+    def filter_rows(self, pattern: Optional[str], column: int = 0) -> None:
+        """Shows only rows whose `column` cell matches the regex `pattern`.
+
+        Raises re.error for a bad pattern.
+        """
+        compiled = re.compile(pattern) if pattern else None
+        self.query = self.query._replace(pattern=compiled, filter_column=column)
+
+    def show_aggregates(self, show: bool) -> None:
+        """Shows sum, min, max, p50 and p99 of each column under the header."""
+        self.lines.show_aggregates(show)
+        self.update_lines(layout=True)
 
     async def on_key(self, key_ev: events.Key):
-        for (pair_num, (row1, row2)) in enumerate(
-            zip(self.rows, self.rows[1:])
-        ):
-            name1 = row1[0]
-            name2 = row2[0]
-            if not self.selected_row:
-                self.selected_row = (name1, pair_num)
-                break
-            # TODO: figure out how to handle scrolling the outer scrollview..
-            if key_ev.key in ("down", "j") and name1 == self.selected_row[0]:
-                self.selected_row = (name2, pair_num + 1)
-                # key_ev.stop()
-                break
-            elif key_ev.key in ("up", "k") and name2 == self.selected_row[0]:
-                self.selected_row = (name1, pair_num)
-                # key_ev.stop()
-                break
-            elif key_ev.key in ("right", "l") and name1 == self.selected_row[0]:
-                await self.emit(ViewRowDetail(self, name1))
-                # self.rows[0][0] += 'TODO HAX'
-                self.refresh(layout=True)
-                break
+        key = key_ev.key
+        if self.search is not None:
+            # don't let the app treat search text as key bindings
+            key_ev.stop()
+            await self.on_search_key(key)
+            return
+        if self.filter_text is not None:
+            key_ev.stop()
+            self.on_filter_key(key)
+            return
+        if key in ("s", "r", "f", "a"):
+            self.on_query_key(key)
+            key_ev.stop()
+            return
+        if not self.shown_rows:
+            return
+        if not self.selected_row:
+            self.select_index(0)
+            return
+        index = self.selected_row[1]
+        if key.isdigit():
+            self.jump_digits += key
+            self.app.sub_title = f"go to row {self.jump_digits}"
+            return
+        jump_digits, self.jump_digits = self.jump_digits, ""
+        if jump_digits:
+            self.app.sub_title = ""
+
+        if key in ("down", "j"):
+            self.select_index(index + 1)
+        elif key in ("up", "k"):
+            self.select_index(index - 1)
+        elif key in ("pagedown", "ctrl+f"):
+            self.select_index(index + self.page_rows)
+        elif key in ("pageup", "ctrl+b"):
+            self.select_index(index - self.page_rows)
+        elif key == "home" or (key == "g" and not jump_digits):
+            self.select_index(0)
+        elif key in ("end", "G"):
+            self.select_index(len(self.shown_rows) - 1)
+        elif key == "g":
+            self.select_index(int(jump_digits))
+        elif key == "/":
+            self.search = ""
+            self.app.sub_title = "/"
+        elif key in ("right", "l"):
+            await self.emit(ViewRowDetail(self, self.selected_row[0]))
+            # self.rows[0][0] += 'TODO HAX'
+            self.refresh(layout=True)
+            return
+        else:
+            return
+        # we scroll ourselves, or emit CursorMove for the outer ScrollView
+        key_ev.stop()
+
+    async def on_search_key(self, key: str) -> None:
+        """Jumps to the first row (by name) starting with the typed text."""
+        assert self.search is not None
+        if key in ("enter", "escape"):
+            self.search = None
+            self.app.sub_title = ""
+            return
+        if key in ("backspace", "ctrl+h"):
+            self.search = self.search[:-1]
+        elif len(key) == 1:
+            self.search += key
+        self.app.sub_title = f"/{self.search}"
+        name = self.lines.index.find_prefix(self.search)
+        if name is not None:
+            index = self.lines.index.position(name)
+            assert index is not None
+            self.select_index(index)
+
+    def on_query_key(self, key: str) -> None:
+        query = self.query
+        if key == "s":
+            # next column, then back to unsorted
+            column = -1 if query.sort_column is None else query.sort_column
+            column += 1
+            self.sort_by(column if column < len(self.lines.widths) else None)
+        elif key == "r":
+            self.sort_by(query.sort_column, not query.reverse)
+        elif key == "f":
+            self.filter_text = query.pattern.pattern if query.pattern else ""
+            self.app.sub_title = f"filter: {self.filter_text}"
+        elif key == "a":
+            self.show_aggregates(self.lines.aggregates is None)
+
+    def on_filter_key(self, key: str) -> None:
+        """Filters rows by name as the regex is typed. Escape clears it."""
+        assert self.filter_text is not None
+        if key in ("enter", "escape"):
+            if key == "escape":
+                self.filter_rows(None)
+            self.filter_text = None
+            self.app.sub_title = ""
+            return
+        if key in ("backspace", "ctrl+h"):
+            self.filter_text = self.filter_text[:-1]
+        elif len(key) == 1:
+            self.filter_text += key
+        try:
+            self.filter_rows(self.filter_text)
+        except re.error:
+            self.app.sub_title = f"filter: {self.filter_text} (incomplete)"
+            return
+        self.app.sub_title = f"filter: {self.filter_text}"
 
     def watch_rows(self, stuff):
-        if (row := self.selected_row) and row[1] >= len(self.rows):
-            new_index = min(row[1], len(self.rows) - 1)
-            self.selected_row = (self.rows[new_index][0], new_index)
-        # needed to cause ScrollView container to update
-        self.refresh(layout=True)
-
-    def render(self) -> Table:
-        table = Table(padding=0)
-        columns_set = False
-        for row in self.rows:
-            row_name = row[0]
-            if not columns_set:
-                for i, _ in enumerate(row, 1):
-                    table.add_column(f"col {i}")
-                columns_set = True
-            if self.selected_row and row_name == self.selected_row[0]:
-                row_rends = [Text(str(i), style="reverse") for i in row]
-            else:
-                row_rends = [str(i) for i in row]
-            table.add_row(*row_rends)
-        return table
+        self.update_lines()
+
+    def watch_query(self, query: RowQuery):
+        self.lines.set_query(query)
+        self.update_lines()
+
+    def update_lines(self, layout: bool = False) -> None:
+        """Updates rendered lines from rows, after they or how they're shown
+        changed."""
+        diff = self.lines.update(self.rows)
+        if row := self.selected_row:
+            # follow the selected row if it moved, else stay at its index
+            index = self.lines.index.position(row[0])
+            self.select_index(row[1] if index is None else index)
+        if self.virtual:
+            # we might have scrolled past the end
+            self.scroll_offset = self.validate_scroll_offset(self.scroll_offset)
+        # A layout is needed to cause ScrollView container to update, but
+        # only when our size changed. Otherwise just repaint. Virtual tables
+        # are docked with a fixed size, so they never need one.
+        layout = layout or diff.layout_changed
+        self.refresh(layout=layout and not self.virtual)
+
+    def render(self) -> Union[RenderedRows, WindowedRows]:
+        selected_name = self.selected_row[0] if self.selected_row else None
+        if self.virtual:
+            return self.lines.window_renderable(
+                self.scroll_offset, self.size.height, selected_name
+            )
+        return self.lines.renderable(selected_name)
 
 
 class StreamTableApp(App):
@@ -117,6 +332,13 @@ class StreamTableApp(App):
     table: StreamTable
     row_details: RowDetails
     view_mode: Reactive[Union[Literal['table'], tuple[Literal['row'], str]]] = Reactive('table')
+    # set from the command line
+    virtual = False
+    num_rows: Optional[int] = None
+    deltas = False
+    # at most this many table updates per second; updates in between are
+    # coalesced
+    fps = 10.0
 
     async def on_load(self) -> None:
         await self.bind("b", "view.toggle('sidebar')", "Toggle sidebar")
@@ -124,31 +346,56 @@ class StreamTableApp(App):
 
     async def on_mount(self) -> None:
         # self.main = ScrollView()
-        self.table = StreamTable()
+        self.table = StreamTable(virtual=self.virtual)
         # self.row_details =
-        self.main = ScrollView(self.table)
+        if self.virtual:
+            # the table scrolls itself, so main is just for row details
+            self.main = ScrollView()
+            self.main.visible = False
+        else:
+            self.main = ScrollView(self.table)
 
         self.title = 'streamtable'
         self.header = Header(tall=False)
         await self.view.dock(self.header, edge="top")
         await self.view.dock(Footer(), edge="bottom")
         await self.view.dock(Placeholder(), edge="left", size=20, name="sidebar")
+        if self.virtual:
+            await self.view.dock(self.table, edge="top")
         await self.view.dock(self.main, edge="top")
 
         await self.table.focus()
 
+        self.ingest = RowIngest()
+        self.set_interval(1 / self.fps, self.flush_updates)
+        self.set_interval(5, self.log_ingest_stats)
         asyncio.create_task(self.update_table())
 
+        self.profile = await install_profiler(self)
+        self.profile.gauges["queue depth"] = lambda: self.ingest.pending
+        self.profile.gauges["rows"] = lambda: len(self.table.rows)
+        lines = self.table.lines
+        self.profile.counters["rows rendered"] = lambda: lines.rows_rendered
+        self.profile.counters["rows formatted"] = lambda: lines.rows_formatted
+
     async def watch_view_mode(self, blah):
         if self.view_mode == 'table':
             self.title = 'streamtable'
-            await self.main.window.update(self.table)
+            if self.virtual:
+                self.table.visible = True
+                self.main.visible = False
+            else:
+                await self.main.window.update(self.table)
         elif self.view_mode[0] == 'row':
             row_name = self.view_mode[1]
-            matching = [r for r in self.table.rows if row_name == r[0]]
-            row = matching[0]
+            index = self.table.lines.index.position(row_name)
+            assert index is not None, row_name
+            row = self.table.shown_rows.row(index)
             self.row_details = RowDetails(row)
             await self.main.window.update(self.row_details)
+            if self.virtual:
+                self.table.visible = False
+                self.main.visible = True
             self.title = f'streamtable > {row_name}'
             # self.table.rows[0][0] += 'wtfff'
 
@@ -164,8 +411,31 @@ class StreamTableApp(App):
         self.view_mode = 'table'
 
     async def update_table(self):
-        async for rows in stream_table_data():
+        # only buffers; flush_updates hands updates to the table
+        if self.deltas:
+            async for update in stream_table_deltas(self.num_rows or 30):
+                self.ingest.put(update)
+        else:
+            async for rows in stream_table_data(self.num_rows):
+                self.ingest.put(Snapshot(rows))
+
+    def flush_updates(self):
+        rows = self.ingest.take(self.table.rows)
+        if rows is not None:
             self.table.rows = rows
 
+    def log_ingest_stats(self):
+        self.log(f"ingest: {self.ingest.stats}, pending={self.ingest.pending}")
+
 
+p = argparse.ArgumentParser()
+p.add_argument("--virtual", action="store_true", help="only render visible rows")
+p.add_argument("--rows", type=int, help="rows per update (default: about 30)")
+p.add_argument("--deltas", action="store_true", help="stream single-row updates")
+p.add_argument("--fps", type=float, default=10, help="max table updates per second")
+args = p.parse_args()
+StreamTableApp.virtual = args.virtual
+StreamTableApp.num_rows = args.rows
+StreamTableApp.deltas = args.deltas
+StreamTableApp.fps = args.fps
 StreamTableApp.run(log="textual.log")
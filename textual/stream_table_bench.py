@@ -0,0 +1,138 @@
+"""Benchmarks StreamTable's rendering without a terminal.
+
+    python stream_table_bench.py --rows 1000 100000 1000000 --frames 50
+
+For each row count, feeds snapshots in which --changed of the rows have
+new values to the same TableLines and renderables StreamTable.render uses,
+renders them to a rich Console writing to a StringIO, and reports time per
+frame and rows rendered per second. Virtual mode renders a --height line
+window; with --full, also renders every row like the non-virtual table
+(slow for big tables). --sort and --aggregates time the table with rows
+sorted by a column, and with aggregates shown.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from array import array
+from io import StringIO
+from typing import Callable, Optional
+
+from rich.console import Console, RenderableType
+
+from stream_table_model import ColumnarRows, RowQuery, TableLines
+
+WIDTH = 120
+
+
+def synthetic_rows(num_rows: int, num_columns: int) -> ColumnarRows:
+    names = [f"row {r}" for r in range(num_rows)]
+    columns = [
+        array("q", (random.randrange(1_000_000) for _ in range(num_rows)))
+        for _ in range(num_columns)
+    ]
+    return ColumnarRows(names, columns)
+
+
+def change_rows(rows: ColumnarRows, fraction: float) -> ColumnarRows:
+    """A new snapshot with `fraction` of the rows' values changed."""
+    num_changed = round(fraction * len(rows))
+    changed = random.sample(range(len(rows)), num_changed)
+    columns = [array(column.typecode, column) for column in rows.columns]
+    for i in changed:
+        for column in columns:
+            column[i] = random.randrange(1_000_000)
+    return ColumnarRows(rows.names, columns)
+
+
+def time_frames(
+    rows: ColumnarRows,
+    frames: int,
+    changed: float,
+    render: Callable[[TableLines], RenderableType],
+    query: RowQuery = RowQuery(),
+    aggregates: bool = False,
+) -> tuple[float, float, float, float]:
+    """Seconds per update and per render, and rows rendered and formatted
+    per second of rendering."""
+    console = Console(file=StringIO(), width=WIDTH, height=1000)
+    lines = TableLines()
+    lines.set_query(query)
+    lines.show_aggregates(aggregates)
+    lines.update(rows)
+    update_time = render_time = 0.0
+    for _ in range(frames):
+        rows = change_rows(rows, changed)
+        start = time.perf_counter()
+        lines.update(rows)
+        middle = time.perf_counter()
+        console.print(render(lines))
+        end = time.perf_counter()
+        update_time += middle - start
+        render_time += end - middle
+        # only the last frame's output is ever needed
+        console.file = StringIO()
+    return (
+        update_time / frames,
+        render_time / frames,
+        lines.rows_rendered / render_time,
+        lines.rows_formatted / render_time,
+    )
+
+
+def format_result(
+    name: str, num_rows: int, result: tuple[float, float, float, float]
+) -> str:
+    update, render, rendered, formatted = result
+    return (
+        f"{name:>8} {num_rows:>9} rows: update {update * 1000:8.2f}ms"
+        f" render {render * 1000:8.2f}ms"
+        f" ({1 / (update + render):7.1f} frames/s)"
+        f" rendered {rendered:10.0f} rows/s, formatted {formatted:10.0f} rows/s"
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    p.add_argument("--columns", type=int, default=8)
+    p.add_argument("--frames", type=int, default=20)
+    p.add_argument(
+        "--changed", type=float, default=0.01, help="fraction of rows changed"
+    )
+    p.add_argument("--height", type=int, default=50, help="virtual window height")
+    p.add_argument("--full", action="store_true", help="also render all rows")
+    p.add_argument("--sort", type=int, help="column to sort by (0 is the name)")
+    p.add_argument("--aggregates", action="store_true", help="show aggregates")
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args(argv)
+
+    random.seed(args.seed)
+    query = RowQuery(sort_column=args.sort)
+    for num_rows in args.rows:
+        rows = synthetic_rows(num_rows, args.columns)
+        result = time_frames(
+            rows,
+            args.frames,
+            args.changed,
+            lambda lines: lines.window_renderable(0, args.height),
+            query,
+            args.aggregates,
+        )
+        print(format_result("virtual", num_rows, result))
+        if args.full:
+            result = time_frames(
+                rows,
+                args.frames,
+                args.changed,
+                lambda lines: lines.renderable(),
+                query,
+                args.aggregates,
+            )
+            print(format_result("full", num_rows, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1010 @@
+"""Row bookkeeping and rendering for stream_table.py.
+
+Kept free of textual so it can be used without a terminal. Rendering only
+needs rich.
+"""
+
+from __future__ import annotations
+
+import bisect
+import operator
+import re
+from array import array
+from dataclasses import dataclass
+from itertools import compress, count
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+)
+
+from rich.console import Console, ConsoleOptions, RenderResult
+from rich.measure import Measurement
+from rich.segment import Segment
+from rich.style import Style
+
+# A row's formatted cells. The first cell is its name, which identifies the
+# row between snapshots.
+Row = list[str]
+# a row's values, without its name
+Values = Sequence[Union[int, float]]
+
+SEPARATOR = Segment("│")
+SELECTED_STYLE = Style(reverse=True)
+HEADER_STYLE = Style(bold=True)
+AGGREGATE_STYLE = Style(dim=True)
+SCROLLBAR_STYLE = Style(dim=True)
+
+# WindowedRows also renders this many rows above and below the window, so
+# scrolling a little reuses cached lines.
+OVERSCAN = 20
+
+
+def format_cell(value: Union[int, float]) -> str:
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+
+def typecode(value: Union[int, float]) -> str:
+    return "d" if isinstance(value, float) else "q"
+
+
+class ColumnarRows:
+    """Rows stored as a list of names and one typed array per value column.
+
+    A million rows of 8 ints are 8 arrays of 8MB rather than 8 million str
+    objects. Cells are only formatted when a row is rendered, see `row`.
+    Treat instances as immutable: the methods that change rows return copies.
+
+    Column 0 is the name; value columns are numbered from 1, like the header.
+    """
+
+    def __init__(self, names: list[str], columns: list[array]):
+        assert all(len(column) == len(names) for column in columns)
+        self.names = names
+        self.columns = columns
+        # name -> index, built on first use
+        self._positions: Optional[dict[str, int]] = None
+
+    @classmethod
+    def from_rows(cls, names: list[str], rows: Iterable[Values]) -> ColumnarRows:
+        """From row-major values, e.g. for tests or small producers."""
+        rows = list(rows)
+        columns = [
+            array(typecode(value), [row[c] for row in rows])
+            for c, value in enumerate(rows[0] if rows else ())
+        ]
+        return cls(names, columns)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def num_columns(self) -> int:
+        return 1 + len(self.columns)
+
+    def column(self, column: int) -> Sequence:
+        return self.names if column == 0 else self.columns[column - 1]
+
+    def values(self, index: int) -> tuple:
+        return tuple(column[index] for column in self.columns)
+
+    def row(self, index: int) -> Row:
+        """The formatted cells of the row at `index`."""
+        return [self.names[index]] + [
+            format_cell(column[index]) for column in self.columns
+        ]
+
+    def position(self, name: str) -> Optional[int]:
+        if self._positions is None:
+            self._positions = {name: i for i, name in enumerate(self.names)}
+        return self._positions.get(name)
+
+    def take(self, indices: Sequence[int]) -> ColumnarRows:
+        """The rows at `indices`, in that order."""
+        return ColumnarRows(
+            [self.names[i] for i in indices],
+            [
+                array(column.typecode, map(column.__getitem__, indices))
+                for column in self.columns
+            ],
+        )
+
+    def sort_indices(self, column: int, reverse: bool = False) -> list[int]:
+        """Row indexes, ordered by the values in `column`."""
+        key = self.column(column).__getitem__
+        return sorted(range(len(self)), key=key, reverse=reverse)
+
+    def filter_indices(
+        self, column: int, predicate: Callable[[Any], bool]
+    ) -> list[int]:
+        """Indexes of the rows whose value in `column` matches `predicate`."""
+        return [i for i, value in enumerate(self.column(column)) if predicate(value)]
+
+    def sorted_by(self, column: int, reverse: bool = False) -> ColumnarRows:
+        return self.take(self.sort_indices(column, reverse))
+
+    def filtered(self, column: int, predicate: Callable[[Any], bool]) -> ColumnarRows:
+        return self.take(self.filter_indices(column, predicate))
+
+    def updated(self, deltas: dict[str, Optional[Values]]) -> ColumnarRows:
+        """A copy with rows upserted (name -> values) or deleted (name -> None).
+
+        Updated rows keep their position; new rows are appended.
+        """
+        deleted = {name for name, values in deltas.items() if values is None}
+        if deleted:
+            kept = [i for i, name in enumerate(self.names) if name not in deleted]
+            result = self.take(kept)
+        else:
+            result = ColumnarRows(
+                list(self.names),
+                [array(column.typecode, column) for column in self.columns],
+            )
+            # same names, so the same positions
+            result._positions = self._positions
+        added = []
+        for name, values in deltas.items():
+            if values is None:
+                continue
+            i = result.position(name)
+            if i is None:
+                added.append((name, values))
+                continue
+            for column, value in zip(result.columns, values):
+                column[i] = value
+        for name, values in added:
+            if not result.columns:
+                result.columns = [array(typecode(value)) for value in values]
+            result.names.append(name)
+            for column, value in zip(result.columns, values):
+                column.append(value)
+        if added:
+            result._positions = None
+        return result
+
+
+EMPTY_ROWS = ColumnarRows([], [])
+
+
+# _changed_indices compares this many values at a time, and then this many
+# within blocks that differ
+_BLOCK = 1024
+_SUBBLOCK = 32
+
+
+def _changed_indices(old: array, new: array) -> list[int]:
+    """Indexes at which `old` and `new` (of the same length) differ.
+
+    Compares their bytes a block at a time, which is a memcmp, so stretches
+    without changes cost next to nothing; values are only compared one by one
+    within the small blocks that differ.
+    """
+    old_bytes, new_bytes = old.tobytes(), new.tobytes()
+    if old_bytes == new_bytes:
+        return []
+    size = new.itemsize
+
+    def differ(start: int, stop: int) -> bool:
+        span = slice(start * size, stop * size)
+        return old_bytes[span] != new_bytes[span]
+
+    changed: list[int] = []
+    # whether the last block had changes in most of its subblocks, so
+    # comparing subblocks first would only add work
+    dense = False
+    for start in range(0, len(new), _BLOCK):
+        stop = min(start + _BLOCK, len(new))
+        if not differ(start, stop):
+            dense = False
+            continue
+        spans = [(start, stop)]
+        if not dense:
+            subblocks = range(start, stop, _SUBBLOCK)
+            spans = [(a, min(a + _SUBBLOCK, stop)) for a in subblocks]
+            spans = [(a, b) for a, b in spans if differ(a, b)]
+        found = len(changed)
+        for a, b in spans:
+            # iterates in C, unlike a generator expression
+            changed.extend(compress(range(a, b), map(operator.ne, old[a:b], new[a:b])))
+        dense = len(changed) - found > (stop - start) // _SUBBLOCK // 2
+    return changed
+
+
+def _sorted_position(
+    order: list[int], sort_values: Optional[Sequence], value: Any, index: int
+) -> int:
+    """Where the row at source `index`, with sort value `value`, goes in
+    `order`, which is sorted by value (`sort_values`, in the same order) and
+    then index. Or only by index, if `sort_values` is None."""
+    if sort_values is None:
+        return bisect.bisect_left(order, index)
+    lo = bisect.bisect_left(sort_values, value)
+    hi = bisect.bisect_right(sort_values, value, lo)
+    return bisect.bisect_left(order, index, lo, hi)
+
+
+Spliceable = TypeVar("Spliceable", list, array)
+
+
+def _without(items: Spliceable, positions: list[int]) -> Spliceable:
+    """A copy of `items` without the ones at (ascending) `positions`."""
+    result = items[:0]
+    start = 0
+    for position in positions:
+        result += items[start:position]
+        start = position + 1
+    result += items[start:]
+    return result
+
+
+def _with_inserted(
+    items: Spliceable, positions: list[int], inserted: Iterable
+) -> Spliceable:
+    """A copy of `items` with each of `inserted` before the item at the
+    matching one of (ascending) `positions`."""
+    result = items[:0]
+    start = 0
+    for position, item in zip(positions, inserted):
+        result += items[start:position]
+        result.append(item)
+        start = position
+    result += items[start:]
+    return result
+
+
+class RowDiff(NamedTuple):
+    # names of rows that are gone
+    removed: list[str]
+    # whether the table needs a new layout: the number of rows or some column
+    # width changed
+    layout_changed: bool
+
+
+class CellWidths:
+    """The widest formatted cell in each column of some rows, kept up to date
+    from the cells that change.
+
+    For numbers that's the min or the max (most digits, or a minus sign), so
+    only those are kept, and no cells need formatting. A column is only
+    scanned again when a cell that held its min or max changes.
+    """
+
+    def __init__(self, rows: ColumnarRows):
+        self._name_width = max(map(len, rows.names), default=0)
+        # per value column, (min, max), or None if there are no rows
+        self._extremes: list[Optional[tuple[Any, Any]]] = [
+            (min(column), max(column)) if column else None for column in rows.columns
+        ]
+
+    def update(
+        self,
+        rows: ColumnarRows,
+        removed_names: list[str],
+        added_names: list[str],
+        removed: list[list],
+        added: list[list],
+    ) -> None:
+        """Moves to `rows`, from which `removed_names` are gone and
+        `added_names` are new, and whose value columns lost the `removed`
+        values and gained the `added` ones."""
+        if any(len(name) == self._name_width for name in removed_names):
+            self._name_width = max(map(len, rows.names), default=0)
+        else:
+            self._name_width = max([self._name_width, *map(len, added_names)])
+        for c, (column, old_values, values) in enumerate(
+            zip(rows.columns, removed, added)
+        ):
+            extremes = self._extremes[c]
+            if extremes is None or any(value in old_values for value in extremes):
+                self._extremes[c] = (min(column), max(column)) if column else None
+            elif values:
+                self._extremes[c] = (
+                    min(extremes[0], min(values)),
+                    max(extremes[1], max(values)),
+                )
+
+    def widths(self) -> list[int]:
+        return [self._name_width] + [
+            max(len(format_cell(extremes[0])), len(format_cell(extremes[1])))
+            if extremes
+            else 0
+            for extremes in self._extremes
+        ]
+
+
+class RowIndex:
+    """Finds rows by name or name prefix without scanning all rows.
+
+    `update` only re-indexes rows from the first one whose name changed, so
+    snapshots that only change cell values cost one list comparison.
+    """
+
+    def __init__(self):
+        self.names: list[str] = []
+        self._positions: dict[str, int] = {}
+        # for prefix search
+        self._sorted_names: list[str] = []
+
+    def update(self, names: list[str]) -> None:
+        if names == self.names:
+            return
+        first_moved = next(
+            compress(count(), map(operator.ne, self.names, names)),
+            min(len(self.names), len(names)),
+        )
+        old_tail, tail = set(self.names[first_moved:]), set(names[first_moved:])
+        removed = old_tail - tail
+        added = tail - old_tail
+        for name in removed:
+            del self._positions[name]
+            del self._sorted_names[bisect.bisect_left(self._sorted_names, name)]
+        for name in added:
+            bisect.insort(self._sorted_names, name)
+        self._positions.update(
+            zip(names[first_moved:], range(first_moved, len(names)))
+        )
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def position(self, name: str) -> Optional[int]:
+        return self._positions.get(name)
+
+    def find_prefix(self, prefix: str) -> Optional[str]:
+        """The first name, in sorted order, that starts with `prefix`."""
+        i = bisect.bisect_left(self._sorted_names, prefix)
+        if i < len(self._sorted_names) and self._sorted_names[i].startswith(prefix):
+            return self._sorted_names[i]
+        return None
+
+
+class TableLines:
+    """Keeps rendered lines for each row, and re-renders only changed rows.
+
+    Call `update` with each new snapshot of rows. `query` decides which of
+    them are shown (`rows`), and in what order. Only rows that get rendered
+    have their cells formatted.
+    """
+
+    # Past this fraction of rows changed, selecting and sorting the shown
+    # rows again beats patching them.
+    RESELECT_FRACTION = 0.1
+
+    def __init__(self):
+        # the last snapshot, and the rows of it that are shown
+        self.source = EMPTY_ROWS
+        self.rows = EMPTY_ROWS
+        self.query = RowQuery()
+        # Source indexes of the shown rows, in order, but ascending with
+        # query.reverse; None if all are shown. With a sort, ties are in index
+        # order, and _sort_values are the sort column's values, in this order.
+        self._order: Optional[list[int]] = None
+        self._sort_values: Optional[Sequence] = None
+        # with a filter, 1 at the source indexes of the shown rows
+        self._shown: Optional[bytearray] = None
+        # whether the query changed since rows were selected
+        self._reselect = True
+        # row name -> whether it matches query.pattern
+        self._name_matches: dict[str, bool] = {}
+        self.aggregates: Optional[Aggregates] = None
+        self.index = RowIndex()
+        self.cell_widths = CellWidths(EMPTY_ROWS)
+        self.widths: tuple[int, ...] = ()
+        # row name -> (values, widths, selected) it was rendered with, and the
+        # resulting segments
+        self._line_cache: dict[str, tuple[tuple, list[Segment]]] = {}
+        # for profiling: rows rendered, and how many of those weren't cached
+        self.rows_rendered = 0
+        self.rows_formatted = 0
+
+    def set_query(self, query: RowQuery) -> None:
+        """Takes effect on the next `update`."""
+        self.query = query
+        self._reselect = True
+        self._name_matches = {}
+
+    def show_aggregates(self, show: bool) -> None:
+        """Takes effect on the next `update`."""
+        self.aggregates = Aggregates(self.rows) if show else None
+
+    @property
+    def header_height(self) -> int:
+        """Lines above the rows: the header, and aggregates if shown."""
+        return 1 + (len(AGGREGATES) if self.aggregates else 0)
+
+    def _select(self, source: ColumnarRows) -> ColumnarRows:
+        """The rows of `source` that the query shows, in order."""
+        query = self.query
+        self._reselect = False
+        self._shown = self._sort_values = None
+        if query.pattern is None and query.sort_column is None:
+            self._order = None
+            return source
+        if query.pattern is None:
+            order = list(range(len(source)))
+        else:
+            order = self._filter_indices(source)
+            self._shown = bytearray(len(source))
+            for i in order:
+                self._shown[i] = 1
+        self._order = order
+        if query.sort_column is None:
+            return source.take(order)
+        # stable, so ties stay in index order
+        order.sort(key=source.column(query.sort_column).__getitem__)
+        rows = source.take(order[::-1] if query.reverse else order)
+        sort_values = rows.column(query.sort_column)
+        self._sort_values = sort_values[::-1] if query.reverse else sort_values
+        return rows
+
+    def _filter_indices(self, source: ColumnarRows) -> list[int]:
+        pattern = self.query.pattern
+        assert pattern is not None
+        if self.query.filter_column != 0:
+            return source.filter_indices(
+                self.query.filter_column,
+                lambda value: pattern.search(format_cell(value)) is not None,
+            )
+        # names rarely change, so remember which match
+        matches = self._name_matches
+        if len(matches) > 2 * len(source):
+            matches.clear()
+
+        def name_matches(name: str) -> bool:
+            match = matches.get(name)
+            if match is None:
+                match = matches[name] = pattern.search(name) is not None
+            return match
+
+        return source.filter_indices(0, name_matches)
+
+    def update(self, source: ColumnarRows) -> RowDiff:
+        """Moves to a new snapshot of rows.
+
+        When it has the same names as the last one (only values changed), the
+        shown rows, column widths and aggregates are patched from the cells
+        that changed. Otherwise they're recomputed.
+        """
+        old = self.rows
+        removed = None
+        if (
+            not self._reselect
+            and source.names == self.source.names
+            and len(source.columns) == len(self.source.columns)
+        ):
+            removed = self._patch(source)
+        if removed is None:
+            rows = self.rows = self._select(source)
+            self.cell_widths = CellWidths(rows)
+            if self.aggregates is not None:
+                self.aggregates = Aggregates(rows)
+            removed = []
+            if rows.names != old.names:
+                removed = list(set(old.names).difference(rows.names))
+        self.source = source
+        rows = self.rows
+        for name in removed:
+            self._line_cache.pop(name, None)
+
+        old_widths = self.widths
+        headers = self.header_cells(rows.num_columns)
+        widths = [
+            max(width, len(header))
+            for width, header in zip(self.cell_widths.widths(), headers)
+        ]
+        for line in self.aggregate_cells():
+            widths = [max(width, len(cell)) for width, cell in zip(widths, line)]
+        self.widths = tuple(widths)
+        layout_changed = len(rows) != len(old) or self.widths != old_widths
+        self.index.update(rows.names)
+        return RowDiff(removed, layout_changed)
+
+    def _patch(self, source: ColumnarRows) -> Optional[list[str]]:
+        """Moves the shown rows to `source`, which has the same names as the
+        last snapshot, from the cells that changed: only rows whose sort value
+        changed move, and only rows whose filter value changed appear or
+        disappear.
+
+        Returns the names of the rows no longer shown, or None if so many rows
+        changed that selecting them again is less work.
+        """
+        old_source = self.source
+        changed = [
+            _changed_indices(old_column, column)
+            for old_column, column in zip(old_source.columns, source.columns)
+        ]
+        if self._order is None:
+            # all rows shown, in source order
+            self.rows = source
+            removed_values = [
+                list(map(column.__getitem__, indices))
+                for column, indices in zip(old_source.columns, changed)
+            ]
+            added_values = [
+                list(map(column.__getitem__, indices))
+                for column, indices in zip(source.columns, changed)
+            ]
+            self._update_stats([], [], removed_values, added_values)
+            return []
+        if max(map(len, changed), default=0) > self.RESELECT_FRACTION * len(source):
+            return None
+
+        query = self.query
+        shown = self._shown
+        # rows that start or stop matching a filter on values
+        entered: list[int] = []
+        left: list[int] = []
+        if query.pattern is not None and query.filter_column != 0:
+            assert shown is not None
+            filter_column = source.columns[query.filter_column - 1]
+            for i in changed[query.filter_column - 1]:
+                matches = query.pattern.search(format_cell(filter_column[i]))
+                if (matches is not None) != shown[i]:
+                    (left if matches is None else entered).append(i)
+        left_set = set(left)
+        # Rows that stay shown, in a new place. Rows sorted by name stay put,
+        # since the names are the same.
+        moved: list[int] = []
+        if query.sort_column:
+            moved = [
+                i
+                for i in changed[query.sort_column - 1]
+                if (shown is None or shown[i]) and i not in left_set
+            ]
+        moved_set = set(moved)
+
+        order, sort_values = self._order, self._sort_values
+        old_sort_column = new_sort_column = None
+        if query.sort_column is not None:
+            old_sort_column = old_source.column(query.sort_column)
+            new_sort_column = source.column(query.sort_column)
+
+        def old_position(i: int) -> int:
+            value = None if old_sort_column is None else old_sort_column[i]
+            return _sorted_position(order, sort_values, value, i)
+
+        # Positions in order are ascending; rows are reversed with
+        # query.reverse.
+        reverse = query.reverse and query.sort_column is not None
+        num_rows = len(order)
+
+        def row_position(position: int) -> int:
+            return num_rows - 1 - position if reverse else position
+
+        # Patch cells in place, in a copy. Moved rows are put back with their
+        # new values below.
+        rows = self.rows
+        columns = [array(column.typecode, column) for column in rows.columns]
+        positions: dict[int, int] = {}
+        removed_values: list[list] = [[] for _ in columns]
+        added_values: list[list] = [[] for _ in columns]
+        for c, indices in enumerate(changed):
+            old_column, new_column = old_source.columns[c], source.columns[c]
+            for i in indices:
+                if (shown is not None and not shown[i]) or i in left_set:
+                    continue
+                removed_values[c].append(old_column[i])
+                added_values[c].append(new_column[i])
+                if i not in moved_set:
+                    if i not in positions:
+                        positions[i] = row_position(old_position(i))
+                    columns[c][positions[i]] = new_column[i]
+        for i in left:
+            for c, column in enumerate(old_source.columns):
+                removed_values[c].append(column[i])
+        for i in entered:
+            for c, column in enumerate(source.columns):
+                added_values[c].append(column[i])
+
+        names = rows.names
+        gone = sorted(map(old_position, moved + left))
+        if gone:
+            order = _without(order, gone)
+            if sort_values is not None:
+                sort_values = _without(sort_values, gone)
+            gone = sorted(map(row_position, gone))
+            names = _without(names, gone)
+            columns = [_without(column, gone) for column in columns]
+        inserted = moved + entered
+        if inserted:
+            if new_sort_column is None:
+                inserted.sort()
+                at = [bisect.bisect_left(order, i) for i in inserted]
+            else:
+                assert sort_values is not None
+                inserted.sort(key=lambda i: (new_sort_column[i], i))
+                # the rows left in order have the same sort values as before
+                at = [
+                    _sorted_position(order, sort_values, new_sort_column[i], i)
+                    for i in inserted
+                ]
+                sort_values = _with_inserted(
+                    sort_values, at, map(new_sort_column.__getitem__, inserted)
+                )
+            kept = len(order)
+            order = _with_inserted(order, at, inserted)
+            if reverse:
+                at = [kept - position for position in reversed(at)]
+                inserted.reverse()
+            names = _with_inserted(names, at, map(source.names.__getitem__, inserted))
+            columns = [
+                _with_inserted(column, at, map(new_column.__getitem__, inserted))
+                for column, new_column in zip(columns, source.columns)
+            ]
+        if shown is not None:
+            for i in left:
+                shown[i] = 0
+            for i in entered:
+                shown[i] = 1
+        self._order, self._sort_values = order, sort_values
+        self.rows = ColumnarRows(names, columns)
+        removed = [source.names[i] for i in left]
+        added = [source.names[i] for i in entered]
+        self._update_stats(removed, added, removed_values, added_values)
+        return removed
+
+    def _update_stats(
+        self,
+        removed_names: list[str],
+        added_names: list[str],
+        removed_values: list[list],
+        added_values: list[list],
+    ) -> None:
+        """Updates widths and aggregates after rows changed, see
+        CellWidths.update."""
+        self.cell_widths.update(
+            self.rows, removed_names, added_names, removed_values, added_values
+        )
+        if self.aggregates is not None:
+            self.aggregates.update(removed_values, added_values)
+
+    def _render_cells(
+        self, cells: Iterable[str], style: Optional[Style] = None
+    ) -> list[Segment]:
+        segments = []
+        for column, (cell, width) in enumerate(zip(cells, self.widths)):
+            if column:
+                segments.append(SEPARATOR)
+            segments.append(Segment(cell.ljust(width), style))
+        return segments
+
+    def row_line(self, index: int, selected: bool) -> list[Segment]:
+        """The segments for the row at `index`, from the cache if nothing
+        changed."""
+        self.rows_rendered += 1
+        name = self.rows.names[index]
+        key = (self.rows.values(index), self.widths, selected)
+        cached = self._line_cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        self.rows_formatted += 1
+        line = self._render_cells(
+            self.rows.row(index), SELECTED_STYLE if selected else None
+        )
+        self._line_cache[name] = (key, line)
+        return line
+
+    def retain_lines(self, names: Iterable[str]) -> None:
+        """Drops cached lines for all rows except those named."""
+        keep = set(names)
+        for name in [name for name in self._line_cache if name not in keep]:
+            del self._line_cache[name]
+
+    def header_cells(self, num_columns: int) -> list[str]:
+        """Column headers, with an arrow on the sort column."""
+        headers = [header(column) for column in range(num_columns)]
+        if self.query.sort_column is not None and self.query.sort_column < num_columns:
+            arrow = "▼" if self.query.reverse else "▲"
+            headers[self.query.sort_column] += f" {arrow}"
+        return headers
+
+    def aggregate_cells(self) -> list[Row]:
+        """One line per aggregate, if shown, with its name in the first cell."""
+        if self.aggregates is None:
+            return []
+        return self.aggregates.lines()
+
+    def header_lines(self) -> list[list[Segment]]:
+        """The header, then aggregates if shown."""
+        lines = [self._render_cells(self.header_cells(len(self.widths)), HEADER_STYLE)]
+        for cells in self.aggregate_cells():
+            lines.append(self._render_cells(cells, AGGREGATE_STYLE))
+        return lines
+
+    def renderable(self, selected_name: Optional[str] = None) -> RenderedRows:
+        return RenderedRows(self, selected_name)
+
+    def window_renderable(
+        self, offset: int, height: int, selected_name: Optional[str] = None
+    ) -> WindowedRows:
+        return WindowedRows(self, offset, height, selected_name)
+
+
+def header(column: int) -> str:
+    return f"col {column + 1}"
+
+
+class RenderedRows:
+    """Rich renderable for a TableLines: a header, then one line per row."""
+
+    def __init__(self, lines: TableLines, selected_name: Optional[str]):
+        self.lines = lines
+        self.selected_name = selected_name
+
+    @property
+    def height(self) -> int:
+        return self.lines.header_height + len(self.lines.rows)
+
+    @property
+    def width(self) -> int:
+        widths = self.lines.widths
+        return sum(widths) + max(len(widths) - 1, 0)
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        new_line = Segment.line()
+        for line in self.lines.header_lines():
+            yield from line
+            yield new_line
+        for i, name in enumerate(self.lines.rows.names):
+            yield from self.lines.row_line(i, name == self.selected_name)
+            yield new_line
+
+    def __rich_measure__(
+        self, console: Console, options: ConsoleOptions
+    ) -> Measurement:
+        return Measurement(self.width, self.width)
+
+
+def scrollbar_thumb(offset: int, window: int, total: int) -> tuple[int, int]:
+    """Start and length of the thumb in a `window` line scrollbar.
+
+    Only needs the counts, so it's O(1) however many rows there are.
+    """
+    if total <= window:
+        return 0, window
+    size = max(1, window * window // total)
+    start = offset * (window - size) // (total - window)
+    return start, size
+
+
+class WindowedRows:
+    """Rich renderable for the rows visible in a `height` line window.
+
+    Renders the header, rows from `offset` on, and a scrollbar in the last
+    column. Only rows in (and OVERSCAN around) the window are rendered or
+    kept in the line cache, so the cost doesn't grow with the number of rows.
+    """
+
+    def __init__(
+        self,
+        lines: TableLines,
+        offset: int,
+        height: int,
+        selected_name: Optional[str],
+    ):
+        self.lines = lines
+        self.offset = offset
+        self.height = height
+        self.selected_name = selected_name
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        lines = self.lines
+        width = options.max_width - 1
+        body_height = max(self.height - lines.header_height, 0)
+        start = max(self.offset - OVERSCAN, 0)
+        stop = self.offset + body_height + OVERSCAN
+        names = lines.rows.names
+        nearby = range(start, min(stop, len(names)))
+        lines.retain_lines(names[start:stop])
+        rendered = [lines.row_line(i, names[i] == self.selected_name) for i in nearby]
+        visible = rendered[self.offset - start :][:body_height]
+
+        new_line = Segment.line()
+        for line in lines.header_lines():
+            yield from Segment.adjust_line_length(line, width)
+            yield Segment(" ")
+            yield new_line
+        thumb_start, thumb_size = scrollbar_thumb(
+            self.offset, body_height, len(lines.rows)
+        )
+        for i in range(body_height):
+            line = visible[i] if i < len(visible) else []
+            yield from Segment.adjust_line_length(line, width)
+            if thumb_start <= i < thumb_start + thumb_size:
+                yield Segment("█", SCROLLBAR_STYLE)
+            else:
+                yield Segment("│", SCROLLBAR_STYLE)
+            yield new_line
+
+
+##### ingest
+
+
+class Snapshot(NamedTuple):
+    """Replaces all rows."""
+
+    rows: ColumnarRows
+
+
+class UpsertRow(NamedTuple):
+    """Updates the named row, or appends it."""
+
+    name: str
+    values: Values
+
+
+class DeleteRow(NamedTuple):
+    name: str
+
+
+TableUpdate = Union[Snapshot, UpsertRow, DeleteRow]
+
+
+@dataclass
+class IngestStats:
+    received: int = 0
+    # batches of updates handed to the table
+    frames: int = 0
+    # snapshots replaced by a newer snapshot before they were shown
+    dropped_snapshots: int = 0
+    # deltas merged into another delta for the same row, or dropped by a
+    # snapshot, before they were shown
+    coalesced_deltas: int = 0
+
+
+class RowIngest:
+    """Buffers table updates between frames, so bursts cost one re-render.
+
+    `put` never blocks the producer. A snapshot replaces everything pending;
+    deltas for the same row are merged, latest wins. Once per frame, `take`
+    applies whatever is pending.
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[ColumnarRows] = None
+        # row name -> values, or None to delete it. Ordered by first update.
+        self._deltas: dict[str, Optional[Values]] = {}
+        self.stats = IngestStats()
+
+    @property
+    def pending(self) -> int:
+        return (self._snapshot is not None) + len(self._deltas)
+
+    def put(self, update: TableUpdate) -> None:
+        self.stats.received += 1
+        if isinstance(update, Snapshot):
+            if self._snapshot is not None:
+                self.stats.dropped_snapshots += 1
+            self.stats.coalesced_deltas += len(self._deltas)
+            self._snapshot = update.rows
+            self._deltas.clear()
+            return
+        if update.name in self._deltas:
+            self.stats.coalesced_deltas += 1
+        values = update.values if isinstance(update, UpsertRow) else None
+        self._deltas[update.name] = values
+
+    def take(self, rows: ColumnarRows) -> Optional[ColumnarRows]:
+        """Applies pending updates to `rows`, returning new rows.
+
+        Returns None if there was nothing pending.
+        """
+        if not self.pending:
+            return None
+        self.stats.frames += 1
+        if self._snapshot is not None:
+            rows, self._snapshot = self._snapshot, None
+        if not self._deltas:
+            return rows
+        deltas, self._deltas = self._deltas, {}
+        return rows.updated(deltas)
+
+
+##### sort, filter, aggregates
+
+
+class RowQuery(NamedTuple):
+    """Which rows TableLines shows, and in what order."""
+
+    # column to sort by, or None for the snapshot's order
+    sort_column: Optional[int] = None
+    reverse: bool = False
+    # show only rows whose filter_column cell matches
+    pattern: Optional[re.Pattern] = None
+    filter_column: int = 0
+
+
+AGGREGATES = ("sum", "min", "max", "p50", "p99")
+
+
+class ColumnStats:
+    """Sum and order statistics of a column, updated one value at a time.
+
+    Values are kept sorted, so min, max and percentiles are lookups, and
+    changing a value is a bisect plus a memmove rather than a sort.
+    """
+
+    # Changing more values than this at once is done in one pass instead.
+    INSORT_LIMIT = 128
+
+    def __init__(self, values: Iterable[Union[int, float]]):
+        self.sorted = sorted(values)
+        self.sum = sum(self.sorted)
+
+    def add(self, value: Union[int, float]) -> None:
+        bisect.insort(self.sorted, value)
+        self.sum += value
+
+    def remove(self, value: Union[int, float]) -> None:
+        del self.sorted[bisect.bisect_left(self.sorted, value)]
+        self.sum -= value
+
+    def update(self, removed: list, added: list) -> None:
+        """Removes each of `removed` and adds each of `added`."""
+        if len(removed) + len(added) <= self.INSORT_LIMIT:
+            for value in removed:
+                self.remove(value)
+            for value in added:
+                self.add(value)
+            return
+        # Past a few values, moving the rest of the list for each one costs
+        # more than cutting them all out, and then splicing the added ones in,
+        # in one pass each.
+        positions = []
+        start = 0
+        for value in sorted(removed):
+            # after the last position, for repeated values
+            start = bisect.bisect_left(self.sorted, value, start)
+            positions.append(start)
+            start += 1
+        values = _without(self.sorted, positions)
+        added = sorted(added)
+        at = [bisect.bisect_left(values, value) for value in added]
+        self.sorted = _with_inserted(values, at, added)
+        self.sum += sum(added) - sum(removed)
+
+    def percentile(self, p: float) -> Union[int, float]:
+        """Nearest rank, so it's always one of the values."""
+        return self.sorted[min(int(p / 100 * len(self.sorted)), len(self.sorted) - 1)]
+
+    def aggregates(self) -> tuple[Union[int, float], ...]:
+        if not self.sorted:
+            return (0, 0, 0, 0, 0)
+        return (
+            self.sum,
+            self.sorted[0],
+            self.sorted[-1],
+            self.percentile(50),
+            self.percentile(99),
+        )
+
+
+class Aggregates:
+    """AGGREGATES of each value column, kept up to date from the values that
+    change."""
+
+    def __init__(self, rows: ColumnarRows):
+        self.columns = [ColumnStats(column) for column in rows.columns]
+
+    def update(self, removed: list[list], added: list[list]) -> None:
+        """Removes the `removed` values from each column, and adds the `added`
+        ones."""
+        for stats, old_values, values in zip(self.columns, removed, added):
+            stats.update(old_values, values)
+
+    def lines(self) -> list[Row]:
+        values = [stats.aggregates() for stats in self.columns]
+        return [
+            [name] + [format_cell(column[a]) for column in values]
+            for a, name in enumerate(AGGREGATES)
+        ]